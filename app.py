@@ -12,14 +12,18 @@ import os                                  # 作業系統相關（路徑、環
 import traceback                           # 取得完整例外堆疊字串，方便在開發時回傳詳細錯誤
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form  # FastAPI 主體與請求/例外/表單工具
 from fastapi.middleware.cors import CORSMiddleware                  # CORS 中介層，讓前端（不同網域，例如 Flutter App）可呼叫 API
+from fastapi.responses import StreamingResponse                     # SSE 串流回應（stream=true 時邊產生答案邊送）
+from starlette.concurrency import run_in_threadpool                 # 在執行緒池跑同步函式，不卡住事件迴圈
 
 # ---- 專案內部服務與模組 ----
 from services import text_extractor  # 負責「任何類型」檔案抽文字 + 圖片/影片的 vision 分析成本回傳
 from services import pdf_utils, vector_store, qna  # pdf_utils: 切段工具；vector_store: 向量索引；qna: 問答核心邏輯
+from services.singleflight import AsyncSingleFlight  # 同時進行中的相同網址問答只算一次
 from routers.knowledge import router as knowledge_router  # /knowledge 路由（管理知識庫 / collections）
 
 from services import text_extractor  # 重複 import（雖然不影響執行，但其實可以刪掉；這邊我先保留不動）
-import requests                      # 用來對外部網址發 HTTP 請求（抓網頁 HTML）
+import httpx                         # 非同步 HTTP 用戶端：抓網頁 HTML 時不卡住事件迴圈
+import anyio                         # 調整 run_in_threadpool 使用的執行緒數上限
 from bs4 import BeautifulSoup        # 解析 HTML，萃取純文字內容
 from urllib.parse import urlparse    # 拆解網址（確認 scheme 是 http/https）
 import re                            # 正規表示式，用來偵測網址與驗證 collectionId 格式
@@ -32,7 +36,11 @@ from routers import news_api
 from routers.news_api import router as news_router, refresh_who_news
 
 from routers import find_papers
+from routers import collections as collections_router
+from routers import search as search_router
+import itertools
 import threading
+import uuid
 
 from routers.auth import get_current_user
 from fastapi import Depends
@@ -81,6 +89,8 @@ LIMITS_MB = {
 app.include_router(knowledge_router)
 app.include_router(news_router)
 app.include_router(find_papers.router)
+app.include_router(collections_router.router)
+app.include_router(search_router.router)
 
 # 加入 CORS 中介層，讓前端（例如：你在手機上的 Flutter App、本機 Web）可以跨網域呼叫 API
 app.add_middleware(
@@ -119,6 +129,20 @@ def preload_news():
     # 關鍵：背景執行，不阻塞 uvicorn listen
     threading.Thread(target=_job, daemon=True).start()
 
+
+# ==========================
+# 執行緒池大小
+# ==========================
+# 各 API 裡會卡住的工作（OpenAI 呼叫、FAISS、PDF 解析、ffmpeg）都丟到執行緒池跑，
+# 事件迴圈本身只負責收發；同時處理的請求數就由這個池的大小決定。
+# 大多是在等 OpenAI 回應，執行緒開多一點就能同時等更多請求（預設 40 偏保守）。
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
+
+
+@app.on_event("startup")
+def _set_threadpool_size():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
 # ==========================
 # 共用工具：網址與字串處理
 # ==========================
@@ -220,49 +244,67 @@ def _split_url_and_instruction(text: str) -> tuple[Optional[str], Optional[str]]
 # 處理「給網址 → 抓內容文字」的工具
 # ==========================
 
-def _extract_text_from_url(url: str, timeout: int = 12) -> str:
+# 網頁大小上限（避免下載超巨網頁，拖爆記憶體）
+MAX_PAGE_BYTES = 2 * 1024 * 1024  # 2MB
+
+
+async def _extract_text_from_url(url: str, timeout: int = 12) -> str:
     """
     下載 HTML，移除 script/style 等無用內容，回傳乾淨文字。
     主要用在：
       - /fetch_url
       - /ask 當 query 含有網址時
+    下載用 httpx 非同步進行；HTML 解析是 CPU 工作，丟到執行緒池。
     """
     # 基本網址驗證（只接受 http/https）
     parsed = urlparse(url)
     if parsed.scheme not in {"http", "https"}:
         raise HTTPException(status_code=400, detail="只支援 http/https 網址")
 
-    # 嘗試下載網頁內容
+    # 嘗試下載網頁內容（邊下載邊檢查大小，超過上限就中斷，不用整頁抓完）
     try:
-        resp = requests.get(
-            url,
+        async with httpx.AsyncClient(
             timeout=timeout,
+            follow_redirects=True,
             headers={"User-Agent": "Mozilla/5.0 (Medical-QA/1.0)"},
-        )
-    except requests.RequestException as e:
+        ) as http_client:
+            async with http_client.stream("GET", url) as resp:
+                if resp.status_code != 200:
+                    # 4xx、5xx 等錯誤
+                    raise HTTPException(status_code=400, detail=f"無法讀取網址（HTTP {resp.status_code}）")
+
+                # 檢查 Content-Type，避免抓到 PDF 等非 HTML 內容
+                ctype = (resp.headers.get("Content-Type") or "").lower()
+
+                # 目前只允許 HTML 類型內容；其餘請改用 /upload 上傳檔案
+                if not any(t in ctype for t in ["text/html", "text/plain", "application/xhtml"]):
+                    raise HTTPException(
+                        status_code=415,
+                        detail=f"目前僅支援一般網頁文字，偵測到 Content-Type={ctype}，請改用 /upload 上傳檔案。"
+                    )
+
+                body = bytearray()
+                async for chunk in resp.aiter_bytes():
+                    body.extend(chunk)
+                    if len(body) > MAX_PAGE_BYTES:
+                        raise HTTPException(status_code=413, detail="頁面過大（>2MB），請改上傳檔案或提供摘要。")
+                charset = resp.charset_encoding
+    except httpx.HTTPError as e:
         # 連線問題（DNS、timeout、連線被拒絕等）
         raise HTTPException(status_code=400, detail=f"連線失敗：{e}")
 
-    if resp.status_code != 200:
-        # 4xx、5xx 等錯誤
-        raise HTTPException(status_code=400, detail=f"無法讀取網址（HTTP {resp.status_code}）")
+    text = await run_in_threadpool(_html_to_text, bytes(body), charset)
 
-    # 檢查 Content-Type，避免抓到 PDF 等非 HTML 內容
-    ctype = (resp.headers.get("Content-Type") or "").lower()
+    if len(text) < 100:
+        # 文字太少，可能是首頁或廣告頁，對 QA 沒什麼用
+        raise HTTPException(status_code=400, detail="頁面文字過少或非文章頁，無法分析。")
 
-    # 目前只允許 HTML 類型內容；其餘請改用 /upload 上傳檔案
-    if not any(t in ctype for t in ["text/html", "text/plain", "application/xhtml"]):
-        raise HTTPException(
-            status_code=415,
-            detail=f"目前僅支援一般網頁文字，偵測到 Content-Type={ctype}，請改用 /upload 上傳檔案。"
-        )
+    return text
 
-    # 粗略大小限制（避免下載超巨網頁，拖爆記憶體）
-    if len(resp.content) > 2 * 1024 * 1024:  # 2MB
-        raise HTTPException(status_code=413, detail="頁面過大（>2MB），請改上傳檔案或提供摘要。")
 
-    # 使用 BeautifulSoup 解析 HTML → 純文字
-    soup = BeautifulSoup(resp.text, "html.parser")
+def _html_to_text(html: bytes, charset: Optional[str] = None) -> str:
+    """使用 BeautifulSoup 解析 HTML → 純文字（header 沒給編碼時由 BeautifulSoup 依 <meta charset> 判斷）。"""
+    soup = BeautifulSoup(html, "html.parser", from_encoding=charset)
     # 移除 script / style / noscript 等無內容元素
     for tag in soup(["script", "style", "noscript"]):
         tag.extract()
@@ -271,13 +313,7 @@ def _extract_text_from_url(url: str, timeout: int = 12) -> str:
 
     # 簡單整理每一行，移除空行
     lines = [ln.strip() for ln in text.splitlines()]
-    text = "\n".join([ln for ln in lines if ln])
-
-    if len(text) < 100:
-        # 文字太少，可能是首頁或廣告頁，對 QA 沒什麼用
-        raise HTTPException(status_code=400, detail="頁面文字過少或非文章頁，無法分析。")
-
-    return text
+    return "\n".join([ln for ln in lines if ln])
 
 
 # ==========================
@@ -373,18 +409,19 @@ def _clean_str(val: Optional[str]) -> Optional[str]:
 # 核心：給網址 → 建立臨時 collection → QA
 # ==========================
 
-async def _answer_from_url(url: str, top_k: int = 5, summary_query: str | None = None):
+async def _build_url_collection(url: str) -> tuple[str, int]:
     """
-    讀取 URL → 取正文 → 切段 → 向量化 → 建立「臨時 collection」→ 用 doc 模式回答 → 清理臨時 collection。
-
-    回傳格式與 /ask、/fetch_url 對齊，會包含：
-      - answer: 模型回答
-      - mode: 使用的模式（"doc"）
-      - usage / sources / cost 細節
+    讀取 URL → 取正文 → 切段 → 向量化 → 建立「臨時 collection」，回傳 (cid, 向量維度)。
+    用完要呼叫 _drop_url_collection 清掉。
     """
     # 1) 先抓網址全文（純文字）
-    fulltext = _extract_text_from_url(url)
+    fulltext = await _extract_text_from_url(url)
+    # 切段、向量化、寫入向量庫都會卡住 → 丟到執行緒池
+    return await run_in_threadpool(_index_url_text, url, fulltext)
+
 
+def _index_url_text(url: str, fulltext: str) -> tuple[str, int]:
+    """把網頁全文切段、向量化，寫進這個網址的臨時 collection。"""
     # 2) 清理 + 切段：把長文切成多段（類似你在 /upload 用的做法，但這裡用內嵌版本）
     def approx_tokens(s: str) -> int:
         # 粗估 token 數：字數 / 3.5（只是估算，避免切段太大）
@@ -441,28 +478,54 @@ async def _answer_from_url(url: str, top_k: int = 5, summary_query: str | None =
         raise HTTPException(status_code=500, detail="向量產生失敗")
     dim = len(vectors[0])
 
-    # 5) 建立一個「臨時 collection」（針對這個 url），用 hash 當 name
+    # 5) 建立一個「臨時 collection」：網址 hash + 每個請求自己的隨機碼
+    #    （同一個網址同時有好幾個請求時，各建各的，不會互相 reset / 刪掉對方正在用的）
     import hashlib
-    cid = "_url_" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+    cid = "_url_" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:12] + "_" + uuid.uuid4().hex
 
     # reset_collection：確保這個臨時 collection 是乾淨的
     vector_store.reset_collection(cid, dim)
+    # 記錄這次用的 embedding 設定，查詢時才會用同一組 model / dimensions
+    vector_store.set_embedding_profile(cid, qna.default_embedding_profile())
     vector_store.add_embeddings(cid, vectors, paragraphs)
+    return cid, dim
 
-    # 6) 做一次 QA（doc 模式），問題就是 summary_query 或預設「請用上面網址內容條列重點並進行摘要」
-    user_query = summary_query or "請用上面網址內容條列重點並進行摘要"
-    answer, mode_used, meta = qna.answer_question(
-        query=user_query, top_k=top_k, mode="doc", sources=None, collection_id=cid
-    )
 
-    # 7) 用完就把臨時 collection 清掉，避免向量庫越積越多
+def _drop_url_collection(cid: str):
+    """用完就把臨時 collection 整個刪掉（記憶體與資料夾），每個請求各一個，不刪會越積越多。"""
     try:
-        vector_store.reset_collection(cid, dim)
+        vector_store.drop_collection(cid)
     except Exception:
         # 若清理失敗就算了，這裡不再往外丟
         pass
 
-    # 8) 回傳結果給前端（/docs 也會照這個格式顯示）
+
+# 同時進行中的相同網址問答（網址 + 指令 + top_k 相同，例如大家同時轉貼同一則新聞）只抓一次、只問一次
+# 臨時 collection 跟著 flight 走：只有 leader 會跑 _run_url_question，每次各建一個專屬的
+# （cid 帶隨機碼），所以同一個網址、不同問題的 flight 同時在跑也不會共用或互刪 collection
+_URL_FLIGHTS = AsyncSingleFlight()
+
+
+async def _answer_from_url(url: str, top_k: int = 5, summary_query: str | None = None):
+    """
+    讀取 URL → 建立「臨時 collection」→ 用 doc 模式回答 → 清理臨時 collection。
+    同時有相同的網址問答在進行時，直接共用那一次的結果，成本由這些請求平均分攤。
+
+    回傳格式與 /ask、/fetch_url 對齊，會包含：
+      - answer: 模型回答
+      - mode: 使用的模式（"doc"）
+      - usage / sources / cost 細節
+      - shared: 與其他請求共用時的人數與總成本（沒有共用為 None）
+    """
+    # 做一次 QA（doc 模式），問題就是 summary_query 或預設「請用上面網址內容條列重點並進行摘要」
+    user_query = summary_query or "請用上面網址內容條列重點並進行摘要"
+    (answer, mode_used, meta, cid), callers, _ = await _URL_FLIGHTS.do(
+        (url, user_query, int(top_k)),
+        lambda: _run_url_question(url, user_query, top_k),
+    )
+    meta = qna.share_meta(meta, callers)
+
+    # 回傳結果給前端（/docs 也會照這個格式顯示）
     return {
         "ok": True,
         "url": url,
@@ -476,9 +539,94 @@ async def _answer_from_url(url: str, top_k: int = 5, summary_query: str | None =
         "chat_cost": round(meta.get("chat_cost", 0.0), 6),
         "transcribe_cost": round(meta.get("transcribe_cost", 0.0), 6),
         "collectionId": cid,
+        "shared": meta.get("shared"),
     }
 
 
+async def _run_url_question(url: str, user_query: str, top_k: int):
+    """
+    _answer_from_url 實際做事的部分（每個 flight 只跑一次）：建立這個 flight 專屬的臨時 collection、回答、清理；
+    回傳 (answer, mode, meta, cid)。
+    """
+    cid, _ = await _build_url_collection(url)
+    try:
+        answer, mode_used, meta = await run_in_threadpool(
+            qna.answer_question,
+            query=user_query, top_k=top_k, mode="doc", sources=None, collection_id=cid,
+            answer_cache=False,  # 臨時 collection 用完就刪，答案存進快取也永遠不會再命中
+        )
+    finally:
+        await run_in_threadpool(_drop_url_collection, cid)
+    return answer, mode_used, meta, cid
+
+
+async def _stream_from_url(url: str, top_k: int = 5, summary_query: str | None = None):
+    """
+    串流版的 _answer_from_url：建好臨時 collection、檢索完就清掉，再以 SSE 回答。
+    檢索到的段落在第一個事件（sources）產生時就已經放進 prompt，之後只剩 GPT 串流，
+    不用讓臨時 collection 一直留到串流結束（前端慢慢讀、或斷線沒觸發清理時也不會殘留）。
+    """
+    cid, _ = await _build_url_collection(url)
+    user_query = summary_query or "請用上面網址內容條列重點並進行摘要"
+    events = qna.answer_question_stream(
+        query=user_query, top_k=top_k, mode="doc", sources=None, collection_id=cid, answer_cache=False,
+    )
+    try:
+        first = await run_in_threadpool(next, events)
+    finally:
+        await run_in_threadpool(_drop_url_collection, cid)
+    return _sse_response(
+        itertools.chain([first], events),
+        {"url": url, "question": user_query, "collectionId": cid},
+    )
+
+
+# ==========================
+# SSE 串流回應
+# - 事件依序為 sources（檢索結果）→ delta（答案片段，多個）→ done（完整答案 + usage / 成本）
+# - 中途出錯時送 error 事件（HTTP 狀態碼已經送出，無法再改成 500）
+# ==========================
+
+def _sse_event(name: str, data: dict) -> str:
+    return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(events, fields: dict) -> StreamingResponse:
+    """
+    把 qna.answer_question_stream 的事件包成 text/event-stream。
+    done 事件的欄位與非串流的 /ask 回應相同（fields 是額外要帶的欄位，例如 collectionId、question）。
+    """
+    def gen():
+        try:
+            for name, data in events:
+                if name == "done":
+                    meta = data["meta"]
+                    data = {
+                        "ok": True,
+                        **fields,
+                        "collectionId": fields.get("collectionId") or meta.get("collection_id"),
+                        "answer": data["answer"],
+                        "mode": data["mode"],
+                        "cost_usd": round(meta.get("total_cost_usd", 0.0), 6),
+                        "embedding_cost": round(meta.get("embedding_cost", 0.0), 6),
+                        "chat_cost": round(meta.get("chat_cost", 0.0), 6),
+                        "transcribe_cost": round(meta.get("transcribe_cost", 0.0), 6),
+                        "usage": meta.get("usage", {}),
+                        "sources": meta.get("sources", []),
+                        "answer_cache": meta.get("answer_cache"),
+                    }
+                yield _sse_event(name, data)
+        except Exception as e:
+            yield _sse_event("error", {"ok": False, "detail": str(e).strip() or type(e).__name__})
+
+    # 同步 generator 會由 Starlette 放到執行緒池逐一取值，不會卡住事件迴圈
+    return StreamingResponse(
+        gen(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # 關掉 nginx 的回應緩衝
+    )
+
+
 # ==========================
 # API：/fetch_url
 # - 直接給網址 → 幫你抓內容並問答
@@ -490,8 +638,11 @@ async def fetch_url(
     url: str = Form(...),  # 表單欄位：網址
     query: str = Form("請用上面網址內容條列重點並進行摘要"),  # 問題（可改寫成想問的內容）
     top_k: int = Form(5),  # 從向量庫取前幾名相似段落
+    stream: bool = Form(False),  # true：以 SSE 邊產生邊回傳（sources → delta → done）
 ):
     try:
+        if stream:
+            return await _stream_from_url(url, top_k=top_k, summary_query=query)
         # 直接重用上面的 _answer_from_url
         return await _answer_from_url(url, top_k=top_k, summary_query=query)
     except HTTPException:
@@ -512,7 +663,7 @@ async def upload_pdf(
     request: Request,                     # 可以取得 header（例如 Content-Length）
     file: UploadFile = File(...),        # 上傳檔案
     collectionId: str = Form(None),      # 指定存入哪個 collection（資料夾/知識庫）
-    mode: str = Form("overwrite"),       # "overwrite"：清空舊資料；其他：append
+    mode: str = Form("overwrite"),       # "overwrite"：清空舊資料；"replace"：只替換同檔名的舊段落；其他：append
     current_user: str = Depends(get_current_user),
 ):
     try:
@@ -546,14 +697,16 @@ async def upload_pdf(
         os.makedirs(upload_dir, exist_ok=True)
         safe_name = os.path.basename(file.filename)  # 避免有人傳路徑進來
         file_path = os.path.join(upload_dir, safe_name)
-        with open(file_path, "wb") as f:
-            f.write(contents)
+        await run_in_threadpool(Path(file_path).write_bytes, contents)
         await file.close()
 
+        # 以下解析、轉錄、向量化、寫入向量庫都會卡住（CPU / OpenAI / ffmpeg / 磁碟），
+        # 一律丟到執行緒池跑，其他請求不用排在這次上傳後面
+
         # === 5) 抽取文字 + 可能的 vision 成本 ===
         # text_extractor.extract_any 會根據副檔名自動決定用哪種方式解析文字
         # 回傳：fulltext（整份文字）、vision_cost（圖片/影片分析成本）
-        fulltext, vision_cost = text_extractor.extract_any(file_path)
+        fulltext, vision_cost = await run_in_threadpool(text_extractor.extract_any, file_path)
 
         # === 6) 切段（改為包裝成頁面形式） ===
         if not fulltext.strip():
@@ -562,18 +715,11 @@ async def upload_pdf(
         # 目前簡單地把整份當成一頁：[(頁碼, 文字)]
         pages_text = [(1, fulltext)]
         # 用 pdf_utils.split_into_paragraphs 依空行、長度等切出多個段落
-        paragraphs = pdf_utils.split_into_paragraphs(pages_text)
+        paragraphs = await run_in_threadpool(pdf_utils.split_into_paragraphs, pages_text)
         if not paragraphs:
             raise HTTPException(status_code=500, detail="切段失敗（可能內容過短或格式錯誤）")
 
-        # === 7) 向量化 ===
-        # 把每個段落文字轉成 embedding 向量
-        vectors = qna.embed_paragraphs([p["text"] for p in paragraphs])
-        if not vectors:
-            raise HTTPException(status_code=500, detail="向量產生失敗")
-        dim = len(vectors[0])  # 向量維度，例如 1536
-
-        # === 8) collectionId 驗證與索引重建 ===
+        # === 7) collectionId 解析 ===
         # 這裡再定義一個區域版的 _norm_collection_id（與全域的幾乎一樣）
         # def _norm_collection_id(cid: str | None) -> str:
         #     INVALID_VALUES = {"", "string", "null", "undefined", "none"}
@@ -591,15 +737,19 @@ async def upload_pdf(
             cid = "_default"
         else:
             cid = get_or_create_cid(collectionId)
-        
 
-        # 模式選擇：
-        # - overwrite：整個 collection 重新建立（清空舊內容）
-        # - 其他：如果已存在，就延用原本索引
-        if mode == "overwrite":
-            vector_store.reset_collection(cid, dim)
+        # === 8) 向量化 ===
+        # 必須沿用 collection 自己的 embedding 設定（model + dimensions），
+        # 覆蓋模式下若 collection 還沒記錄過設定，就改用目前的預設設定
+        if mode == "overwrite" and not vector_store.embedding_profile(cid):
+            profile = qna.default_embedding_profile()
         else:
-            vector_store.init_collection(cid, dim)
+            profile = qna.collection_profile(cid)
+        # 把每個段落文字轉成 embedding 向量
+        vectors = await run_in_threadpool(qna.embed_paragraphs, [p["text"] for p in paragraphs], profile)
+        if not vectors:
+            raise HTTPException(status_code=500, detail="向量產生失敗")
+        dim = len(vectors[0])  # 向量維度，例如 1536
 
         # === 9) 加入來源資訊並寫入向量庫 ===
         src = file.filename
@@ -607,8 +757,25 @@ async def upload_pdf(
             # 如果 paragraph 沒有 source，就幫它加上檔名
             p.setdefault("source", src)
 
-        # 把 vectors + paragraphs 一起寫入 collection
-        vector_store.add_embeddings(cid, vectors, paragraphs)
+        def _store() -> int:
+            # 模式選擇：
+            # - overwrite：整個 collection 重新建立（清空舊內容）
+            # - replace / 其他：如果已存在，就延用原本索引
+            if mode == "overwrite":
+                vector_store.reset_collection(cid, dim)
+            else:
+                vector_store.init_collection(cid, dim)
+            if not vector_store.embedding_profile(cid):
+                vector_store.set_embedding_profile(cid, profile)
+
+            # 把 vectors + paragraphs 一起寫入 collection
+            # replace：同檔名的舊段落一起換掉（其他檔案不動，不用整個 collection 重新向量化）
+            if mode == "replace":
+                return vector_store.replace_source(cid, src, vectors, paragraphs)["deleted"]
+            vector_store.add_embeddings(cid, vectors, paragraphs)
+            return 0
+
+        paragraphs_replaced = await run_in_threadpool(_store)
 
         # === 10) 影音轉錄費（Whisper 成本暫存） ===
         is_audio = ext in {"mp3", "wav", "m4a"}
@@ -617,7 +784,7 @@ async def upload_pdf(
         transcribe_cost = 0.0
         if is_audio or is_video:
             # 取得影音長度（秒）→ 換算成分鐘 → 計算暫存轉錄成本
-            dur_sec = get_media_duration_sec(str(file_path))
+            dur_sec = await run_in_threadpool(get_media_duration_sec, str(file_path))
             minutes = dur_sec / 60.0
             transcribe_cost = round(minutes * PRICE_WHISPER_PER_MIN, 6)
             # 先累加到 pending 欄位，之後你可以再對帳
@@ -637,6 +804,7 @@ async def upload_pdf(
             "limit_mb": limit_mb,
             "size_mb": round(len(contents) / (1024 * 1024), 2),
             "paragraphs_indexed": len(paragraphs),
+            "paragraphs_replaced": paragraphs_replaced,
             "transcribe_cost": transcribe_cost,
             "vision_cost": vision_cost,
             "embedding_cost": embedding_cost,
@@ -670,6 +838,7 @@ async def ask_question(
     top_k: int = Form(5),
     source: Optional[List[str]] = Query(None), # 指定只從哪些來源檔案過濾
     collectionId: Optional[str] = Form(None),  # 指定 collection
+    stream: bool = Form(False),                # true：以 SSE 邊產生邊回傳（sources → delta → done）
 ):
     """
     支援三種使用方式：
@@ -767,6 +936,12 @@ async def ask_question(
 
         # --- 分支處理：若有 url，就走「抓網址 + QA」路線 ---
         if url:
+            if stream:
+                return await _stream_from_url(
+                    url,
+                    top_k=top_k,
+                    summary_query=instruction or "請用上面網址內容條列重點並進行摘要",
+                )
             # 呼叫前面寫好的 _answer_from_url，會建立臨時 collection 做 QA
             return await _answer_from_url(
                 url,
@@ -783,7 +958,21 @@ async def ask_question(
         # 才走 doc；否則走 general。
         mode_to_use = "doc" if (sources or cid is not None) else "general"
 
-        answer, mode_used, meta = qna.answer_question(
+        if stream:
+            # 串流：檢索完先送 sources，答案邊產生邊送，最後 done 事件帶 usage / 成本
+            events = qna.answer_question_stream(
+                query=pure_text,
+                top_k=top_k,
+                mode=mode_to_use,
+                sources=sources,
+                collection_id=cid,
+            )
+            return _sse_response(events, {"collectionId": cid, "question": pure_text})
+
+        # answer_question 是同步的（OpenAI 呼叫、FAISS 搜尋）→ 丟到執行緒池跑，
+        # 多個 /ask 才能同時進行（問題的 embedding 也才能跨請求合併送出）
+        answer, mode_used, meta = await run_in_threadpool(
+            qna.answer_question,
             query=pure_text,
             top_k=top_k,
             # 若有指定 sources 或 cid，就用 doc 模式（從向量庫檢索）
@@ -806,6 +995,10 @@ async def ask_question(
             "transcribe_cost": round(meta.get("transcribe_cost", 0.0), 6),
             "usage": meta.get("usage", {}),
             "sources": meta.get("sources", []) or (sources or []),
+            # 答案快取命中："exact"（同一個問題）/ "semantic"（意思幾乎一樣的問題）；沒命中為 None
+            "answer_cache": meta.get("answer_cache"),
+            # 同時有相同的問題在算時共用同一次結果：{"callers": 共用的請求數, "total_cost_usd": 這次的總成本}
+            "shared": meta.get("shared"),
         }
 
     except HTTPException:
@@ -0,0 +1,117 @@
+# routers/collections.py
+# 向量庫（vector_store）的維運用 API：快取統計等
+
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Form, HTTPException
+
+from routers.auth import get_current_user
+from services import embed_cache, qna, vector_store
+
+router = APIRouter(prefix="/collections", tags=["collections"])
+
+
+def _check_cid(cid: str):
+    """cid 只能包含英數、底線、減號（長度 1~64），其他一律 400，不讓它碰到檔案路徑。"""
+    if not vector_store.is_valid_cid(cid):
+        raise HTTPException(status_code=400, detail="collectionId 只能包含英數、底線、減號，長度 1~64")
+
+
+def _require_collection(cid: str):
+    """cid 要合法且已經存在（不存在就 404）；查詢與修改都先過這關，才不會順手在磁碟上建出一個空的 collection。"""
+    _check_cid(cid)
+    if not vector_store.exists(cid):
+        raise HTTPException(status_code=404, detail=f"找不到 collection：{cid}")
+
+
+@router.get("/cache", summary="向量庫快取統計（命中 / 未命中 / 淘汰次數、常駐大小）")
+def cache_stats():
+    return vector_store.cache_stats()
+
+
+@router.get("/embedding_cache", summary="段落 embedding 快取統計（筆數、大小、命中 / 未命中 / 淘汰次數）")
+def embedding_cache_stats():
+    return embed_cache.stats()
+
+
+@router.get("/answer_cache", summary="/ask 答案快取統計（筆數、設定、完全 / 相似命中與未命中次數）")
+def answer_cache_stats():
+    return qna.answer_cache_stats()
+
+
+@router.get("/{cid}/index", summary="查看 collection 的索引種類與策略")
+def index_info(cid: str):
+    _require_collection(cid)
+    return vector_store.index_info(cid)
+
+
+@router.put("/{cid}/index_policy", summary="覆寫 collection 的索引策略（auto / flat / hnsw / ivfpq）")
+def set_index_policy(
+    cid: str,
+    policy: Optional[str] = Form(None),
+    current_user: str = Depends(get_current_user),
+):
+    _require_collection(cid)
+    try:
+        vector_store.set_index_policy(cid, policy or None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return vector_store.index_info(cid)
+
+
+@router.put("/{cid}/quantization", summary="覆寫 collection 的向量量化方式（none / fp16 / int8 / pq）")
+def set_quantization(
+    cid: str,
+    quantization: Optional[str] = Form(None),
+    current_user: str = Depends(get_current_user),
+):
+    _require_collection(cid)
+    try:
+        vector_store.set_quantization(cid, quantization or None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return vector_store.index_info(cid)
+
+
+@router.get("/{cid}/sources", summary="列出 collection 內的來源檔案與段落數")
+def list_sources(cid: str):
+    _require_collection(cid)
+    return {"collection_id": cid, "sources": vector_store.list_sources(cid)}
+
+
+@router.delete("/{cid}/sources", summary="刪除某個來源檔案的所有段落（不用重建 collection）")
+def delete_source(cid: str, source: str, current_user: str = Depends(get_current_user)):
+    _require_collection(cid)
+    deleted = vector_store.delete_source(cid, source)
+    if not deleted:
+        raise HTTPException(status_code=404, detail=f"找不到來源：{source}")
+    # 空間不會馬上回收：pending_reclaim 是目前已刪除、等 compaction 回收的段落數
+    return {
+        "collection_id": cid,
+        "source": source,
+        "deleted": deleted,
+        "pending_reclaim": vector_store.index_info(cid)["deleted"],
+    }
+
+
+@router.get("/{cid}/embedding", summary="查看 collection 的 embedding 設定與重新向量化進度")
+def embedding_info(cid: str):
+    _require_collection(cid)
+    return {"profile": qna.collection_profile(cid), "job": qna.reembed_status(cid)}
+
+
+@router.put("/{cid}/embedding", summary="改用新的 embedding 設定（model / dimensions），在背景重新向量化")
+def set_embedding(
+    cid: str,
+    model: Optional[str] = Form(None),
+    dimensions: Optional[int] = Form(None),
+    current_user: str = Depends(get_current_user),
+):
+    _require_collection(cid)
+    if dimensions is not None and dimensions <= 0:
+        raise HTTPException(status_code=400, detail="dimensions 必須是正整數")
+    try:
+        job = qna.start_reembed(cid, model or None, dimensions)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"profile": qna.collection_profile(cid), "job": job}
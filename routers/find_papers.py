@@ -117,12 +117,12 @@ import httpx
 import os
 import re
 import xml.etree.ElementTree as ET
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 router = APIRouter()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)  # 非同步版，跟 httpx 一樣不卡住事件迴圈
 
 def is_chinese(text: str) -> bool:
     return bool(re.search(r"[\u4e00-\u9fff]", text))
@@ -150,7 +150,7 @@ async def find_papers(payload: QueryRequest = Body(...)):
         # 🔹 Step 0：中文轉英文
         if is_chinese(payload.query):
             translation_prompt = f"請將下列醫學查詢翻譯為英文：\n\n{payload.query}"
-            translation_resp = openai_client.chat.completions.create(
+            translation_resp = await openai_client.chat.completions.create(
                 model="gpt-4",
                 messages=[{"role": "user", "content": translation_prompt}],
                 temperature=0.2
@@ -225,7 +225,7 @@ async def find_papers(payload: QueryRequest = Body(...)):
             + "\n\n".join(summaries)
         )
 
-        gpt_resp = openai_client.chat.completions.create(
+        gpt_resp = await openai_client.chat.completions.create(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "你是一位醫學論文推薦引擎"},
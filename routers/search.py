@@ -0,0 +1,86 @@
+# routers/search.py
+# 批次檢索 API：一次送很多個問題，只做一次 embedding 呼叫、每組過濾條件一次 FAISS 搜尋
+# 給評估（evaluation）工作或一次問很多題的前端使用
+
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel, Field
+
+from routers.auth import get_current_user
+from services import qna, vector_store
+
+router = APIRouter(prefix="/search", tags=["search"])
+
+# 單次請求最多幾個查詢，避免一次塞爆 embeddings / 記憶體
+MAX_BATCH_QUERIES = 1000
+
+# 每個查詢最多取幾筆（0、負數或超大的值不能直接丟給 FAISS）
+MAX_TOP_K = 100
+
+
+class BatchSearchRequest(BaseModel):
+    collectionId: str
+    queries: Optional[List[str]] = None            # 文字查詢（由後端做 embedding）
+    vectors: Optional[List[List[float]]] = None    # 或直接給查詢向量（不收 embedding 費用）
+    top_k: int = Field(5, ge=1, le=MAX_TOP_K)
+    sources: Optional[List[str]] = None            # 所有查詢共用的來源過濾
+    filters: Optional[List[Optional[List[str]]]] = None  # 每個查詢各自的來源過濾（優先於 sources）
+
+
+def _resolve_cid(collection_id: str) -> str:
+    """跟 /ask 一樣：先把前端的 collection 名稱對照成實際 cid，對照不到就直接當 cid 用。"""
+    if collection_id == "_default":
+        return collection_id
+    # 對照表沿用 app.py 的 load_map（在這裡才 import：app.py 載入時會 import 這個 router）
+    from app import load_map
+    return load_map().get(collection_id) or collection_id
+
+
+@router.post("/batch", summary="批次檢索：一次取回多個問題的相似段落")
+def search_batch(payload: BatchSearchRequest, current_user: str = Depends(get_current_user)):
+    if (payload.queries is None) == (payload.vectors is None):
+        raise HTTPException(status_code=400, detail="queries 與 vectors 必須擇一提供")
+
+    n = len(payload.queries if payload.queries is not None else payload.vectors)
+    if n == 0:
+        raise HTTPException(status_code=400, detail="查詢列表是空的")
+    if n > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"單次最多 {MAX_BATCH_QUERIES} 個查詢")
+    if payload.filters is not None and len(payload.filters) != n:
+        raise HTTPException(status_code=400, detail="filters 的長度必須與查詢數相同")
+
+    cid = _resolve_cid(payload.collectionId.strip())
+    if not vector_store.is_valid_cid(cid):
+        raise HTTPException(status_code=400, detail="collectionId 只能包含英數、底線、減號，長度 1~64")
+    # 不存在的 collection 直接 404（不然搜尋時會在磁碟上建出一個空的，還白花 embedding 費用）
+    if not vector_store.exists(cid):
+        raise HTTPException(status_code=404, detail=f"找不到 collection：{cid}")
+
+    emb_cost = 0.0
+    if payload.queries is not None:
+        vectors, emb_cost = qna.embed_queries(payload.queries, qna.collection_profile(cid))
+    else:
+        vectors = payload.vectors
+
+    filters = payload.filters if payload.filters is not None else payload.sources
+    try:
+        results = qna.search_batch_in_collection(
+            cid, vectors, top_k=payload.top_k, filters=filters, texts=payload.queries,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "ok": True,
+        "collectionId": cid,
+        "results": [
+            {
+                "query": payload.queries[i] if payload.queries is not None else None,
+                "hits": hits,
+            }
+            for i, hits in enumerate(results)
+        ],
+        "embedding_cost": round(emb_cost, 6),
+        "cost_usd": round(emb_cost, 6),
+    }
@@ -0,0 +1,159 @@
+# services/embed_cache.py
+# ---------------------------------------------
+# 段落 embedding 的持久化快取（content-addressed）：
+# - key = sha256(model, dimensions, 正規化後的文字)，跟上傳到哪個 collection 無關
+#   → 同一份 PDF 重新上傳、傳到另一個 collection、mode=overwrite、同一個網址再摘要一次，
+#     都不用再呼叫 embeddings API
+# - 存在一個 SQLite 檔（data/embed_cache.sqlite），向量以 float32 bytes 存放（不用 JSON，省空間也快）
+# - 有大小上限（EMBED_CACHE_MB）：超過時依「最後使用時間」淘汰最久沒用到的
+#   刪掉的頁面 SQLite 會重複利用，檔案大小大致維持在上限附近
+# ---------------------------------------------
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+import numpy as np
+
+# 快取檔位置與大小上限（MB，可由 .env 覆蓋；0 代表關閉快取）
+CACHE_PATH = Path(os.getenv("EMBED_CACHE_PATH", "data/embed_cache.sqlite"))
+CACHE_MB = float(os.getenv("EMBED_CACHE_MB", "512"))
+
+# 超過上限時一次淘汰到上限的這個比例，避免每次寫入都在淘汰
+_EVICT_TO = 0.9
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key       BLOB PRIMARY KEY,
+    dim       INTEGER NOT NULL,
+    vec       BLOB NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+_INDEX = "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+
+_lock = threading.Lock()
+_conn: sqlite3.Connection | None = None
+_bytes = 0          # 目前快取內向量的總大小（bytes）
+_stats = {"hits": 0, "misses": 0, "evicted": 0}
+
+
+def _normalize(text: str) -> str:
+    """正規化文字：Unicode NFC、連續空白（含換行）合成一個空白、去頭尾空白。"""
+    return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+
+def cache_key(text: str, model: str, dimensions: int | None) -> bytes:
+    """快取 key：同一個模型 + 維度 + 正規化後相同的文字 → 同一個 key。"""
+    h = hashlib.sha256()
+    h.update(f"{model}\0{dimensions or 0}\0".encode("utf-8"))
+    h.update(_normalize(text).encode("utf-8"))
+    return h.digest()
+
+
+def _db() -> sqlite3.Connection | None:
+    """第一次用到時才開啟快取檔（呼叫端持有 _lock）。"""
+    global _conn, _bytes
+    if CACHE_MB <= 0:
+        return None
+    if _conn is None:
+        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(CACHE_PATH), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(_SCHEMA)
+        conn.execute(_INDEX)
+        _bytes = conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()[0]
+        _conn = conn
+    return _conn
+
+
+def get_many(keys: list[bytes]) -> dict[bytes, list[float]]:
+    """一次查多個 key，回傳 {key: 向量}（沒命中的不在結果裡），命中的順便更新最後使用時間。"""
+    if not keys:
+        return {}
+    uniq = list(dict.fromkeys(keys))
+    found: dict[bytes, list[float]] = {}
+    with _lock:
+        conn = _db()
+        if conn is None:
+            return {}
+        # SQLite 單一查詢的參數數量有上限，分批查
+        for i in range(0, len(uniq), 500):
+            part = uniq[i:i + 500]
+            marks = ",".join("?" * len(part))
+            for key, vec in conn.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", part):
+                found[bytes(key)] = np.frombuffer(vec, dtype="<f4").tolist()
+        if found:
+            now = time.time()
+            with conn:
+                conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+        _stats["hits"] += len(found)
+        _stats["misses"] += len(uniq) - len(found)
+    return found
+
+
+def put_many(items: dict[bytes, list[float]]):
+    """寫入多筆 {key: 向量}，超過大小上限時淘汰最久沒用到的。"""
+    global _bytes
+    if not items:
+        return
+    with _lock:
+        conn = _db()
+        if conn is None:
+            return
+        now = time.time()
+        rows = []
+        for key, vec in items.items():
+            arr = np.asarray(vec, dtype="<f4")
+            rows.append((key, int(arr.shape[0]), arr.tobytes(), now))
+        with conn:
+            # 已存在的 key（例如併發的兩次上傳）先扣掉舊的大小再覆蓋
+            for i in range(0, len(rows), 500):
+                part = [r[0] for r in rows[i:i + 500]]
+                marks = ",".join("?" * len(part))
+                _bytes -= conn.execute(
+                    f"SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings WHERE key IN ({marks})", part
+                ).fetchone()[0]
+            conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            _bytes += sum(len(r[2]) for r in rows)
+            _evict_locked(conn)
+
+
+def _evict_locked(conn: sqlite3.Connection):
+    """超過上限 → 依最後使用時間由舊到新刪除，直到降到上限的 _EVICT_TO（呼叫端持有 _lock 且在 transaction 內）。"""
+    global _bytes
+    budget = CACHE_MB * 1024 * 1024
+    if _bytes <= budget:
+        return
+    target = budget * _EVICT_TO
+    victims = []
+    cur = conn.execute("SELECT key, LENGTH(vec) FROM embeddings ORDER BY last_used")
+    for key, size in cur:
+        if _bytes <= target:
+            break
+        victims.append((key,))
+        _bytes -= size
+    cur.close()
+    conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+    _stats["evicted"] += len(victims)
+
+
+def stats() -> dict:
+    """快取統計：筆數、大小、上限、命中 / 未命中 / 淘汰次數（自程式啟動後）。"""
+    with _lock:
+        conn = _db()
+        entries = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] if conn is not None else 0
+        return {
+            "enabled": conn is not None,
+            "entries": entries,
+            "bytes": _bytes,
+            "budget_bytes": int(CACHE_MB * 1024 * 1024),
+            **_stats,
+        }
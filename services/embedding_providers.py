@@ -0,0 +1,126 @@
+# services/embedding_providers.py
+# ---------------------------------------------
+# Embedding 提供者（provider）介面：
+# - qna 所有的 embedding（上傳段落、/ask 查詢、批次檢索、重新向量化）都經過
+#   provider.embed(texts, model, dimensions) 這一個入口
+# - 依 collection 記錄的模型名稱決定用哪個 provider：
+#     local-* → 本機的 HashedNgramProvider（不連網、不花錢、結果固定）
+#     其他    → OpenAI（實作在 qna，含重試與限流處理）
+# - 本機 provider 給離線開發、CI、效能測試用：向量品質比不上真的模型，
+#   但相同文字永遠得到相同向量、字面相近的段落向量也相近，檢索流程可以完整跑一遍
+# ---------------------------------------------
+
+from __future__ import annotations
+
+import os
+import unicodedata
+from abc import ABC, abstractmethod
+from typing import Dict, Tuple
+
+import numpy as np
+
+# 本機 provider 的模型名稱（記錄在 collection 的 embedding 設定裡）與預設維度
+LOCAL_MODEL = "local-hash-ngram"
+LOCAL_DIMENSIONS = int(os.getenv("LOCAL_EMBED_DIMENSIONS", "1024"))
+
+# 取哪幾種長度的字元 n-gram（1-gram 讓單一中文字也有訊號，2/3-gram 保留詞序）
+_NGRAM_SIZES = (1, 2, 3)
+
+# 64-bit 雜湊用的常數（FNV-1a 乘數、黃金比例、splitmix64 的混合常數）
+_FNV_PRIME = np.uint64(0x100000001B3)
+_GOLDEN = 0x9E3779B97F4A7C15
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+class EmbeddingProvider(ABC):
+    """Embedding 提供者的共同介面（沒實作 embed 的子類別無法建立，註冊前就會報錯）。"""
+
+    name = "base"
+
+    @abstractmethod
+    def embed(self, texts: list[str], model: str, dimensions: int | None) -> Tuple[list[list[float]], int]:
+        """把一批文字轉成向量，回傳 (向量列表, 計費的 token 數)；向量順序與 texts 相同。"""
+
+    def price_per_token(self, model: str) -> float:
+        """每個 token 的單價（USD）；不收費的 provider 回傳 0。"""
+        return 0.0
+
+    def default_dimensions(self, model: str) -> int | None:
+        """沒指定 dimensions 時實際產生的維度；None 代表由模型決定（要呼叫過才知道）。"""
+        return None
+
+
+class HashedNgramProvider(EmbeddingProvider):
+    """
+    本機 embedding：把文字的字元 n-gram 雜湊到固定維度（feature hashing），再做 L2 正規化。
+    - 只用 numpy 的整數運算，不依賴 Python 的 hash()（每次啟動會隨機化），跨機器、跨次執行結果都一樣
+    - 每個 n-gram 依雜湊值決定落在哪一維、是 +1 還是 -1，碰撞的影響會互相抵銷
+    - 計數取 log 壓縮，避免長段落裡重複的字主導整個向量
+    """
+
+    name = "local"
+
+    def default_dimensions(self, model: str) -> int | None:
+        return LOCAL_DIMENSIONS
+
+    def embed(self, texts: list[str], model: str, dimensions: int | None) -> Tuple[list[list[float]], int]:
+        dim = int(dimensions or LOCAL_DIMENSIONS)
+        out = np.zeros((len(texts), dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            out[i] = self._vector(text, dim)
+        # 不收費，token 數回報 0（用量統計不會把本機 embedding 算成花費）
+        return out.tolist(), 0
+
+    @staticmethod
+    def _vector(text: str, dim: int) -> np.ndarray:
+        s = " ".join(unicodedata.normalize("NFKC", text or "").lower().split())
+        codes = np.frombuffer(s.encode("utf-32-le"), dtype="<u4").astype(np.uint64)
+        vec = np.zeros(dim, dtype=np.float64)
+        for n in _NGRAM_SIZES:
+            m = len(codes) - n + 1
+            if m <= 0:
+                continue
+            # 每個位置的 n-gram 雜湊（向量化，一次算完整段）
+            h = np.full(m, (_GOLDEN * n) & 0xFFFFFFFFFFFFFFFF, dtype=np.uint64)
+            for j in range(n):
+                h = (h ^ codes[j:j + m]) * _FNV_PRIME
+            h ^= h >> np.uint64(30)
+            h *= _MIX1
+            h ^= h >> np.uint64(27)
+            h *= _MIX2
+            h ^= h >> np.uint64(31)
+            idx = (h % np.uint64(dim)).astype(np.int64)
+            sign = np.where((h >> np.uint64(63)) == 0, 1.0, -1.0)
+            vec += np.bincount(idx, weights=sign, minlength=dim)
+        vec = np.sign(vec) * np.log1p(np.abs(vec))
+        norm = np.linalg.norm(vec)
+        if norm > 0:
+            vec /= norm
+        return vec.astype(np.float32)
+
+
+_PROVIDERS: Dict[str, EmbeddingProvider] = {"local": HashedNgramProvider()}
+
+
+def register(name: str, provider: EmbeddingProvider):
+    """註冊（或替換）一個 provider，例如 qna 在載入時註冊 OpenAI、測試時換成假的。"""
+    if not isinstance(provider, EmbeddingProvider):
+        raise TypeError(f"embedding provider 必須繼承 EmbeddingProvider：{type(provider).__name__}")
+    _PROVIDERS[name] = provider
+
+
+def get(name: str) -> EmbeddingProvider:
+    try:
+        return _PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"未知的 embedding provider：{name}")
+
+
+def provider_name_for(model: str | None) -> str:
+    """依模型名稱決定 provider：local-* 用本機，其他都走 OpenAI。"""
+    return "local" if str(model or "").startswith("local-") else "openai"
+
+
+def for_model(model: str | None) -> EmbeddingProvider:
+    return get(provider_name_for(model))
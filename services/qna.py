@@ -7,14 +7,36 @@
 # 5. 合併影音轉錄成本（Whisper）到問答結果中
 
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Dict
+import openai
 from openai import OpenAI                  # OpenAI 官方 Python SDK
 from services import vector_store          # 你自己的向量庫封裝（FAISS 或其他）
+from services import embed_cache           # 段落 embedding 的持久化快取
+from services import embedding_providers   # embedding 提供者（OpenAI / 本機）
+from services.singleflight import SingleFlight  # 同時進行中的相同問題只算一次
+import copy
 import json
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
+import math
 import re
 from typing import Optional, List, Dict, Any
 
+import numpy as np
+
+# token 計算（可選）：沒裝 tiktoken 就退回保守的估算
+try:
+    import tiktoken  # type: ignore
+    _HAS_TIKTOKEN = True
+except Exception:
+    _HAS_TIKTOKEN = False
+
 
 # === transcribe cost merge ===
 # 這一段是「從成本檔案中讀出 / 更新 影音轉錄（Whisper）費用」的工具。
@@ -30,7 +52,9 @@ def search_similar_in_collection(
     collection_id: str,
     query_vec: list[float],
     top_k: int = 5,
-    sources: list[str] | None = None
+    sources: list[str] | None = None,
+    query_text: str | None = None,
+    with_vectors: bool = False,
 ):
     """
     從指定 collection 檢索相似段落（封裝呼叫 vector_store.search）
@@ -39,9 +63,30 @@ def search_similar_in_collection(
     :param query_vec: 查詢向量（由 query 做 embedding 的結果）
     :param top_k: 取前幾名相似段落
     :param sources: 如果有指定來源檔名，就只從這些來源中搜尋
+    :param query_text: 問題原文；有給就同時做關鍵字檢索（藥名、代碼等），與向量結果合併排序
+    :param with_vectors: 結果另外帶列號 row 與段落向量 vector（組上下文時去重、合併相鄰段落用）
     :return: 一個段落列表，每個元素通常包含 text/page/source/score 等欄位
     """
-    return vector_store.search(collection_id, query_vec, top_k=top_k, sources=sources)
+    return vector_store.search(
+        collection_id, query_vec, top_k=top_k, sources=sources, query_text=query_text, with_vectors=with_vectors,
+    )
+
+
+def search_batch_in_collection(
+    collection_id: str,
+    query_vecs: list[list[float]],
+    top_k: int = 5,
+    filters: list | None = None,
+    texts: list[str] | None = None,
+):
+    """
+    一次檢索多個查詢向量（封裝呼叫 vector_store.search_batch）。
+
+    :param filters: None、共用的 sources 列表，或每個查詢各自的 sources 列表
+    :param texts: 每個查詢的原文（可選，有給就同時做關鍵字檢索）
+    :return: 與 query_vecs 等長的列表，每項格式同 search_similar_in_collection
+    """
+    return vector_store.search_batch(collection_id, query_vecs, top_k=top_k, filters=filters, texts=texts)
 
 
 def _load_costs():
@@ -102,7 +147,37 @@ client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # 模型名稱設定
 EMBED_MODEL = "text-embedding-3-large"   # 嵌入模型（用於向量化段落與 query）
+# 新 collection 的預設 embedding 維度（text-embedding-3 可縮短成 256 / 512 / 1024…；0 代表原生 3072）
+EMBED_DIMENSIONS = int(os.getenv("EMBED_DIMENSIONS", "0"))
 CHAT_MODEL = "gpt-4o"                    # 問答模型（用於生成答案）
+# 新 collection 與查詢預設用哪個 embedding provider：
+#   openai：EMBED_MODEL（預設）
+#   local：本機的雜湊 n-gram 向量（離線開發 / 效能測試用，不連網、不收費）
+# 已建立的 collection 依自己記錄的模型決定，切換這個設定不會把新舊向量混在一起
+EMBED_PROVIDER = os.getenv("EMBED_PROVIDER", "openai").lower()
+
+# --- Embedding 併發與重試（可由 .env 覆蓋）---
+# - EMBED_CONCURRENCY：同時最多幾批在送 embeddings API（全程式共用，多個上傳一起排隊）
+# - EMBED_MAX_RETRIES：遇到 429 / 5xx / 連線錯誤時最多重試幾次
+# - EMBED_BACKOFF_BASE / EMBED_BACKOFF_MAX：指數退避的起始與最長等待秒數（有 Retry-After 就照它）
+EMBED_CONCURRENCY = max(1, int(os.getenv("EMBED_CONCURRENCY", "4")))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", "1.0"))
+EMBED_BACKOFF_MAX = float(os.getenv("EMBED_BACKOFF_MAX", "60"))
+
+# --- Embedding 批次上限（OpenAI 的限制，可由 .env 覆蓋）---
+# - EMBED_MAX_INPUT_TOKENS：單一段落最多幾個 token（text-embedding-3 為 8191），超過的切開或截斷
+# - EMBED_BATCH_TOKENS：單次請求所有段落的 token 總數上限
+# - EMBED_BATCH_INPUTS：單次請求最多幾筆
+# - EMBED_OVERSIZE：段落超過單筆上限時的處理方式
+#     split：切成多段各自 embedding，再依 token 數加權平均（預設，不丟內容）
+#     truncate：只取前 EMBED_MAX_INPUT_TOKENS 個 token
+EMBED_MAX_INPUT_TOKENS = int(os.getenv("EMBED_MAX_INPUT_TOKENS", "8191"))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "300000"))
+EMBED_BATCH_INPUTS = int(os.getenv("EMBED_BATCH_INPUTS", "2048"))
+EMBED_OVERSIZE = os.getenv("EMBED_OVERSIZE", "split").lower()
+# 批次平均分給各執行緒時，每批至少這麼多 token（太小的批次只是多了來回）
+_EMBED_MIN_BATCH_TOKENS = 8000
 
 # --- Pricing (USD) 可由 .env 覆蓋 ---
 # .env 範例：
@@ -151,91 +226,932 @@ def _tokens(u) -> Tuple[int, int, int]:
 
 def _has_collection_data(cid: str) -> bool:
     """
-    檢查指定 collection 是否有可用資料：
-    - 有 index 且 index.ntotal > 0
-    - 有對應的 meta（段落資訊）
+    檢查指定 collection 是否有可用資料（向量數 > 0）。
 
+    用 vector_store.count 只讀檔頭，不會為了這個檢查把整個 collection 載入記憶體。
     若沒有資料，代表就算你指定了 collection_id，也無法做檢索。
     """
     try:
-        obj = vector_store.ensure_collection(cid)
-        return (
-            obj.get("index") is not None
-            and obj["index"].ntotal > 0
-            and len(obj.get("meta", [])) > 0
-        )
+        return vector_store.count(cid) > 0
     except Exception:
         # 如果任何錯誤，視為「沒有資料」
         return False
 
 
-def embed_paragraphs(paragraph_texts: list[str]) -> list[list[float]]:
+# ==========================
+# Embedding 設定（每個 collection 各自記錄 model + dimensions）
+# ==========================
+def _resolve_profile(model: str, dimensions: Optional[int]) -> Dict:
+    """
+    沒指定 dimensions 時，換成 provider 實際會產生的維度（例如本機 provider 的 LOCAL_EMBED_DIMENSIONS）；
+    collection 記錄與 embedding 快取的 key 都用這個值，之後改了環境變數也不會混用到不同維度的向量。
+    """
+    if not dimensions:
+        dimensions = embedding_providers.for_model(model).default_dimensions(model)
+    return {"model": model, "dimensions": int(dimensions) if dimensions else None}
+
+
+def default_embedding_profile() -> Dict:
+    """新 collection 使用的 embedding 設定（EMBED_DIMENSIONS=0 代表 provider 的預設維度）。"""
+    model = embedding_providers.LOCAL_MODEL if EMBED_PROVIDER == "local" else EMBED_MODEL
+    return _resolve_profile(model, EMBED_DIMENSIONS)
+
+
+def collection_profile(collection_id: Optional[str]) -> Dict:
+    """
+    取得 collection 的 embedding 設定：
+    - config.json 有記錄 → 直接用
+    - 舊 collection 沒記錄但已有資料 → 當初是用預設模型、以目前的維度建立
+    - 全新的 collection → 用目前的預設設定
+    """
+    if not collection_id:
+        return default_embedding_profile()
+    profile = vector_store.embedding_profile(collection_id)
+    if profile:
+        # 舊記錄可能沒寫維度（本機 provider），補成實際維度，快取 key 才會跟新記錄一致
+        return _resolve_profile(profile["model"], profile.get("dimensions"))
+    if vector_store.count(collection_id) > 0:
+        return {"model": EMBED_MODEL, "dimensions": vector_store.ensure_collection(collection_id)["dim"]}
+    return default_embedding_profile()
+
+
+def _embed_price(profile: Optional[Dict]) -> float:
+    """embedding 每 token 單價（由 provider 決定；本機 provider 不收費）。"""
+    model = (profile or {}).get("model") or EMBED_MODEL
+    return embedding_providers.for_model(model).price_per_token(model)
+
+
+# 所有 embedding 批次共用的執行緒池：限制同時在送的批次數
+_EMBED_POOL = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="embed")
+
+# 被限流（429）時，所有批次都先暫停到這個時間點再送，不要一起繼續撞限流
+_RATE_LIMIT_LOCK = threading.Lock()
+_rate_limited_until = 0.0
+
+
+def _retry_delay(err: Exception, attempt: int) -> Optional[float]:
+    """
+    判斷錯誤是否值得重試，回傳要等幾秒（None 代表不重試）。
+    - 429、5xx、連線逾時 / 中斷 → 重試
+    - 其他 4xx（參數錯、金鑰錯）→ 直接拋出
+    """
+    if isinstance(err, openai.APIStatusError):
+        if err.status_code != 429 and err.status_code < 500:
+            return None
+        # 伺服器有告訴我們要等多久就照它
+        try:
+            retry_after = float(err.response.headers.get("retry-after") or 0)
+        except (TypeError, ValueError):
+            retry_after = 0.0
+        if retry_after > 0:
+            return min(retry_after, EMBED_BACKOFF_MAX)
+    elif not isinstance(err, openai.APIConnectionError):
+        return None
+    # 指數退避 + 隨機抖動，避免所有批次同時重送
+    return min(EMBED_BACKOFF_BASE * (2 ** attempt), EMBED_BACKOFF_MAX) * (0.5 + random.random() / 2)
+
+
+class _OpenAIEmbeddings(embedding_providers.EmbeddingProvider):
+    """OpenAI embeddings API：遇到 429 / 5xx / 連線錯誤會以指數退避重試，被限流時其他批次也會一起暫停。"""
+
+    name = "openai"
+
+    def embed(self, texts: list[str], model: str, dimensions: Optional[int]) -> Tuple[list[list[float]], int]:
+        global _rate_limited_until
+        kwargs = {}
+        if dimensions and str(model).startswith("text-embedding-3"):
+            # 只有 text-embedding-3 系列支援縮短維度
+            kwargs["dimensions"] = int(dimensions)
+
+        # 重試由這裡統一處理（SDK 內建的重試關掉，避免兩層疊加）
+        api = client.with_options(max_retries=0)
+        attempt = 0
+        while True:
+            wait = _rate_limited_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                resp = api.embeddings.create(model=model, input=texts, **kwargs)
+                return [d.embedding for d in resp.data], _tokens(getattr(resp, "usage", None))[2]
+            except Exception as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None or attempt >= EMBED_MAX_RETRIES:
+                    raise
+                attempt += 1
+                print(f"[qna] embeddings 失敗（{type(e).__name__}），{delay:.1f} 秒後第 {attempt} 次重試")
+                if isinstance(e, openai.RateLimitError):
+                    with _RATE_LIMIT_LOCK:
+                        _rate_limited_until = max(_rate_limited_until, time.time() + delay)
+                else:
+                    time.sleep(delay)
+
+    def price_per_token(self, model: str) -> float:
+        # 沒有列在 PRICES 的模型就用預設模型的價格估
+        return PRICES.get(model, PRICES[EMBED_MODEL])["in"]
+
+
+embedding_providers.register("openai", _OpenAIEmbeddings())
+
+
+def _embed_request(texts: list[str], profile: Optional[Dict] = None) -> Tuple[list[list[float]], int]:
+    """送一次 embedding（依 profile 的 model 選 provider、決定 dimensions），回傳 (向量列表, token 數)。"""
+    profile = profile or default_embedding_profile()
+    provider = embedding_providers.for_model(profile["model"])
+    return provider.embed(texts, profile["model"], profile.get("dimensions"))
+
+
+def _embed_paragraph_batches(
+    paragraph_texts: list[str], profile: Optional[Dict] = None
+) -> Tuple[list[list[float]], int]:
+    """
+    embed_paragraphs 的本體，另外回傳總 token 數（重新向量化時用來計算成本）。
+    先查 embedding 快取，只有沒命中的段落（同一批內重複的只算一次）才送 API；
+    token 數只算實際送出的部分。
+    """
+    profile = profile or default_embedding_profile()
+    keys = [embed_cache.cache_key(t, profile["model"], profile.get("dimensions")) for t in paragraph_texts]
+    cached = embed_cache.get_many(keys)
+
+    misses: dict[bytes, str] = {}
+    for key, txt in zip(keys, paragraph_texts):
+        if key not in cached:
+            misses.setdefault(key, txt)
+
+    fresh, total_tokens = _embed_text_batches(list(misses.values()), profile)
+    new_items = dict(zip(misses.keys(), fresh))
+    embed_cache.put_many(new_items)
+
+    cached.update(new_items)
+    return [cached[k] for k in keys], total_tokens
+
+
+@lru_cache(maxsize=8)
+def _encoder(model: str):
+    """取得模型的 tokenizer（建立很慢，每個模型只建一次）；沒裝 tiktoken 回傳 None。"""
+    if not _HAS_TIKTOKEN:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # 不認得的模型名稱：OpenAI 的 embedding 模型都用 cl100k_base
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # 第一次使用要下載詞表，離線環境會失敗 → 退回估算
+        print(f"[qna] 無法載入 tokenizer（{e}），改用估算的 token 數")
+        return None
+
+
+def _is_wide(ch: str) -> bool:
+    """中日韓文字（含全形標點）：tokenizer 常常一個字就一個以上的 token。"""
+    return "\u3000" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af" or "\uf900" <= ch <= "\uffef"
+
+
+def _estimate_tokens(text: str) -> int:
+    """沒有 tokenizer 時的保守估算：中日韓文字一字算 2 個 token，其他每 3 個字元 1 個 token。"""
+    wide = sum(1 for ch in text if _is_wide(ch))
+    return wide * 2 + math.ceil((len(text) - wide) / 3)
+
+
+def _ends_on_char(tail: bytes) -> bool:
+    """tail（片段最後最多 4 個 byte）是否剛好結束在完整的 UTF-8 字元上。"""
+    for back in range(1, min(4, len(tail)) + 1):
+        lead = tail[-back]
+        if lead & 0xC0 != 0x80:
+            # 最後一個字元的開頭：依開頭 byte 算出這個字元應該有幾個 byte
+            need = 1 if lead < 0x80 else 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+            return back == need
+    return False
+
+
+def _clean_cut(enc, ids: list[int], start: int, end: int) -> int:
+    """
+    把 token 切點 end 往前移到完整字元的邊界：中文字常被拆成好幾個 byte 層級的 token
+    （有的 token 甚至橫跨兩個字），直接在中間切開，兩邊 decode 出來都會多出 U+FFFD。
+    只看切點前面最後幾個 byte 能不能組成完整字元，不用整段重新 decode。
+    """
+    cut = end
+    while start + 1 < cut < len(ids):
+        tail, j = b"", cut
+        while j > start and len(tail) < 4:
+            j -= 1
+            tail = enc.decode_single_token_bytes(ids[j]) + tail
+        if _ends_on_char(tail[-4:]):
+            return cut
+        cut -= 1
+    # 找不到乾淨的切點（上限小到裝不下一個字）就照原本的位置切
+    return cut if cut == len(ids) else end
+
+
+def _split_for_embedding(text: str, model: str) -> list[Tuple[str, int]]:
+    """
+    把一段文字依單筆上限切開，回傳 [(片段, token 數)]；沒超過上限就是只有一段。
+    EMBED_OVERSIZE=truncate 時只保留第一段。
+    """
+    enc = _encoder(model)
+    limit = EMBED_MAX_INPUT_TOKENS
+    if enc is not None:
+        ids = enc.encode_ordinary(text)
+        if len(ids) <= limit:
+            return [(text, len(ids))]
+        pieces, start = [], 0
+        while start < len(ids):
+            end = _clean_cut(enc, ids, start, min(start + limit, len(ids)))
+            pieces.append((enc.decode(ids[start:end]), end - start))
+            start = end
+    else:
+        n = _estimate_tokens(text)
+        if n <= limit:
+            return [(text, n)]
+        # 逐字累加估算值，快超過上限就切一段
+        pieces, start, cost = [], 0, 0.0
+        for i, ch in enumerate(text):
+            c = 2.0 if _is_wide(ch) else 1 / 3
+            if cost + c > limit - 1:
+                pieces.append(text[start:i])
+                start, cost = i, 0.0
+            cost += c
+        pieces.append(text[start:])
+        pieces = [(p, _estimate_tokens(p)) for p in pieces]
+    return pieces[:1] if EMBED_OVERSIZE == "truncate" else pieces
+
+
+def _pack_batches(sizes: list[int], concurrency: int) -> list[Tuple[int, int]]:
+    """
+    依序把各片段裝成批次，回傳 [(起, 迄)]：
+    - 每批 token 總數 ≤ EMBED_BATCH_TOKENS、筆數 ≤ EMBED_BATCH_INPUTS
+    - 量大時平均分成至少 concurrency 批（每批至少 _EMBED_MIN_BATCH_TOKENS），讓各執行緒都有事做
+    """
+    total = sum(sizes)
+    target = min(EMBED_BATCH_TOKENS, max(_EMBED_MIN_BATCH_TOKENS, math.ceil(total / max(1, concurrency))))
+    batches = []
+    start, tokens = 0, 0
+    for i, n in enumerate(sizes):
+        if i > start and (tokens + n > target or i - start >= EMBED_BATCH_INPUTS):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += n
+    if start < len(sizes):
+        batches.append((start, len(sizes)))
+    return batches
+
+
+def _embed_text_batches(texts: list[str], profile: Optional[Dict] = None) -> Tuple[list[list[float]], int]:
+    """
+    把 texts 切成批次送 embeddings API（不查快取），回傳 (向量列表, 總 token 數)。
+    - 用模型的 tokenizer 算出每段的 token 數，依單次請求的 token / 筆數上限裝批
+    - 超過單筆上限的段落切成多段（或截斷），切開的各段向量依 token 數加權平均後再正規化
+    - 批次丟進共用的執行緒池同時送（最多 EMBED_CONCURRENCY 批），結果依原順序接回
+    """
+    profile = profile or default_embedding_profile()
+    pieces: list[str] = []
+    sizes: list[int] = []
+    owner: list[int] = []      # 每個片段屬於第幾段
+    for i, txt in enumerate(texts):
+        for piece, n in _split_for_embedding(txt, profile["model"]):
+            pieces.append(piece)
+            sizes.append(n)
+            owner.append(i)
+    if not pieces:
+        return [], 0
+
+    batches = _pack_batches(sizes, EMBED_CONCURRENCY)
+    if len(batches) == 1:
+        piece_vecs, total_tokens = _embed_request(pieces, profile)
+    else:
+        futures = [_EMBED_POOL.submit(_embed_request, pieces[a:b], profile) for a, b in batches]
+        piece_vecs = []
+        total_tokens = 0
+        try:
+            for fut in futures:
+                vecs, tt = fut.result()
+                piece_vecs.extend(vecs)
+                total_tokens += tt
+        except Exception:
+            # 有一批重試後仍失敗 → 還沒開始的批次就不用送了
+            for fut in futures:
+                fut.cancel()
+            raise
+
+    if len(pieces) == len(texts):
+        return piece_vecs, total_tokens
+
+    # 有段落被切開 → 把同一段的片段向量合併回來
+    vectors: list[list[float]] = []
+    j = 0
+    for i in range(len(texts)):
+        k = j
+        while k < len(pieces) and owner[k] == i:
+            k += 1
+        if k - j == 1:
+            vectors.append(piece_vecs[j])
+        else:
+            v = np.average(np.asarray(piece_vecs[j:k], dtype="float32"), axis=0, weights=sizes[j:k])
+            v /= max(float(np.linalg.norm(v)), 1e-12)
+            vectors.append(v.tolist())
+        j = k
+    return vectors, total_tokens
+
+
+def embed_paragraphs(paragraph_texts: list[str], profile: Optional[Dict] = None) -> list[list[float]]:
     """
     對一堆段落文字做 embedding，回傳每段對應的向量（list[float]）。
 
-    - 會做簡單批次切分，避免一次送太多 token 給 embeddings API：
-      - 粗估 token：len(text) // 3.5
-      - 若目前批次 token 超過 ~7000 就先送出一批
+    - profile：collection 的 embedding 設定（見 collection_profile），None 代表預設設定
+    - 同樣的文字（同 model + dimensions）算過就會記在 embedding 快取，不會再呼叫 API
+    - 依 tokenizer 算出的 token 數裝批，不超過單次請求的 token / 筆數上限；
+      超過單筆上限的段落會切開（或截斷，見 EMBED_OVERSIZE），不會整批失敗
+    - 各批次同時送出（最多 EMBED_CONCURRENCY 批），遇到 429 / 5xx 自動退避重試，結果維持原順序
+    """
+    return _embed_paragraph_batches(paragraph_texts, profile)[0]
+
+
+def embed_queries(queries: list[str], profile: Optional[Dict] = None) -> Tuple[list[list[float]], float]:
+    """
+    對多個查詢做 embedding（批次檢索用），回傳 (向量列表, embedding 成本)。
+
+    - 查詢通常很短，每次 API 呼叫最多送 EMBED_BATCH_INPUTS 筆（OpenAI 單次上限 2048）
     """
-    all_vectors: list[list[float]] = []
-    batch: list[str] = []
-    batch_tokens = 0
+    vectors: list[list[float]] = []
+    total_tokens = 0
+    for i in range(0, len(queries), EMBED_BATCH_INPUTS):
+        vecs, tt = _embed_request(queries[i:i + EMBED_BATCH_INPUTS], profile)
+        vectors.extend(vecs)
+        total_tokens += tt
+    return vectors, total_tokens * _embed_price(profile)
 
-    for txt in paragraph_texts:
-        # 粗估這段文字的 token 數
-        t = len(txt) // 3.5
 
-        # 若再加這段會超過 ~7000，就先把目前批次送去 embeddings
-        if batch_tokens + t > 7000:
-            resp = client.embeddings.create(model=EMBED_MODEL, input=batch)
-            all_vectors.extend([d.embedding for d in resp.data])
-            batch, batch_tokens = [], 0
+# ==========================
+# 查詢 embedding 快取（/ask 的問題常常一模一樣，例如「劑量？」「副作用？」）
+# ==========================
+# - 記憶體 LRU：key = (model, dimensions, 正規化後的問題)，最多 QUERY_CACHE_SIZE 筆（0 代表關閉）
+# - QUERY_CACHE_DISK=1 時另外查 / 寫 embed_cache 的磁碟快取（多個 worker 行程共用，重啟也還在）
+# 命中時完全不呼叫 embeddings API，也不計 embedding 費用。
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_CACHE_DISK = os.getenv("QUERY_CACHE_DISK", "0") == "1"
 
-        batch.append(txt)
-        batch_tokens += t
+# 快取沒命中的問題，在 QUERY_BATCH_WINDOW_MS 毫秒內到達的會合成一次 embeddings 請求
+# （最多 QUERY_BATCH_MAX 筆；WINDOW 設 0 代表不合併，每個問題各自呼叫）
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "5"))
+QUERY_BATCH_MAX = max(1, int(os.getenv("QUERY_BATCH_MAX", "64")))
 
-    # 把最後一批補上
-    if batch:
-        resp = client.embeddings.create(model=EMBED_MODEL, input=batch)
-        all_vectors.extend([d.embedding for d in resp.data])
+_QUERY_CACHE: "OrderedDict[bytes, list[float]]" = OrderedDict()
+_QUERY_CACHE_LOCK = threading.Lock()
 
-    return all_vectors
 
+class _QueryBatch:
+    """一批等待合併送出的問題（同一組 model + dimensions）。"""
 
-def _answer_general(query: str) -> Tuple[str, Dict]:
+    def __init__(self, profile: Dict):
+        self.profile = profile
+        self.texts: list[str] = []
+        self.closed = False                 # 已經收滿或開始送出，不再接新的問題
+        self.full = threading.Event()       # 收滿 QUERY_BATCH_MAX 筆 → 不用等到時間窗結束
+        self.done = threading.Event()
+        self.vectors: list[list[float]] = []
+        self.tokens: list[int] = []
+        self.error: Optional[Exception] = None
+
+
+class _QueryBatcher:
+    """
+    跨請求合併查詢 embedding：
+    - 第一個到達的問題負責送出（leader），先等 window 秒（或收滿 max_batch 筆），
+      期間到達的問題都加進同一批，只呼叫一次 embeddings API
+    - 其他問題等這批送完，各自取回自己的向量
+    - token 數依各問題自己的 token 數分攤（沒有 tokenizer 時依字數比例）
     """
-    一般知識回答（不依賴文件 / 向量庫），並計算聊天成本。
 
-    適用情境：
-    - 使用者只問一般問題，沒有指定文件或 collection。
-    - 或者文件模式信心不足時（auto 模式本來預計這樣用，但目前 auto 的 fallback 被註解掉）。
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._open: dict[tuple, _QueryBatch] = {}
+
+    def embed(self, text: str, profile: Dict) -> Tuple[list[float], int]:
+        """取得單一問題的向量，回傳 (向量, 分攤到的 token 數)。"""
+        if self.window <= 0 or self.max_batch <= 1:
+            vecs, tokens = _embed_request([text], profile)
+            return vecs[0], tokens
+
+        key = (profile["model"], profile.get("dimensions"))
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _QueryBatch(profile)
+            i = len(batch.texts)
+            batch.texts.append(text)
+            if len(batch.texts) >= self.max_batch:
+                self._close(key, batch)
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                self._close(key, batch)
+            self._send(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.vectors[i], batch.tokens[i]
+
+    def _close(self, key: tuple, batch: _QueryBatch):
+        """這批不再收新的問題（呼叫端持有 _lock）。"""
+        batch.closed = True
+        if self._open.get(key) is batch:
+            del self._open[key]
+
+    def _send(self, batch: _QueryBatch):
+        try:
+            batch.vectors, total = _embed_request(batch.texts, batch.profile)
+            batch.tokens = _share_tokens(batch.texts, total, batch.profile["model"])
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+
+def _share_tokens(texts: list[str], total: int, model: str) -> list[int]:
+    """把一次請求的 token 總數分攤回各筆（有 tokenizer 就用各自的 token 數，否則依字數比例）。"""
+    if len(texts) == 1:
+        return [total]
+    enc = _encoder(model)
+    weights = [len(enc.encode_ordinary(t)) if enc is not None else len(t) for t in texts]
+    s = sum(weights) or 1
+    shares = [total * w // s for w in weights]
+    # 整數除法的餘數補給第一筆，總和維持不變
+    shares[0] += total - sum(shares)
+    return shares
+
+
+_QUERY_BATCHER = _QueryBatcher(QUERY_BATCH_WINDOW_MS, QUERY_BATCH_MAX)
+
+
+def _normalize_query(query: str) -> str:
+    """問題正規化：全形轉半形（？→ ?）、連續空白合成一個、去頭尾空白。"""
+    return " ".join(unicodedata.normalize("NFKC", query or "").split())
+
+
+def _embed_query(query: str, profile: Optional[Dict] = None) -> Tuple[list[float], int, str]:
     """
-    # 呼叫 GPT-4o 做一般醫學問答
-    chat = client.chat.completions.create(
-        model=CHAT_MODEL,
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "你是專業且謹慎的中文醫學知識助手。"
-                    "當沒有可靠文件內容時，以一般醫學常識回覆；"
-                    "請條列重點、常見症狀、風險與就醫時機，避免個別診斷。"
-                ),
-            },
-            {
-                "role": "user",
-                "content": f"問題：{query}\n\n請條列重點並提醒何時應就醫。",
-            },
-        ],
-        temperature=0,
+    取得單一問題的 embedding，回傳 (向量, token 數, 快取狀態)。
+    快取狀態："memory"（記憶體命中）/ "disk"（磁碟命中）/ "miss"（有呼叫 API）；命中時 token 數為 0。
+    """
+    profile = profile or default_embedding_profile()
+    text = _normalize_query(query)
+    key = embed_cache.cache_key(text, profile["model"], profile.get("dimensions"))
+
+    with _QUERY_CACHE_LOCK:
+        vec = _QUERY_CACHE.get(key)
+        if vec is not None:
+            _QUERY_CACHE.move_to_end(key)
+            return vec, 0, "memory"
+
+    status = "miss"
+    vec = embed_cache.get_many([key]).get(key) if QUERY_CACHE_DISK else None
+    tokens = 0
+    if vec is not None:
+        status = "disk"
+    else:
+        # 同時間其他請求的問題會合成一次 API 呼叫
+        vec, tokens = _QUERY_BATCHER.embed(text, profile)
+        if QUERY_CACHE_DISK:
+            embed_cache.put_many({key: vec})
+
+    if QUERY_CACHE_SIZE > 0:
+        with _QUERY_CACHE_LOCK:
+            _QUERY_CACHE[key] = vec
+            _QUERY_CACHE.move_to_end(key)
+            while len(_QUERY_CACHE) > QUERY_CACHE_SIZE:
+                _QUERY_CACHE.popitem(last=False)
+    return vec, tokens, status
+
+
+# ==========================
+# 答案快取（同一個 collection、內容沒變，同樣或幾乎一樣的問題直接回上次的答案）
+# ==========================
+# - 範圍：collection + 內容版本（vector_store.content_version）+ embedding 設定 + mode / top_k / sources
+#   collection 有新增、刪除、reset、重新向量化 → 版本改變，舊答案自然不會再命中
+# - 完全命中（exact）：正規化後的問題文字相同 → 連問題的 embedding 都不用做
+# - 相似命中（semantic）：問題向量與快取中的問題 cosine ≥ ANSWER_CACHE_SIMILARITY
+#   → 省下檢索與 GPT，只付問題 embedding（通常也已在查詢快取裡）
+# - ANSWER_CACHE_SIZE：最多幾筆（0 代表關閉）；ANSWER_CACHE_TTL：秒數，過期就不再使用
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+# {(scope, 正規化後的問題): {"answer", "mode", "meta", "vec", "at"}}
+_ANSWER_CACHE: "OrderedDict[tuple, Dict]" = OrderedDict()
+_ANSWER_CACHE_LOCK = threading.Lock()
+_ANSWER_STATS = {"exact": 0, "semantic": 0, "misses": 0}
+
+
+def _answer_scope(
+    collection_id: str, profile: Dict, mode: str, top_k: int, sources: Optional[List[str]],
+) -> tuple:
+    """答案快取的範圍：只有這些都相同時，同一個問題的答案才能共用。"""
+    return (
+        collection_id,
+        vector_store.content_version(collection_id),
+        profile["model"],
+        profile.get("dimensions"),
+        mode,
+        int(top_k),
+        tuple(sorted(sources or [])),
     )
 
-    # 取得 usage 以計算成本
-    pt, ct, tt = _tokens(getattr(chat, "usage", None))
-    cost = pt * PRICES[CHAT_MODEL]["in"] + ct * PRICES[CHAT_MODEL]["out"]
 
-    # 回傳回答內容與成本資訊
-    return chat.choices[0].message.content.strip(), {
+def _answer_cache_get(scope: tuple, query: str, q_vec: Optional[list[float]] = None) -> Optional[Tuple[Dict, float]]:
+    """
+    查答案快取，回傳 (快取項目, 相似度) 或 None。
+    沒給 q_vec 只查完全相同的問題；有給就在同一範圍內找 cosine 最高、且達門檻的問題。
+    """
+    if ANSWER_CACHE_SIZE <= 0:
+        return None
+    now = time.time()
+    with _ANSWER_CACHE_LOCK:
+        if q_vec is None:
+            key = (scope, _normalize_query(query))
+            entry = _ANSWER_CACHE.get(key)
+            if entry is None:
+                return None
+            if now - entry["at"] > ANSWER_CACHE_TTL:
+                del _ANSWER_CACHE[key]
+                return None
+            _ANSWER_CACHE.move_to_end(key)
+            return entry, 1.0
+
+        keys, vecs = [], []
+        for key, entry in list(_ANSWER_CACHE.items()):
+            if now - entry["at"] > ANSWER_CACHE_TTL:
+                del _ANSWER_CACHE[key]
+            elif key[0] == scope:
+                keys.append(key)
+                vecs.append(entry["vec"])
+        if not keys:
+            return None
+        # 向量都已正規化（embedding 模型輸出就是單位向量）→ 內積就是 cosine
+        sims = np.asarray(vecs, dtype=np.float32) @ np.asarray(q_vec, dtype=np.float32)
+        best = int(np.argmax(sims))
+        if sims[best] < ANSWER_CACHE_SIMILARITY:
+            return None
+        _ANSWER_CACHE.move_to_end(keys[best])
+        return _ANSWER_CACHE[keys[best]], float(sims[best])
+
+
+def _answer_cache_put(scope: tuple, query: str, q_vec: list[float], answer: str, mode: str, meta: Dict):
+    """把這次的答案放進快取（超過 ANSWER_CACHE_SIZE 筆時淘汰最久沒用到的）。"""
+    if ANSWER_CACHE_SIZE <= 0:
+        return
+    key = (scope, _normalize_query(query))
+    with _ANSWER_CACHE_LOCK:
+        _ANSWER_CACHE[key] = {"answer": answer, "mode": mode, "meta": meta, "vec": q_vec, "at": time.time()}
+        _ANSWER_CACHE.move_to_end(key)
+        while len(_ANSWER_CACHE) > ANSWER_CACHE_SIZE:
+            _ANSWER_CACHE.popitem(last=False)
+
+
+def _count_answer_cache(kind: str):
+    with _ANSWER_CACHE_LOCK:
+        _ANSWER_STATS[kind] += 1
+
+
+def answer_cache_stats() -> Dict:
+    """答案快取統計：筆數、設定、完全 / 相似命中與未命中次數（自程式啟動後）。"""
+    with _ANSWER_CACHE_LOCK:
+        entries = len(_ANSWER_CACHE)
+        counts = dict(_ANSWER_STATS)
+    return {
+        "enabled": ANSWER_CACHE_SIZE > 0,
+        "entries": entries,
+        "max_entries": ANSWER_CACHE_SIZE,
+        "ttl_seconds": ANSWER_CACHE_TTL,
+        "similarity": ANSWER_CACHE_SIMILARITY,
+        **counts,
+    }
+
+
+def _cached_plan(
+    hit: Tuple[Dict, float],
+    kind: str,
+    collection_id: str,
+    emb_tt: int = 0,
+    emb_cost: float = 0.0,
+    emb_cache: Optional[str] = None,
+) -> Dict:
+    """
+    答案快取命中時的 plan：直接回上次的答案與來源。
+    沒有呼叫 GPT → 聊天費用為 0；相似命中時照算這次問題的 embedding 費用。
+    """
+    _count_answer_cache(kind)
+    entry, similarity = hit
+    cached = entry["meta"]
+    # 文件模式照常結清暫存的轉錄費（跟沒命中時一樣，不會因為命中而一直掛著）
+    trans_cost = pop_pending_transcribe_cost(collection_id) if entry["mode"] == "doc" else 0.0
+    meta = {
+        "usage": {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+            "embedding_tokens": emb_tt,
+            "embedding_cache": emb_cache,   # 完全命中時不做 embedding → None
+        },
+        "embedding_cost": emb_cost,
+        "chat_cost": 0.0,
+        "transcribe_cost": trans_cost,
+        "total_cost_usd": round(emb_cost, 6) + trans_cost,
+        "sources": cached.get("sources", []),
+        "collection_id": collection_id,
+        "top_score": cached.get("top_score"),
+        "answer_cache": kind,                           # "exact" / "semantic"
+        "answer_cache_similarity": round(similarity, 4),
+    }
+    return {
+        "mode": entry["mode"],
+        "answer": entry["answer"],
+        "meta": meta,
+        "sources": meta["sources"],
+        "top_score": meta["top_score"],
+    }
+
+
+def _remember_answer(plan: Dict, query: str, answer: str, meta: Dict):
+    """GPT 回答完後，把答案存進答案快取（plan 沒有快取範圍，例如一般模式，就不存）。"""
+    if plan.get("cache"):
+        scope, q_vec = plan["cache"]
+        _answer_cache_put(scope, query, q_vec, answer, plan["mode"], meta)
+
+
+# ==========================
+# 背景重新向量化（換 embedding 設定）
+# ==========================
+# 每批從向量庫取出幾段原文重新 embedding
+REEMBED_BATCH = 512
+
+# 進行中 / 最近一次的工作狀態：{cid: {"state": "running" | "done" | "failed", ...}}
+_REEMBED_JOBS: Dict[str, Dict] = {}
+_REEMBED_LOCK = threading.Lock()
+
+
+def start_reembed(collection_id: str, model: Optional[str] = None, dimensions: Optional[int] = None) -> Dict:
+    """
+    在背景把 collection 改用新的 embedding 設定重新向量化：
+    - 先寫到影子 collection（_reembed_<cid>），期間原本的 collection 照常服務查詢與上傳
+    - 追上期間新增的段落後，整個資料夾一次替換
+    回傳工作狀態（可用 reembed_status 查進度）。
+    """
+    profile = _resolve_profile(model or default_embedding_profile()["model"], dimensions)
+
+    with _REEMBED_LOCK:
+        job = _REEMBED_JOBS.get(collection_id)
+        if job and job["state"] == "running":
+            raise ValueError("這個 collection 已經有重新向量化的工作在執行")
+        job = {
+            "collection_id": collection_id,
+            "state": "running",
+            "profile": profile,
+            "done": 0,
+            "total": vector_store.count(collection_id),
+            "embedding_cost": 0.0,
+            "error": None,
+        }
+        _REEMBED_JOBS[collection_id] = job
+
+    threading.Thread(target=_reembed_job, args=(collection_id, profile, job), daemon=True).start()
+    return dict(job)
+
+
+def reembed_status(collection_id: str) -> Optional[Dict]:
+    job = _REEMBED_JOBS.get(collection_id)
+    return dict(job) if job else None
+
+
+def _reembed_job(collection_id: str, profile: Dict, job: Dict):
+    shadow = f"_reembed_{collection_id}"
+    created = False
+    try:
+        done = 0
+        epoch = vector_store.row_epoch(collection_id)
+        while True:
+            n = vector_store.count(collection_id)
+            job["total"] = n
+            for start in range(done, n, REEMBED_BATCH):
+                metas = vector_store.read_metas(collection_id, start, min(start + REEMBED_BATCH, n))
+                vectors, tokens = _embed_paragraph_batches([m.get("text") or "" for m in metas], profile)
+                if not created:
+                    vector_store.create_shadow_collection(collection_id, shadow, len(vectors[0]), profile)
+                    created = True
+                vector_store.add_embeddings(shadow, vectors, metas)
+                done = start + len(metas)
+                job["done"] = done
+                job["embedding_cost"] = round(job["embedding_cost"] + tokens * _embed_price(profile), 6)
+
+            if not created:
+                # 空的 collection：沒有東西要搬，直接換設定
+                vector_store.set_embedding_profile(collection_id, profile)
+                break
+            # 期間若又有新增，替換會失敗 → 回到上面把新的段落補完再試
+            if vector_store.replace_collection(collection_id, shadow, done, epoch):
+                break
+        job["state"] = "done"
+    except Exception as e:
+        job["state"] = "failed"
+        job["error"] = str(e).strip() or type(e).__name__
+        if created:
+            vector_store.drop_collection(shadow)
+
+
+# 文件模式下，模型自己加上的「(第1頁)」之類頁碼（來源另外列在 sources，這裡一律拿掉）
+PAGE_HINT_RE = re.compile(r'[（(]\s*第\s*\d+\s*頁\s*[)）]')
+
+# 串流時，左括號後面最多等幾個字判斷是不是頁碼（「(第12頁)」不會超過這個長度）
+_PAGE_HINT_MAX = 16
+
+
+def _general_messages(query: str) -> list[Dict]:
+    """一般知識回答的 prompt。"""
+    return [
+        {
+            "role": "system",
+            "content": (
+                "你是專業且謹慎的中文醫學知識助手。"
+                "當沒有可靠文件內容時，以一般醫學常識回覆；"
+                "請條列重點、常見症狀、風險與就醫時機，避免個別診斷。"
+            ),
+        },
+        {
+            "role": "user",
+            "content": f"問題：{query}\n\n請條列重點並提醒何時應就醫。",
+        },
+    ]
+
+
+# --- 文件模式的上下文組裝（可由 .env 覆蓋）---
+# - CONTEXT_TOKEN_BUDGET：檢索段落組成的上下文最多幾個 token（用 CHAT_MODEL 的 tokenizer 算；沒有 tokenizer 時用估算）
+# - CONTEXT_DEDUP_SIMILARITY：兩段的向量 cosine ≥ 這個值就視為重複（投影片常見），只留名次較前的
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_DEDUP_SIMILARITY = float(os.getenv("CONTEXT_DEDUP_SIMILARITY", "0.95"))
+# 預算快用完時，剩下的空間少於這麼多 token 就不再塞截斷的片段
+_CONTEXT_MIN_PIECE = 50
+
+
+def _count_tokens(text: str, model: str = CHAT_MODEL) -> int:
+    """計算文字的 token 數（有 tokenizer 就精確計算，否則估算）。"""
+    enc = _encoder(model)
+    return len(enc.encode_ordinary(text)) if enc is not None else _estimate_tokens(text)
+
+
+def _truncate_tokens(text: str, limit: int, model: str = CHAT_MODEL) -> str:
+    """只保留前 limit 個 token 的文字。"""
+    if limit <= 0:
+        return ""
+    enc = _encoder(model)
+    if enc is not None:
+        return enc.decode(enc.encode_ordinary(text)[:limit])
+    cost = 0.0
+    for i, ch in enumerate(text):
+        cost += 2.0 if _is_wide(ch) else 1 / 3
+        if math.ceil(cost) > limit:
+            return text[:i]
+    return text
+
+
+def _dedup_passages(paras: list[Dict]) -> list[Dict]:
+    """
+    依名次由前到後，丟掉跟前面已保留的段落幾乎相同的段落：
+    - 向量 cosine ≥ CONTEXT_DEDUP_SIMILARITY（所有段落兩兩相似度一次用矩陣乘法算完）
+    - 或正規化後文字完全相同（取不回向量的段落也能去重）
+    """
+    n = len(paras)
+    if n <= 1:
+        return list(paras)
+    has_vec = [p.get("vector") is not None for p in paras]
+    dup = np.zeros((n, n), dtype=bool)
+    if any(has_vec):
+        dim = next(len(p["vector"]) for p in paras if p.get("vector") is not None)
+        mat = np.zeros((n, dim), dtype=np.float32)
+        for i, p in enumerate(paras):
+            if has_vec[i]:
+                mat[i] = p["vector"]
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        mat /= np.where(norms > 0, norms, 1.0)
+        # dup[i, j]：排在後面的 j 跟前面的 i 重複（沒有向量的列全為 0，不會被判為重複）
+        dup = np.triu(mat @ mat.T >= CONTEXT_DEDUP_SIMILARITY, k=1)
+
+    kept: list[int] = []
+    seen: set[str] = set()
+    for j, p in enumerate(paras):
+        norm = " ".join((p.get("text") or "").split())
+        if norm in seen or (kept and dup[kept, j].any()):
+            continue
+        kept.append(j)
+        seen.add(norm)
+    return [paras[j] for j in kept]
+
+
+def _render_block(page, items: list[list]) -> str:
+    """同一頁的段落合成一段：依列號排好（相鄰段落接在一起），只標一次頁碼。"""
+    ordered = sorted(items, key=lambda it: it[0])
+    return f"第{page}頁：" + "\n".join(it[1] for it in ordered)
+
+
+def _pack_context(top_paras: list[Dict]) -> Tuple[str, list[Dict]]:
+    """
+    把檢索結果組成不超過 CONTEXT_TOKEN_BUDGET 個 token 的上下文，回傳 (上下文, 實際放進去的段落)：
+    1. 去掉重複 / 幾乎相同的段落（見 _dedup_passages）
+    2. 依名次（分數高的先）逐段放入，放不下整段時截斷最後一段補滿預算
+    3. 同一個來源、同一頁的段落合成一段，依列號排序（相鄰段落接在一起，頁碼只標一次）
+    """
+    budget = CONTEXT_TOKEN_BUDGET
+    sep_tokens = _count_tokens("\n\n")
+    blocks: Dict[tuple, list[list]] = {}     # (source, page) → [[列號, 文字], ...]，依第一次出現排序
+    block_tokens: Dict[tuple, int] = {}
+    used: list[Dict] = []
+    total = 0
+
+    for p in _dedup_passages(top_paras):
+        text = (p.get("text") or "").strip()
+        if not text:
+            continue
+        page = p.get("page", "?")
+        key = (p.get("source"), page)
+        # 沒有列號就排在同頁有列號的段落後面（依名次）
+        item = [p.get("row", float("inf")), text]
+        items = blocks.get(key, []) + [item]
+        new_block = _count_tokens(_render_block(page, items))
+        new_total = total - block_tokens.get(key, 0) + new_block + (0 if key in blocks or not blocks else sep_tokens)
+        if new_total <= budget:
+            blocks[key], block_tokens[key], total = items, new_block, new_total
+            used.append(p)
+            continue
+
+        # 放不下整段 → 截斷到剩下的空間（太小就不放了），之後的段落都不再考慮
+        room = budget - (new_total - _count_tokens(text)) - 1   # 留 1 個 token 給 "..."
+        if room >= _CONTEXT_MIN_PIECE:
+            item[1] = _truncate_tokens(text, room) + "..."
+            blocks[key] = items
+            used.append(p)
+        break
+
+    ctx = "\n\n".join(_render_block(page, items) for (_, page), items in blocks.items())
+    # 段落接在一起時 token 的切法可能跟分開算時略有不同 → 最後再以整段精確檢查一次
+    if _count_tokens(ctx) > budget:
+        ctx = _truncate_tokens(ctx, budget)
+    return ctx, used
+
+
+def _doc_messages(query: str, ctx: str) -> list[Dict]:
+    """文件模式的 prompt：ctx 是 _pack_context 組好的上下文。"""
+    prompt = (
+        "你是一位嚴謹的中文醫學AI助手。請僅根據下面提供的文件內容回答問題，"
+        "務必以條列式說明，並在每一點最後以 (第X頁) 標註引用頁碼。"
+        "若文件不足以支持答案，請明確說明。\n\n"
+        f"【可用文件內容】\n{ctx}\n\n【使用者問題】{query}\n\n請開始回答："
+    )
+    return [
+        {
+            "role": "system",
+            "content": "你是專業且謹慎的醫學知識助手，回答時務必標註引用頁碼。"
+        },
+        {
+            "role": "user",
+            "content": prompt,
+        },
+    ]
+
+
+def _sources_meta(top_paras: list[Dict]) -> list[Dict]:
+    """整理來源段落（給前端顯示用）。"""
+    sources_meta: list[Dict] = []
+    for p in top_paras:
+        src = p.get("source")
+        if not src:
+            continue
+        snippet = (p.get("text") or "").replace("\n", " ")
+        sources_meta.append({
+            "snippet": snippet[:160],   # 簡短片段
+            "text": snippet[:160],
+            "source": src,
+            "time": p.get("time"),
+            "page": p.get("page"),
+            "score": (float(p["score"]) if p.get("score") is not None else None),
+        })
+    return sources_meta
+
+
+def _general_meta(pt: int, ct: int, tt: int) -> Dict:
+    """
+    一般知識回答（不依賴文件 / 向量庫）的聊天成本。
+
+    適用情境：
+    - 使用者只問一般問題，沒有指定文件或 collection。
+    - 或者 auto 模式下文件檢索信心不足時（最高分數低於 CONF_THRESHOLD）。
+    """
+    cost = pt * PRICES[CHAT_MODEL]["in"] + ct * PRICES[CHAT_MODEL]["out"]
+    return {
         "usage": {
             "prompt_tokens": pt,
             "completion_tokens": ct,
@@ -246,57 +1162,29 @@ def _answer_general(query: str) -> Tuple[str, Dict]:
     }
 
 
-
-
-def answer_question(
+def _plan_answer(
     query: str,
     mode: str,
     top_k: int = 5,
     sources: Optional[List[str]] = None,
-    collection_id: Optional[str] = None,  # 可以為 None，不強制 "_default"
-) -> Tuple[str, str, Dict]:
+    collection_id: Optional[str] = None,
+    answer_cache: bool = True,
+) -> Dict:
     """
-    問答主入口，負責整合「一般模式」與「文件(doc)模式」。
+    answer_question / answer_question_stream 共用的前半段：決定實際模式、做檢索、組 prompt。
+    answer_cache=False：不查也不存答案快取（例如 /fetch_url 用完即丟的臨時 collection，存了也永遠不會再命中）。
 
-    參數：
-    - query: 使用者問題（純文字）
-    - mode: "general" / "doc" / "auto"
-        * "general"：一定走一般知識，不用文件
-        * "doc"：強制走文件模式，若沒有文件則回傳提示訊息
-        * "auto"：原設計想根據信心分數決定走 doc 或 general（目前相關程式已註解掉）
-    - top_k: 文件模式下，從向量庫取前幾個相似段落
-    - sources: 可選，限制只從指定檔案來源中搜尋
-    - collection_id: 可選，指定向量庫 collection（知識庫）
-
-    回傳：
-    - answer: 答案文字
-    - mode_used: 最終實際使用的模式 "general" or "doc"
-    - meta: 成本與來源資訊字典
+    回傳 plan：
+    - {"mode", "answer", "meta"}：不需要呼叫 GPT（例如 doc 模式卻沒有文件），直接回這段文字
+    - {"mode", "messages", ...}：要送 GPT 的 prompt，以及檢索結果與 embedding 用量（給 _plan_meta 算成本）
     """
     mode = mode.lower()
-    CONF_THRESHOLD = 0.25  # （預留用）檢索信心門檻，auto 模式可用 0.2~0.35
-
-    # ---- 建立一個「空 meta」的工具 ----
-    def _meta_zero(**extra):
-        base = {
-            "usage": {},
-            "embedding_cost": 0.0,
-            "chat_cost": 0.0,
-            "transcribe_cost": 0.0,
-            "total_cost_usd": 0.0,
-            "sources": [],
-        }
-        base.update(extra)
-        return base
+    # 檢索信心門檻（cosine 相似度），auto 模式可用 0.2~0.35
+    CONF_THRESHOLD = float(os.getenv("QA_CONF_THRESHOLD", "0.25"))
 
     # 1) 強制一般知識模式：完全不看文件、不做 embedding
     if mode == "general":
-        ans, meta = _answer_general(query)
-        # 確保 meta 裡有 embedding_cost / transcribe_cost / total_cost_usd
-        meta.setdefault("embedding_cost", 0.0)
-        meta.setdefault("transcribe_cost", 0.0)
-        meta.setdefault("total_cost_usd", meta.get("chat_cost", 0.0))
-        return ans, "general", meta
+        return {"mode": "general", "messages": _general_messages(query)}
 
     # 2) 判斷「文件是否可用？」
     use_docs = False
@@ -311,145 +1199,315 @@ def answer_question(
 
     # 若文件不可用，且 mode != "doc"（也就是 auto 模式），就退回一般知識回答
     if not use_docs and mode != "doc":
-        ans, meta = _answer_general(query)
-        meta.setdefault("embedding_cost", 0.0)
-        meta.setdefault("transcribe_cost", 0.0)
-        meta.setdefault("total_cost_usd", meta.get("chat_cost", 0.0))
-        return ans, "general", meta
+        return {"mode": "general", "messages": _general_messages(query)}
 
     # 3) 若使用者硬指定 mode="doc"，但實際上沒有任何文件可以用
     if mode == "doc" and not use_docs:
         # 這裡選擇回傳溫和提示，而不是直接 raise HTTPException
-        ans = "根據目前指定的文件/知識庫，無法進行檢索，請先上傳或選擇正確的來源。"
-        return ans, "doc", _meta_zero()
+        return {
+            "mode": "doc",
+            "answer": "根據目前指定的文件/知識庫，無法進行檢索，請先上傳或選擇正確的來源。",
+            "meta": {
+                "usage": {},
+                "embedding_cost": 0.0,
+                "chat_cost": 0.0,
+                "transcribe_cost": 0.0,
+                "total_cost_usd": 0.0,
+                "sources": [],
+            },
+        }
 
     # 走到這裡代表：文件可用（auto 或 doc 模式）。
 
-    emb_cost = 0.0
-    trans_cost = 0.0
-
     # 4) 僅在「使用文件」時才對 query 做 embedding（避免浪費錢）
-    q_embed = client.embeddings.create(model=EMBED_MODEL, input=[query])
-    q_vec = q_embed.data[0].embedding
-
-    # 取得 embedding token 使用量，計算 embedding 成本
-    _, _, emb_tt = _tokens(getattr(q_embed, "usage", None))
-    emb_cost = emb_tt * PRICES[EMBED_MODEL]["in"]
-
-    # 5) 在指定 collection/sources 中做相似段落檢索
+    #    query 必須跟 collection 用同一組 embedding 設定（model + dimensions）
+    #    同樣的問題問過就直接用快取的向量（不呼叫 API、不計費）
+    profile = collection_profile(collection_id)
+
+    # 同一個 collection（內容沒變）問過同樣的問題 → 直接回上次的答案，連 embedding 都不用做
+    scope = _answer_scope(collection_id, profile, mode, top_k, sources) if collection_id and answer_cache else None
+    hit = _answer_cache_get(scope, query) if scope else None
+    if hit:
+        return _cached_plan(hit, "exact", collection_id)
+
+    q_vec, emb_tt, emb_cache = _embed_query(query, profile)
+
+    # 依 embedding token 使用量，計算 embedding 成本
+    emb_cost = emb_tt * _embed_price(profile)
+
+    # 意思幾乎一樣的問題（向量很接近）也共用答案，省下檢索與 GPT
+    if scope:
+        hit = _answer_cache_get(scope, query, q_vec)
+        if hit:
+            return _cached_plan(hit, "semantic", collection_id, emb_tt, emb_cost, emb_cache)
+        _count_answer_cache("misses")
+
+    # 5) 在指定 collection/sources 中做相似段落檢索（向量 + 關鍵字混合，不多花 API 費用）
+    #    同時取回段落向量，組上下文時用來去除重複段落
     top_paras = search_similar_in_collection(
         collection_id,
         q_vec,
         top_k=top_k,
         sources=sources,
+        query_text=query,
+        with_vectors=True,
     ) or []
 
-    # 最高分數（用於 auto 模式判斷信心）
-    top_score = float(top_paras[0].get("score", 0.0)) if top_paras else 0.0
+    # 最高分數（cosine 相似度，用於 auto 模式判斷信心）
+    # 混合檢索依 RRF 排序，只被關鍵字找到的段落沒有 cosine 分數 → 取有分數者的最大值
+    top_score = max((float(p["score"]) for p in top_paras if p.get("score") is not None), default=0.0)
 
-    # 原本 auto 模式設計：
-    # - 若沒找到段落或分數太低 → 退回一般知識
-    # 目前被註解掉，如果未來要啟用可以打開這段。
-    # if mode == "auto" and (not top_paras or top_score < CONF_THRESHOLD):
-    #     ans, meta = _answer_general(query)
-    #     meta["embedding_cost"] = meta.get("embedding_cost", 0.0) + emb_cost
-    #     meta["total_cost_usd"] = meta.get("total_cost_usd", 0.0) + emb_cost
-    #     meta.setdefault("transcribe_cost", 0.0)
-    #     return ans, "general", meta
+    retrieval = {
+        "emb_cost": emb_cost,
+        "emb_tt": emb_tt,
+        "emb_cache": emb_cache,
+        "top_score": top_score,
+        "cache": (scope, q_vec) if scope else None,   # 回答完存進答案快取用
+    }
 
-    # 6) 組上下文文字（把 top_k 段落變成一大段 context）
-    ctx_lines: list[str] = []
-    total_chars = 0
+    # auto 模式：若沒找到段落或分數太低 → 退回一般知識（query embedding 的費用照算）
+    if mode == "auto" and (not top_paras or top_score < CONF_THRESHOLD):
+        return {"mode": "general", "messages": _general_messages(query), **retrieval}
 
-    for p in top_paras:
-        t = (p.get("text") or "")
-        # 避免每段太長，簡單裁切到 1200 字
-        if len(t) > 1200:
-            t = t[:1200] + "..."
-        total_chars += len(t)
-        page = p.get("page", "?")
-        ctx_lines.append(f"第{page}頁：{t}")
+    # 6) 組上下文：去重、依分數在 token 預算內挑段落、同頁段落合併
+    ctx, used = _pack_context(top_paras)
 
-    # 若要在 auto 模式下再做一次保護（總字數太少就退回一般知識），可打開這段：
-    # if mode == "auto" and total_chars < 200:
-    #     ans, meta = _answer_general(query)
-    #     meta["embedding_cost"] = meta.get("embedding_cost", 0.0) + emb_cost
-    #     meta["total_cost_usd"] = meta.get("total_cost_usd", 0.0) + emb_cost
-    #     meta.setdefault("transcribe_cost", 0.0)
-    #     return ans, "general", meta
+    # 若要在 auto 模式下再做一次保護（上下文總字數太少就退回一般知識），可打開這段：
+    # if mode == "auto" and len(ctx) < 200:
+    #     return {"mode": "general", "messages": _general_messages(query), **retrieval}
 
-    ctx = "\n\n".join(ctx_lines)
+    # 7) 建構送給 GPT-4o 的 prompt（文件模式專用）；來源只列實際放進上下文的段落
+    return {
+        "mode": "doc",
+        "messages": _doc_messages(query, ctx),
+        "sources": _sources_meta(used),
+        **retrieval,
+    }
 
-    # 7) 建構送給 GPT-4o 的 prompt（文件模式專用）
-    prompt = (
-        "你是一位嚴謹的中文醫學AI助手。請僅根據下面提供的文件內容回答問題，"
-        "務必以條列式說明，並在每一點最後以 (第X頁) 標註引用頁碼。"
-        "若文件不足以支持答案，請明確說明。\n\n"
-        f"【可用文件內容】\n{ctx}\n\n【使用者問題】{query}\n\n請開始回答："
-    )
 
-    # 呼叫 GPT-4o 生成「根據文件內容」的答案
-    chat = client.chat.completions.create(
-        model=CHAT_MODEL,
-        messages=[
-            {
-                "role": "system",
-                "content": "你是專業且謹慎的醫學知識助手，回答時務必標註引用頁碼。"
-            },
-            {
-                "role": "user",
-                "content": prompt,
-            },
-        ],
-        temperature=0,
-    )
+def _plan_meta(plan: Dict, pt: int, ct: int, tt: int, collection_id: Optional[str]) -> Dict:
+    """GPT 回答完之後，依 plan 與聊天 token 數整理成本與來源資訊（回給上層 /ask 使用）。"""
+    if plan["mode"] == "general":
+        meta = _general_meta(pt, ct, tt)
+        # 確保 meta 裡有 embedding_cost / transcribe_cost / total_cost_usd
+        meta["embedding_cost"] = plan.get("emb_cost", 0.0)
+        meta["total_cost_usd"] += meta["embedding_cost"]
+        meta["transcribe_cost"] = 0.0
+        if "top_score" in plan:
+            # auto 模式檢索後才退回一般知識：附上檢索資訊
+            meta["top_score"] = plan["top_score"]
+            meta["usage"]["embedding_tokens"] = plan["emb_tt"]
+            meta["usage"]["embedding_cache"] = plan["emb_cache"]
+        return meta
 
     # 計算聊天成本
-    pt, ct, tt = _tokens(getattr(chat, "usage", None))
     chat_cost = round(
         pt * PRICES[CHAT_MODEL]["in"] + ct * PRICES[CHAT_MODEL]["out"],
         6,
     )
 
-    # 8) 若這個 collection 之前有暫存轉錄費用（影音），此處一次結清
+    # 若這個 collection 之前有暫存轉錄費用（影音），此處一次結清
     trans_cost = pop_pending_transcribe_cost(collection_id) if collection_id else 0.0
 
     # 總成本：embedding + chat（轉錄費另外加在 meta 中）
-    total_cost = round(emb_cost + chat_cost, 6)
-
-    # 9) 整理來源段落（給前端顯示用）
-    sources_meta: list[Dict] = []
-    for p in top_paras:
-        src = p.get("source")
-        if not src:
-            continue
-        snippet = (p.get("text") or "").replace("\n", " ")
-        sources_meta.append({
-            "snippet": snippet[:160],   # 簡短片段
-            "text": snippet[:160],
-            "source": src,
-            "time": p.get("time"),
-            "page": p.get("page"),
-            "score": (float(p["score"]) if p.get("score") is not None else None),
-        })
-
-    # 10) 清理 AI 回答中模型自己亂加的「(第1頁)」之類假頁碼
-    PAGE_HINT_RE = re.compile(r'[（(]\s*第\s*\d+\s*頁\s*[)）]')
-    answer_text = chat.choices[0].message.content.strip()
-    answer_text = PAGE_HINT_RE.sub('', answer_text)
+    total_cost = round(plan["emb_cost"] + chat_cost, 6)
 
-    # 11) 整理 meta，回給上層 /ask 使用
-    meta = {
+    return {
         "usage": {
             "prompt_tokens": pt,
             "completion_tokens": ct,
             "total_tokens": tt,
+            "embedding_tokens": plan["emb_tt"],
+            "embedding_cache": plan["emb_cache"],   # "memory" / "disk"：問題的向量來自快取，沒有 embedding 費用
         },
-        "embedding_cost": emb_cost,
+        "embedding_cost": plan["emb_cost"],
         "chat_cost": chat_cost,
         "transcribe_cost": trans_cost,
         "total_cost_usd": total_cost + trans_cost,  # 把轉錄費加進總成本
-        "sources": sources_meta,
+        "sources": plan["sources"],
+        "collection_id": collection_id,
+        "top_score": plan["top_score"],
+    }
+
+
+# 同時進行中的相同問題（問題 + mode + collection + sources + top_k 都相同）只算一次
+_ANSWER_FLIGHTS = SingleFlight()
+
+# 分攤時要除以人數的成本欄位
+_COST_FIELDS = ("embedding_cost", "chat_cost", "transcribe_cost", "total_cost_usd")
+
+
+def share_meta(meta: Dict, callers: int) -> Dict:
+    """
+    多個請求共用同一次計算時，每個請求回報的成本是平均分攤後的金額（加總起來才是實際花費）；
+    另外在 meta["shared"] 記錄共用的請求數與這次計算的總成本。只有一個請求時原樣回傳。
+    """
+    if callers <= 1:
+        return meta
+    meta = copy.deepcopy(meta)
+    total = meta.get("total_cost_usd", 0.0)
+    for k in _COST_FIELDS:
+        if k in meta:
+            meta[k] = meta[k] / callers
+    meta["shared"] = {"callers": callers, "total_cost_usd": total}
+    return meta
+
+
+def answer_question(
+    query: str,
+    mode: str,
+    top_k: int = 5,
+    sources: Optional[List[str]] = None,
+    collection_id: Optional[str] = None,  # 可以為 None，不強制 "_default"
+    answer_cache: bool = True,
+) -> Tuple[str, str, Dict]:
+    """
+    問答主入口，負責整合「一般模式」與「文件(doc)模式」。
+    同時有多個相同的問題在算時，只有第一個實際 embedding / 檢索 / 呼叫 GPT，
+    其他的等它算完拿同一份答案，成本由這些請求平均分攤（見 share_meta）。
+
+    參數：
+    - query: 使用者問題（純文字）
+    - mode: "general" / "doc" / "auto"
+        * "general"：一定走一般知識，不用文件
+        * "doc"：強制走文件模式，若沒有文件則回傳提示訊息
+        * "auto"：有文件就先檢索，最高相似度低於 CONF_THRESHOLD 時退回一般知識
+    - top_k: 文件模式下，從向量庫取前幾個相似段落
+    - sources: 可選，限制只從指定檔案來源中搜尋
+    - collection_id: 可選，指定向量庫 collection（知識庫）
+    - answer_cache: False 時不查也不存答案快取（臨時 collection 用）
+
+    回傳：
+    - answer: 答案文字
+    - mode_used: 最終實際使用的模式 "general" or "doc"
+    - meta: 成本與來源資訊字典
+    """
+    key = (_normalize_query(query), mode.lower(), collection_id, tuple(sorted(sources or [])), int(top_k))
+    (answer_text, mode_used, meta), callers, _ = _ANSWER_FLIGHTS.do(
+        key, lambda: _answer_question(query, mode, top_k, sources, collection_id, answer_cache),
+    )
+    return answer_text, mode_used, share_meta(meta, callers)
+
+
+def _answer_question(
+    query: str,
+    mode: str,
+    top_k: int = 5,
+    sources: Optional[List[str]] = None,
+    collection_id: Optional[str] = None,
+    answer_cache: bool = True,
+) -> Tuple[str, str, Dict]:
+    """answer_question 的本體（不合併請求）。"""
+    plan = _plan_answer(
+        query, mode, top_k=top_k, sources=sources, collection_id=collection_id, answer_cache=answer_cache,
+    )
+    if "answer" in plan:
+        return plan["answer"], plan["mode"], plan["meta"]
+
+    # 呼叫 GPT-4o 生成答案
+    chat = client.chat.completions.create(
+        model=CHAT_MODEL,
+        messages=plan["messages"],
+        temperature=0,
+    )
+    pt, ct, tt = _tokens(getattr(chat, "usage", None))
+
+    answer_text = chat.choices[0].message.content.strip()
+    if plan["mode"] == "doc":
+        # 清理 AI 回答中模型自己亂加的「(第1頁)」之類假頁碼
+        answer_text = PAGE_HINT_RE.sub('', answer_text)
+
+    meta = _plan_meta(plan, pt, ct, tt, collection_id)
+    _remember_answer(plan, query, answer_text, meta)
+    return answer_text, plan["mode"], meta
+
+
+# ==========================
+# 串流回答（SSE）
+# ==========================
+class _PageHintFilter:
+    """
+    串流版的 PAGE_HINT_RE：逐段餵入模型輸出，回傳可以先送出的文字。
+    遇到左括號就先扣住，等到確定不是「(第X頁)」（或括號已經結束）才放出去。
+    """
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, text: str) -> str:
+        buf = PAGE_HINT_RE.sub("", self._pending + text)
+        # 從最後一個還沒結束、而且可能是頁碼的左括號開始扣住
+        for i in range(max(0, len(buf) - _PAGE_HINT_MAX), len(buf)):
+            if buf[i] in "（(" and not any(c in "）)" for c in buf[i:]):
+                self._pending = buf[i:]
+                return buf[:i]
+        self._pending = ""
+        return buf
+
+    def flush(self) -> str:
+        out, self._pending = PAGE_HINT_RE.sub("", self._pending), ""
+        return out
+
+
+def answer_question_stream(
+    query: str,
+    mode: str,
+    top_k: int = 5,
+    sources: Optional[List[str]] = None,
+    collection_id: Optional[str] = None,
+    answer_cache: bool = True,
+):
+    """
+    串流版的 answer_question（generator），依序產生 (事件名稱, 資料)：
+    - ("sources", {"mode", "sources", "collection_id", "top_score"})：檢索完馬上送，不用等 GPT
+    - ("delta", {"text"})：答案的片段（文件模式已去掉假頁碼）
+    - ("done", {"answer", "mode", "meta"})：完整答案，以及與 answer_question 相同的成本資訊
+    """
+    plan = _plan_answer(
+        query, mode, top_k=top_k, sources=sources, collection_id=collection_id, answer_cache=answer_cache,
+    )
+    yield "sources", {
+        "mode": plan["mode"],
+        "sources": plan.get("sources", []),
         "collection_id": collection_id,
+        "top_score": plan.get("top_score"),
     }
-    return answer_text, "doc", meta
+
+    if "answer" in plan:
+        yield "delta", {"text": plan["answer"]}
+        yield "done", {"answer": plan["answer"], "mode": plan["mode"], "meta": plan["meta"]}
+        return
+
+    # include_usage：最後一個 chunk 會帶整次的 token 用量（choices 為空）
+    stream = client.chat.completions.create(
+        model=CHAT_MODEL,
+        messages=plan["messages"],
+        temperature=0,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    hint_filter = _PageHintFilter() if plan["mode"] == "doc" else None
+    parts: list[str] = []
+    usage = None
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content or ""
+        if hint_filter is not None:
+            text = hint_filter.feed(text)
+        if text:
+            parts.append(text)
+            yield "delta", {"text": text}
+    if hint_filter is not None:
+        tail = hint_filter.flush()
+        if tail:
+            parts.append(tail)
+            yield "delta", {"text": tail}
+
+    pt, ct, tt = _tokens(usage)
+    answer_text = "".join(parts).strip()
+    meta = _plan_meta(plan, pt, ct, tt, collection_id)
+    _remember_answer(plan, query, answer_text, meta)
+    yield "done", {"answer": answer_text, "mode": plan["mode"], "meta": meta}
@@ -0,0 +1,85 @@
+# services/singleflight.py
+# ---------------------------------------------
+# 合併「同時進行中」的相同工作（singleflight）：
+# - 同一個 key 已經有人在算 → 後到的呼叫不再重算，等第一個算完一起拿結果
+# - 算完就從表裡移除，之後的呼叫會重新計算（要重複使用結果請用快取，這裡只管同時間的重複）
+# - 回傳時附上「總共幾個呼叫分到這次結果」，讓呼叫端把費用平均分攤，不會重複計費
+# 兩個版本：
+#   SingleFlight：給執行緒用（qna.answer_question 在執行緒池裡跑）
+#   AsyncSingleFlight：給 asyncio 用（app.py 的網址問答是 async 流程）
+# ---------------------------------------------
+
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Hashable, Tuple
+
+
+class _Call:
+    """一次進行中的計算。"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.callers = 1
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """執行緒版：同一個 key 同時只會有一個 fn 在跑。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, int, bool]:
+        """
+        執行（或加入進行中的）計算，回傳 (結果, 分到這次結果的呼叫數, 自己是否為實際計算的那一個)。
+        計算拋出的例外，所有等待中的呼叫都會收到同一個例外。
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.callers += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                # 先移出表再喚醒：之後 callers 不會再變，大家讀到的人數一致
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result, call.callers, leader
+
+
+class AsyncSingleFlight:
+    """asyncio 版：同一個 key 同時只會有一個 coroutine 在跑（只在同一個事件迴圈內使用）。"""
+
+    def __init__(self):
+        self._calls: dict[Hashable, list] = {}   # key → [task, 呼叫數]
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, int, bool]:
+        """同 SingleFlight.do；發起的請求被取消（例如前端斷線）時，計算仍會跑完給其他等待者。"""
+        entry = self._calls.get(key)
+        leader = entry is None
+        if leader:
+            task = asyncio.ensure_future(fn())
+            entry = self._calls[key] = [task, 1]
+            # 第一個註冊的 callback：完成時先移出表，等待者醒來時人數已經固定
+            task.add_done_callback(lambda _t: self._calls.pop(key, None))
+        else:
+            entry[1] += 1
+        result = await asyncio.shield(entry[0])
+        return result, entry[1], leader
@@ -127,12 +127,32 @@
 # 3️⃣ 提供新增向量 (add_embeddings) 與相似度搜尋 (search)
 # 4️⃣ 資料結構為每個 collection 一個資料夾：
 #      data/collections/<collection_id>/
-#        ├── index.faiss   ← 向量資料
-#        └── meta.json     ← 段落描述列表
+#        ├── index.faiss   ← 向量資料（compaction 後的主檔）
+#        ├── meta.sqlite   ← 段落 meta（compaction 後的主檔，SQLite，一列一個段落）
+#        ├── vectors.f32   ← 量化時才有：主檔向量的原始 float32（重排用）
+#        └── segments/     ← append-only 段檔，每次 add_embeddings 寫一組
+#              ├── 000000000120.npy    ← 這批新增的向量（起始列號 120）
+#              └── 000000000120.jsonl  ← 這批新增的段落 meta（一行一筆）
+# 5️⃣ 新增只寫入小段檔（成本與批次大小成正比），
+#    段檔累積到一定數量後由背景 compaction 合併回主檔。
+# 6️⃣ 記憶體中分成兩層：
+#      - base：主檔的索引（VECTOR_STORAGE=mmap 時直接 mmap，不整份讀進 RAM）
+#      - delta：段檔裡的新向量（一律放記憶體，小）
+#    搜尋時兩層都查，再依距離合併。
 # ---------------------------------------------
 
 from __future__ import annotations
 import os, json
+import bisect
+import itertools
+import re
+import shutil
+import sqlite3
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 import faiss                # Facebook AI 相似度搜尋庫
 import numpy as np
@@ -142,14 +162,293 @@ import numpy as np
 BASE_DIR = Path("data/collections")
 BASE_DIR.mkdir(parents=True, exist_ok=True)
 
+# 段檔累積到幾個就觸發背景 compaction（可由 .env 覆蓋）
+COMPACT_SEGMENTS = int(os.getenv("VECTOR_COMPACT_SEGMENTS", "16"))
+
+# 主檔的載入方式（可由 .env 覆蓋）：
+# - memory：index 整份讀進記憶體（預設，和舊版行為一樣）
+# - mmap：index 以 mmap 開啟（冷啟動快、記憶體省）
+# meta 一律存在 meta.sqlite，依需要分頁讀取
+STORAGE_MODE = os.getenv("VECTOR_STORAGE", "memory").lower()
+
+# meta 分頁讀取時，每頁幾筆；每個 collection 最多保留幾頁在記憶體（0 代表不限制）
+META_PAGE_ROWS = int(os.getenv("VECTOR_META_PAGE_ROWS", "256"))
+META_CACHE_PAGES = int(os.getenv("VECTOR_META_CACHE_PAGES", "64"))
+
+# 寫檔後是否 fsync（預設開啟：rename 之後的檔案內容一定已經落地，斷電或執行個體被砍也不會留下半份檔；
+# 本機測試可設 VECTOR_FSYNC=0 加速）
+FSYNC = os.getenv("VECTOR_FSYNC", "1") != "0"
+
+# collection 快取的記憶體預算（MB，可由 .env 覆蓋；0 代表不限制）
+CACHE_BUDGET_MB = float(os.getenv("VECTOR_CACHE_MB", "1024"))
+
+# 估算常駐大小時，每筆 meta（Python dict）額外的物件開銷（bytes）
+_META_ROW_OVERHEAD = 300
+
+# 相似度量（可由 .env 覆蓋，也可在 collection 的 config.json 設定 "metric"）：
+# - cosine：向量先正規化成單位長度，再用內積（IndexFlatIP 等）；OpenAI embedding 本來就是單位長度
+# - l2：歐氏距離（IndexFlatL2），舊版 collection 的格式
+# 已存在的 collection 一律沿用主檔 index 的度量，只有新建 / reset 時才採用這個設定。
+METRICS = ("cosine", "l2")
+METRIC = os.getenv("VECTOR_METRIC", "cosine").lower()
+
+# === 索引策略（可由 .env 覆蓋，也可用 set_index_policy 針對單一 collection 覆寫）===
+# - flat：精確搜尋（IndexFlatL2），資料少時最準也夠快
+# - hnsw：圖索引（IndexHNSWFlat），查詢快、記憶體略多
+# - ivfpq：倒排 + 乘積量化（IndexIVFPQ），大量資料時最省記憶體
+# - auto：向量數 < VECTOR_ANN_THRESHOLD 用 flat，超過就升級成 VECTOR_ANN_KIND
+INDEX_POLICIES = ("auto", "flat", "hnsw", "ivfpq")
+INDEX_POLICY = os.getenv("VECTOR_INDEX_POLICY", "auto").lower()
+ANN_THRESHOLD = int(os.getenv("VECTOR_ANN_THRESHOLD", "50000"))
+ANN_KIND = os.getenv("VECTOR_ANN_KIND", "hnsw").lower()
+
+# HNSW / IVF 參數
+HNSW_M = int(os.getenv("VECTOR_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", "80"))
+HNSW_EF_SEARCH = int(os.getenv("VECTOR_HNSW_EF_SEARCH", "64"))
+# IVF 每次查詢掃幾個 list：越大越準、越慢。
+# 有重排時（量化 + 原始向量）實際掃 VECTOR_IVF_NPROBE × VECTOR_RERANK 個 list（不超過 nlist）：
+# 重排只能在「撈得到的候選」裡排序，候選只來自少數幾個 list 時，多取的 RERANK 倍候選
+# 大多是同一群裡 PQ 距離失準的鄰居，召回率上不去。
+# 實測（2 萬筆 64 維、nlist=512）：nprobe 固定 16 時 recall@5 約 0.4，放大到 64 約 0.7，
+# 每次查詢的時間約變成 2 倍；要更高的召回率就再調高 VECTOR_IVF_NPROBE，
+# 在意延遲的話可把 VECTOR_RERANK 設成 1（不重排）或調低 VECTOR_IVF_NPROBE。
+IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE", "16"))
+
+# === 量化（可由 .env 覆蓋，也可用 set_quantization 針對單一 collection 覆寫）===
+# base 的向量以較省記憶體的格式存放（delta 一律為原始 float32）：
+# - none：原始 float32（3072 維約 12 KB / 段落）
+# - fp16：半精度，1/2
+# - int8：8-bit 純量量化，1/4
+# - pq：乘積量化，預設每 4 維 1 byte，約 1/16（VECTOR_PQ_M 可調子量化器數量）
+# 量化後原始向量另存在 vectors.f32（磁碟，mmap 讀取），
+# 搜尋時先多取 VECTOR_RERANK 倍的候選，再用原始向量算精確距離重排（0 或 1 代表不重排）。
+QUANTIZATIONS = ("none", "fp16", "int8", "pq")
+QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none").lower()
+PQ_M = int(os.getenv("VECTOR_PQ_M", "0"))
+RERANK = int(os.getenv("VECTOR_RERANK", "4"))
+_SQ_TYPES = {"fp16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}
+
+# 指定 sources 搜尋時，若 ANN base 中符合的向量數不超過這個值，
+# 就直接對這些向量做完整比對（保證拿到完整的 top_k）
+FILTER_EXACT_MAX = int(os.getenv("VECTOR_FILTER_EXACT_MAX", "20000"))
+
+# 刪除（delete_source / replace_source）只先標記為 tombstone，搜尋時排除；
+# 已刪除的列數達到總列數的這個比例時，下一次 compaction 才真正回收空間（重新編號）
+RECLAIM_RATIO = float(os.getenv("VECTOR_RECLAIM_RATIO", "0.2"))
+
+# === 混合檢索（可由 .env 覆蓋）===
+# 有給查詢文字時，除了向量相似度，也用關鍵字索引（BM25）查一次，兩份名次以 RRF 合併：
+# - VECTOR_HYBRID=0 關閉（只用向量，也不維護關鍵字索引）
+# - VECTOR_HYBRID_DEPTH：兩邊各取前幾名來合併（至少 top_k）
+# - VECTOR_RRF_K：RRF 的平滑常數，分數 = Σ 1 / (RRF_K + 名次)
+HYBRID = os.getenv("VECTOR_HYBRID", "1") != "0"
+HYBRID_DEPTH = int(os.getenv("VECTOR_HYBRID_DEPTH", "20"))
+RRF_K = int(os.getenv("VECTOR_RRF_K", "60"))
+
+# IVFPQ 至少要有這麼多向量才能好好訓練（PQ 每個子量化器 256 個中心 × 39 筆），不足時維持 flat
+_IVF_MIN_TRAIN = 39 * 256
+
+# 每個 collection 各幾把鎖：
+# - _LOCKS：寫入端互斥（新增、compaction 拍快照、reset），也保護段檔的寫入順序
+# - _RW_LOCKS：記憶體中 index/delta/meta 的讀寫鎖；搜尋拿讀鎖，
+#   寫入端只在「套用」這一小步（delta.add + meta.extend、換上新 base）拿寫鎖，
+#   寫段檔、compaction 訓練與寫檔都在寫鎖外，所以搜尋不會卡在長時間的寫入後面，
+#   也不會看到只加了一半的批次（例如 delta 有新向量但 meta 還沒接上）
+# - _IO_LOCKS：保護主檔（index.faiss / meta.sqlite）的覆寫，避免 reset 與 compaction 互蓋
+_LOCKS: dict[str, threading.Lock] = {}
+_RW_LOCKS: dict[str, "_RWLock"] = {}
+_IO_LOCKS: dict[str, threading.Lock] = {}
+_LOCKS_GUARD = threading.Lock()
+
+
+class _RWLock:
+    """
+    讀寫鎖：多個讀者可以同時持有；寫者獨占。
+    有寫者在等時，新來的讀者先排隊，避免查詢很多時寫入一直拿不到鎖。
+    不可重入：持有讀鎖時不要再拿同一把鎖。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+def _lock(cid: str) -> threading.Lock:
+    with _LOCKS_GUARD:
+        return _LOCKS.setdefault(cid, threading.Lock())
+
+
+def _rw_lock(cid: str) -> _RWLock:
+    with _LOCKS_GUARD:
+        return _RW_LOCKS.setdefault(cid, _RWLock())
+
+
+def _io_lock(cid: str) -> threading.Lock:
+    with _LOCKS_GUARD:
+        return _IO_LOCKS.setdefault(cid, threading.Lock())
+
+
+# ==========================
+# Collection 快取（LRU + 記憶體預算）
+# ==========================
+class _CollectionCache:
+    """
+    已載入 collection 的 LRU 快取。
+
+    - 以 OrderedDict 記錄使用順序，最近用過的放在最後。
+    - 所有 collection 的常駐大小（向量 + meta）總和超過預算時，
+      從最久沒用的開始淘汰「乾淨」的 collection：
+        沒有 compaction 在跑、也沒有人正拿著鎖寫入。
+      資料在 add_embeddings 時就已經落地，淘汰後下次用到會再從磁碟載入。
+    - 提供 hits / misses / evictions 計數（見 cache_stats()）。
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._items: OrderedDict[str, dict] = OrderedDict()
+        self._guard = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, cid: str):
+        """取出 collection 並標記為最近使用；不存在回傳 None。"""
+        with self._guard:
+            obj = self._items.get(cid)
+            if obj is not None:
+                self._items.move_to_end(cid)
+            return obj
+
+    def lookup(self, cid: str, count_miss: bool = True):
+        """
+        跟 get 一樣，但同時記錄 hits / misses（在 _guard 裡加，多執行緒同時查也不會少算）。
+        count_miss=False：這次沒找到還不算 miss（例如拿鎖之後還會再查一次）。
+        """
+        with self._guard:
+            obj = self._items.get(cid)
+            if obj is not None:
+                self._items.move_to_end(cid)
+                self.hits += 1
+            elif count_miss:
+                self.misses += 1
+            return obj
+
+    def peek(self, cid: str):
+        """只看不動：不影響 LRU 順序（給內部比對物件身分用）。"""
+        with self._guard:
+            return self._items.get(cid)
+
+    def __setitem__(self, cid: str, obj: dict):
+        with self._guard:
+            # 每份放進快取的記憶體物件都有自己的編號（載入 / reset 各算一份，見 content_version）
+            obj.setdefault("incarnation", next(_INCARNATIONS))
+            self._items[cid] = obj
+            self._items.move_to_end(cid)
+
+    def __contains__(self, cid: str) -> bool:
+        with self._guard:
+            return cid in self._items
+
+    def pop(self, cid: str, default=None):
+        with self._guard:
+            return self._items.pop(cid, default)
+
+    def clear(self):
+        with self._guard:
+            self._items.clear()
+
+    def resident_bytes(self) -> int:
+        with self._guard:
+            return sum(_resident_bytes(o) for o in self._items.values())
+
+    def evict_over_budget(self, keep: str | None = None):
+        """
+        總常駐大小超過預算時，依 LRU 順序淘汰乾淨的 collection。
+        keep：正在使用的 collection，不淘汰。
+        """
+        if self.budget_bytes <= 0:
+            return
+        with self._guard:
+            sizes = {cid: _resident_bytes(o) for cid, o in self._items.items()}
+            total = sum(sizes.values())
+            for cid in list(self._items.keys()):
+                if total <= self.budget_bytes:
+                    break
+                obj = self._items[cid]
+                if cid == keep or obj.get("compacting") or _lock(cid).locked():
+                    continue
+                del self._items[cid]
+                total -= sizes[cid]
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._guard:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "collections": len(self._items),
+                "resident_bytes": sum(_resident_bytes(o) for o in self._items.values()),
+                "budget_bytes": self.budget_bytes,
+            }
+
+
 # 快取所有載入過的 collection，避免每次重複讀檔
-_COLLECTIONS: dict[str, dict] = {}
+_INCARNATIONS = itertools.count(1)
+_COLLECTIONS = _CollectionCache(int(CACHE_BUDGET_MB * 1024 * 1024))
 # 結構範例：
 # {
 #   "myCollection": {
-#       "index": faiss.IndexFlatL2,
+#       "index": faiss.IndexFlatIP,   # base：主檔的索引（列號 0 ~ nb-1）
+#       "delta": faiss.IndexFlatIP,   # delta：段檔的向量（列號 nb ~ n-1）
 #       "dim": 1536,
-#       "meta": [{"page": 1, "text": "...", "source": "..."}],
+#       "meta": _MetaView,            # 用起來像 list：len()、meta[i]、extend()
+#       "metric": "cosine",           # 相似度量（cosine 用內積 index，l2 為舊格式）
+#       "full": np.memmap | None,     # 量化時 base 的原始向量（vectors.f32，重排用）
+#       "sources": {"a.pdf": [[0, 120]]},  # 來源 → 列號範圍（過濾搜尋用）
+#       "segments": 3,                # 尚未 compaction 的段檔數
+#       "compacting": False,          # 背景 compaction 是否正在跑
+#       "mmap": False,                # base 是否為 mmap 開啟
+#       "version": 12,                # 每套用一次寫入（新增 / 刪除 / 換上新 base）就 +1
+#       "incarnation": 3,             # 這份記憶體物件的編號（重新載入、reset 後都是新的一份）
+#       "deleted": [[120, 180]],      # 已刪除、尚未回收的列號範圍（搜尋時排除）
+#       "epoch": 0,                   # 列號世代：回收空間重新編號後 +1
+#       "manifest": {...},            # 目前已提交的 manifest（主檔檔名、向量數、校驗碼…）
+#       "lex": _LexicalIndex | None,  # 關鍵字索引（BM25，混合檢索用）
 #   },
 #   ...
 # }
@@ -158,66 +457,1689 @@ _COLLECTIONS: dict[str, dict] = {}
 # ==========================
 # 共用：路徑工具
 # ==========================
+# 合法的 collectionId：只能有英數、底線、減號，長度 1~64（與 app._norm_collection_id 的規則相同）
+_CID_RE = re.compile(r"[A-Za-z0-9_\-]{1,64}")
+
+
+def is_valid_cid(cid: str | None) -> bool:
+    """cid 是否合法；不合法的 cid（例如含 ../）絕對不能拿來組路徑。"""
+    return bool(cid) and _CID_RE.fullmatch(cid) is not None
+
+
 def _paths(cid: str):
     """給定 collectionId，回傳對應資料夾及檔案路徑。"""
     root = BASE_DIR / cid
     return {
-        "root": root,
-        "index": root / "index.faiss",   # 向量索引檔
-        "meta":  root / "meta.json",     # 段落中繼資料檔
+        "root": root,
+        "index": root / "index.faiss",   # 舊版的向量索引檔名（現在是 index.<世代>.faiss，見 manifest）
+        "meta":  root / "meta.sqlite",   # 段落中繼資料（SQLite，一列一個段落，依列號查詢）
+        "meta_jsonl": root / "meta.jsonl",  # 舊版格式（一行一筆），載入時自動轉換
+        "meta_idx": root / "meta.idx",      # 舊版 meta.jsonl 的位移表
+        "legacy_meta": root / "meta.json",  # 更舊的格式（整份 JSON list），載入時自動轉換
+        "segments": root / "segments",   # append-only 段檔資料夾
+        "config": root / "config.json",  # 單一 collection 的設定（例如索引策略覆寫）
+        "sources": root / "sources.json",  # 舊版：來源檔名 → 主檔列號範圍（現在記在 manifest）
+        "vectors": root / "vectors.f32",   # 舊版的原始向量檔名（量化時保留，n×dim float32，重排用）
+        "deleted": root / "deleted.json",  # 舊版：已刪除的列號範圍（現在記在 manifest）
+        "manifest": root / "manifest.json",  # 主檔的提交點（檔名、向量數、校驗碼…）
+    }
+
+
+def _check_root(cid: str) -> Path:
+    """
+    確認 cid 的資料夾確實在 BASE_DIR 底下（解析 .. 與 symlink 之後）才回傳，否則拋出 ValueError。
+    載入、清檔、刪除整個 collection 之前都要先過這一關，避免 ../ 之類的 cid 動到資料目錄以外的檔案。
+    """
+    root = _paths(cid)["root"]
+    if root.resolve().parent != BASE_DIR.resolve():
+        raise ValueError(f"[vector_store] collectionId 不合法（不在資料目錄內）：{cid!r}")
+    return root
+
+
+def _fsync(f):
+    if FSYNC:
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path: Path):
+    """rename 之後 fsync 資料夾，確保新的檔名本身也已落地。"""
+    if not FSYNC:
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _atomic_write_bytes(path: Path, data: bytes):
+    """先寫到暫存檔（fsync）再 rename，避免寫到一半被中斷留下壞檔。"""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        _fsync(f)
+    os.replace(tmp, path)
+    _fsync_dir(path.parent)
+
+
+def _read_index(path: Path):
+    """
+    讀取 FAISS 主檔：
+    - mmap 模式且是 flat 索引時，用 IO_FLAG_MMAP_IFC 直接對應檔案（唯讀、零複製）
+    - 否則整份讀進記憶體
+    """
+    if _mmap_readable(path):
+        index = faiss.read_index(str(path), faiss.IO_FLAG_MMAP_IFC)
+    else:
+        index = faiss.read_index(str(path))
+    _tune_index(index)
+    return index
+
+
+def _use_mmap() -> bool:
+    """mmap 模式且目前的 faiss 版本支援 IO_FLAG_MMAP_IFC。"""
+    return STORAGE_MODE == "mmap" and hasattr(faiss, "IO_FLAG_MMAP_IFC")
+
+
+# flat 索引檔開頭的 fourcc（只有這類可以安全 mmap）
+_FLAT_FOURCC = {b"IxF2", b"IxFI"}
+
+
+def _mmap_readable(path: Path) -> bool:
+    """檔案是否要以 mmap 開啟：mmap 模式 + flat 索引（HNSW / IVF 一律整份讀入）。"""
+    if not _use_mmap():
+        return False
+    try:
+        with open(path, "rb") as f:
+            return f.read(4) in _FLAT_FOURCC
+    except OSError:
+        return False
+
+
+def _read_config(cid: str) -> dict:
+    """讀取 collection 的 config.json；沒有或壞掉就回傳空 dict。"""
+    path = _paths(cid)["config"]
+    if path.exists():
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            pass
+    return {}
+
+
+def _write_config(cid: str, cfg: dict):
+    p = _paths(cid)
+    p["root"].mkdir(parents=True, exist_ok=True)
+    _atomic_write_bytes(p["config"], json.dumps(cfg, ensure_ascii=False, indent=2).encode("utf-8"))
+
+
+# ==========================
+# 相似度量：cosine（內積）/ l2
+# ==========================
+def _index_metric(index) -> str:
+    """判斷 FAISS index 使用的度量。"""
+    if index is not None and index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return "cosine"
+    return "l2"
+
+
+def _config_metric(cfg: dict | None) -> str:
+    """新建 index 時要用的度量：collection 設定優先，否則用全域的 VECTOR_METRIC。"""
+    metric = (cfg or {}).get("metric") or METRIC
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}（可用：{', '.join(METRICS)}）")
+    return metric
+
+
+def _faiss_metric(metric: str) -> int:
+    return faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2
+
+
+def _flat_index(dim: int, metric: str):
+    """建立空的 flat index（delta 與小型 base 都用這個）。"""
+    return faiss.IndexFlatIP(dim) if metric == "cosine" else faiss.IndexFlatL2(dim)
+
+
+def _prepare_vectors(arr: np.ndarray, metric: str) -> np.ndarray:
+    """cosine 模式下把向量正規化成單位長度（新增與查詢都要做）。"""
+    arr = np.ascontiguousarray(arr, dtype="float32")
+    if metric == "cosine":
+        arr = arr.copy()
+        faiss.normalize_L2(arr)
+    return arr
+
+
+def _as_distance(index, D: np.ndarray) -> np.ndarray:
+    """
+    把 FAISS 回傳的 D 統一成「越小越相似」，方便 base / delta / 分塊結果一起排序。
+    內積（越大越相似）取負號；沒有結果的位置（-FLT_MAX）會變成極大值，自然排在最後。
+    """
+    return -D if index.metric_type == faiss.METRIC_INNER_PRODUCT else D
+
+
+def _to_score(D: np.ndarray, metric: str) -> np.ndarray:
+    """
+    把內部距離轉成相似度分數（越大越相似）：
+    - cosine：就是內積，也就是 cosine 相似度
+    - l2：單位向量下 ‖a-b‖² = 2 - 2·cos，換算回 cosine，
+      讓舊的 L2 collection 與新的 cosine collection 分數可以互相比較
+    """
+    if metric == "cosine":
+        return -D
+    return 1.0 - D / 2.0
+
+
+# ==========================
+# 索引種類：選擇、建立與升級
+# ==========================
+def _index_kind(index) -> str:
+    """判斷 FAISS index 的種類：flat / hnsw / ivfpq。"""
+    if index is None:
+        return "flat"
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivfpq"
+    return "flat"
+
+
+def _target_kind(obj: dict, n: int) -> str:
+    """依 collection 的策略（覆寫優先，否則用全域設定）與向量數決定 base 應該用哪種索引。"""
+    policy = (obj.get("config") or {}).get("index_policy") or INDEX_POLICY
+    kind = policy
+    if policy == "auto":
+        kind = ANN_KIND if n >= ANN_THRESHOLD else "flat"
+    if kind == "ivfpq" and n < _IVF_MIN_TRAIN:
+        return "flat"
+    return kind
+
+
+def _tune_index(index):
+    """套用查詢參數（efSearch / nprobe），讀檔或新建後都要設一次。"""
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVF_NPROBE
+
+
+def _ivf_nprobe(index, rerank: bool) -> int:
+    """IVF 查詢要掃的 list 數：有重排時跟著 RERANK 放大（見 IVF_NPROBE 的說明）。"""
+    nprobe = IVF_NPROBE * RERANK if rerank else IVF_NPROBE
+    return max(1, min(nprobe, index.nlist))
+
+
+def _pq_m(dim: int) -> int:
+    """IVFPQ 的子量化器數量：取能整除 dim 的最大值（最多 64）。"""
+    for m in (64, 48, 32, 24, 16, 12, 8, 4, 2):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def _index_quant(index) -> str:
+    """判斷 index 儲存向量的量化方式：none / fp16 / int8 / pq。"""
+    if index is None:
+        return "none"
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return "int8" if index.sq.qtype == faiss.ScalarQuantizer.QT_8bit else "fp16"
+    if isinstance(index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    return "none"
+
+
+def _is_lossy(index) -> bool:
+    """index 裡的向量是否為近似值（量化過）；是的話原始向量另存在 vectors.f32 供重排。"""
+    return _index_quant(index) != "none"
+
+
+def _target_quant(obj: dict, kind: str, n: int) -> str:
+    """依 collection 設定（覆寫優先，否則用全域設定）決定 base 的量化方式。"""
+    if kind == "ivfpq":
+        return "pq"
+    if n == 0:
+        return "none"
+    quant = (obj.get("config") or {}).get("quantization") or QUANTIZATION
+    if quant not in QUANTIZATIONS:
+        return "none"
+    if quant == "pq" and (kind == "hnsw" or n < _IVF_MIN_TRAIN):
+        # PQ 訓練資料不足時先用 int8；
+        # HNSW 搭配 PQ storage 在內積度量下建圖不穩定（召回率會掉很多），也改用 int8
+        return "int8"
+    return quant
+
+
+def _flat_pq_m(dim: int) -> int:
+    """flat（IndexPQ）用的 PQ 子量化器數量：預設每 4 維一個（約 16 倍壓縮）。"""
+    m = PQ_M or max(1, dim // 4)
+    while m > 1 and dim % m:
+        m -= 1
+    return m
+
+
+def _training_sample(vectors: np.ndarray, cap: int) -> np.ndarray:
+    """訓練樣本最多取 cap 筆（固定亂數種子，結果可重現）。"""
+    n = len(vectors)
+    if n <= cap:
+        return vectors
+    rows = np.random.default_rng(0).choice(n, cap, replace=False)
+    return vectors[np.sort(rows)]
+
+
+def _build_index(kind: str, dim: int, vectors: np.ndarray | None, metric: str = "l2", quant: str = "none"):
+    """
+    依種類、度量與量化方式建立新的 index 並加入 vectors：
+    - flat：IndexFlatL2 / IndexFlatIP；量化時為 IndexScalarQuantizer（fp16 / int8）或 IndexPQ
+    - hnsw：IndexHNSWFlat(M)；量化時為 IndexHNSWSQ
+    - ivfpq：IndexIVFPQ，nlist ≈ 4·√n，先用（抽樣的）vectors 訓練
+      資料太少無法訓練時退回 flat。
+    """
+    n = 0 if vectors is None else len(vectors)
+    mt = _faiss_metric(metric)
+
+    if kind == "hnsw":
+        if quant in _SQ_TYPES:
+            index = faiss.IndexHNSWSQ(dim, _SQ_TYPES[quant], HNSW_M, mt)
+        else:
+            index = faiss.IndexHNSWFlat(dim, HNSW_M, mt)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        cap = 65536
+    elif kind == "ivfpq" and n >= _IVF_MIN_TRAIN:
+        nlist = max(16, min(int(4 * np.sqrt(n)), n // 39, 65536))
+        quantizer = _flat_index(dim, metric)
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m(dim), 8, mt)
+        # 訓練樣本最多取 256·nlist 筆就夠了
+        cap = 256 * nlist
+    elif quant in _SQ_TYPES:
+        index = faiss.IndexScalarQuantizer(dim, _SQ_TYPES[quant], mt)
+        cap = 65536
+    elif quant == "pq":
+        index = faiss.IndexPQ(dim, _flat_pq_m(dim), 8, mt)
+        cap = 65536
+    else:
+        index = _flat_index(dim, metric)
+        cap = 0
+
+    if not index.is_trained and n:
+        index.train(_training_sample(vectors, cap))
+    _tune_index(index)
+    if n:
+        index.add(vectors)
+    return index
+
+
+def _reconstruct_all(index) -> np.ndarray | None:
+    """取回 index 內所有向量（IVFPQ 為量化後的近似值）。"""
+    if index is None or index.ntotal == 0:
+        return None
+    if isinstance(index, faiss.IndexIVF):
+        # 在副本上建 direct map，不動到正在服務查詢的 index
+        index = faiss.clone_index(index)
+        index.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def _merge_base(
+    base,
+    delta_vecs: np.ndarray | None,
+    kind: str,
+    dim: int,
+    metric: str,
+    quant: str = "none",
+    base_vecs: np.ndarray | None = None,
+):
+    """
+    產生新的 base：
+    - 種類與量化方式都不變，且需要訓練或建圖（HNSW / IVFPQ / 量化）
+      → 複製舊 base 再加入 delta，不用重新訓練
+    - 種類或量化方式改變（升級 / 降級）或單純 flat → 取回全部向量重新建立
+      （有原始向量 base_vecs 就用它，避免從量化後的近似值重建）
+    """
+    if (
+        base is not None
+        and base.ntotal
+        and (kind != "flat" or quant != "none")
+        and _index_kind(base) == kind
+        and _index_quant(base) == quant
+    ):
+        new_index = faiss.clone_index(base)
+        _tune_index(new_index)
+        if delta_vecs is not None:
+            new_index.add(delta_vecs)
+        return new_index
+
+    if base_vecs is None:
+        base_vecs = _reconstruct_all(base)
+    parts = [v for v in (base_vecs, delta_vecs) if v is not None]
+    vectors = np.concatenate(parts) if parts else None
+    return _build_index(kind, dim, vectors, metric, quant)
+
+
+def _needs_rebuild(obj: dict) -> bool:
+    """base 的索引種類或量化方式是否跟設定要求的不一樣（需要背景升級 / 降級）。"""
+    if obj.get("index") is None:
+        return False
+    n = _ntotal(obj)
+    if n == 0:
+        return False
+    kind = _target_kind(obj, n)
+    return _index_kind(obj["index"]) != kind or _index_quant(obj["index"]) != _target_quant(obj, kind, n)
+
+
+# ==========================
+# 原始向量（vectors.f32）：量化時保留，用來重排與重建
+# ==========================
+def _open_full_vectors(path: Path, dim: int, n: int):
+    """以 mmap 開啟前 n 筆原始向量；檔案不存在或筆數不足就回傳 None。"""
+    if n == 0 or not path.exists() or path.stat().st_size < n * dim * 4:
+        return None
+    return np.memmap(path, dtype="float32", mode="r", shape=(n, dim))
+
+
+def _write_full_vectors(path: Path, start: int, dim: int, arr: np.ndarray | None):
+    """
+    把 arr 寫成第 start 筆起的原始向量：
+    - start > 0：截掉 start 之後的舊資料再接上（前面的內容不動，正在用的 mmap 仍有效）
+    - start == 0：寫到暫存檔再 rename（舊檔可能還被 mmap 著）
+    """
+    data = b"" if arr is None else np.ascontiguousarray(arr, dtype="float32").tobytes()
+    if start == 0:
+        _atomic_write_bytes(path, data)
+        return
+    with open(path, "r+b") as f:
+        f.truncate(start * dim * 4)
+        f.seek(0, os.SEEK_END)
+        f.write(data)
+        _fsync(f)
+
+
+# ==========================
+# 段落 meta：分頁讀取
+# ==========================
+class _SqliteMeta:
+    """
+    主檔 meta（meta.sqlite）的唯讀存取器。
+
+    - 一列一個段落：row 為主鍵（= 向量在 index 中的列號），
+      常用欄位 text / source / page 各自一欄，其餘欄位收進 extra（JSON）。
+    - 要第 i 筆時只查它所在的那一頁（META_PAGE_ROWS 筆），
+      讀過的頁以 LRU 保留最多 META_CACHE_PAGES 頁，不會整份載入。
+    - n：只看前 n 列（以 index 的向量數為準，多出來的列不採用）。
+    - table：manifest 記錄的 meta 表名（回收空間後會換成新的表）。
+    """
+
+    def __init__(self, path: Path, n: int, table: str = "meta"):
+        self.path = path
+        self.n = n
+        self.table = table
+        self._conn = _connect_meta(path)
+        # 搜尋可能在多個執行緒同時讀同一頁：連線與分頁快取都用這把鎖保護
+        self._conn_lock = threading.RLock()
+        self._pages: OrderedDict[int, tuple[list[dict], int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return self.n
+
+    def _query(self, sql: str, args: tuple = ()) -> list[tuple]:
+        with self._conn_lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def _page(self, pno: int) -> list[dict]:
+        with self._conn_lock:
+            return self._load_page(pno)
+
+    def _load_page(self, pno: int) -> list[dict]:
+        hit = self._pages.get(pno)
+        if hit is not None:
+            self._pages.move_to_end(pno)
+            return hit[0]
+
+        lo = pno * META_PAGE_ROWS
+        hi = min(lo + META_PAGE_ROWS, self.n)
+        page: list[dict] = [{} for _ in range(hi - lo)]
+        nbytes = 0
+        for row in self._query(
+            f"SELECT row, text, source, page, extra FROM {self.table} WHERE row >= ? AND row < ? ORDER BY row",
+            (lo, hi),
+        ):
+            m = _row_to_meta(row)
+            page[row[0] - lo] = m
+            nbytes += _meta_row_bytes(m)
+
+        self._pages[pno] = (page, nbytes)
+        while META_CACHE_PAGES and len(self._pages) > META_CACHE_PAGES:
+            self._pages.popitem(last=False)
+        return page
+
+    def __getitem__(self, i: int) -> dict:
+        i = int(i)   # FAISS 回傳的是 numpy 整數，sqlite 無法直接綁定
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return self._page(i // META_PAGE_ROWS)[i % META_PAGE_ROWS]
+
+    def rows(self, lo: int, hi: int) -> list[dict]:
+        """直接讀 [lo, hi) 的 meta（不經過分頁快取，給一次性的整批搬移用）。"""
+        out: list[dict] = [{} for _ in range(max(hi - lo, 0))]
+        for row in self._query(
+            f"SELECT row, text, source, page, extra FROM {self.table} WHERE row >= ? AND row < ? ORDER BY row",
+            (lo, hi),
+        ):
+            out[row[0] - lo] = _row_to_meta(row)
+        return out
+
+    def close(self):
+        """關閉連線（回收空間換掉 meta.sqlite 之前呼叫；之後不能再讀）。"""
+        with self._conn_lock:
+            self._conn.close()
+            self._pages.clear()
+
+    def sources(self) -> list[tuple[int, str]]:
+        """依列號順序回傳 (row, source)（建立來源範圍表用，不會把 text 讀進來）。"""
+        return self._query(
+            f"SELECT row, source FROM {self.table} WHERE row < ? AND source IS NOT NULL ORDER BY row",
+            (self.n,),
+        )
+
+    def nbytes(self) -> int:
+        """已讀入記憶體的分頁大小（文字 UTF-8 長度 + 每筆 dict 開銷）。"""
+        return sum(nbytes for _, nbytes in list(self._pages.values()))
+
+
+class _MetaView:
+    """
+    把「主檔 meta（分頁）」與「段檔 meta（list）」接成一個像 list 的物件。
+    - len(view)、view[i]、for m in view 都跟原本的 list 一樣用
+    - extend() 只會加到段檔那一段
+    """
+
+    def __init__(self, base: _SqliteMeta | None = None, tail: list[dict] | None = None):
+        self.base = base
+        self.tail = tail if tail is not None else []
+        self._tail_bytes = sum(_meta_row_bytes(m) for m in self.tail)
+
+    def _nbase(self) -> int:
+        return len(self.base) if self.base is not None else 0
+
+    def __len__(self) -> int:
+        return self._nbase() + len(self.tail)
+
+    def __getitem__(self, i: int) -> dict:
+        nb = self._nbase()
+        if i < 0:
+            i += len(self)
+        if 0 <= i < nb:
+            return self.base[i]
+        return self.tail[i - nb]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def rows(self, lo: int, hi: int):
+        """依序讀出 [lo, hi) 的 meta（主檔的部分分批直接查 sqlite，不經過分頁快取）。"""
+        nb = self._nbase()
+        for a in range(lo, min(hi, nb), META_PAGE_ROWS):
+            yield from self.base.rows(a, min(a + META_PAGE_ROWS, hi, nb))
+        if hi > nb:
+            yield from self.tail[max(lo, nb) - nb:hi - nb]
+
+    def extend(self, metas: list[dict]):
+        self.tail.extend(metas)
+        self._tail_bytes += sum(_meta_row_bytes(m) for m in metas)
+
+    def nbytes(self) -> int:
+        """估算目前常駐在記憶體的 meta 大小（已讀入的分頁 + 段檔 meta）。"""
+        n = self._tail_bytes
+        if self.base is not None:
+            n += self.base.nbytes()
+        return n
+
+
+def _meta_row_bytes(m: dict) -> int:
+    """粗估一筆 meta 在記憶體中的大小：文字的 UTF-8 長度 + dict 物件開銷。"""
+    return len((m.get("text") or "").encode("utf-8")) + _META_ROW_OVERHEAD
+
+
+# meta.sqlite 的欄位：常用欄位獨立一欄，其餘收進 extra
+_META_COLUMNS = ("text", "source", "page")
+_META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    row    INTEGER PRIMARY KEY,
+    text   TEXT,
+    source TEXT,
+    page,
+    extra  TEXT
+)
+"""
+
+
+def _connect_meta(path: Path) -> sqlite3.Connection:
+    """開啟 meta.sqlite（WAL 模式：compaction 寫入時，搜尋仍可同時讀取）。"""
+    conn = sqlite3.connect(str(path), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(_META_SCHEMA.format(table="meta"))
+    return conn
+
+
+def _meta_to_row(row: int, m: dict) -> tuple:
+    extra = {k: v for k, v in m.items() if k not in _META_COLUMNS}
+    return (
+        row,
+        m.get("text"),
+        m.get("source"),
+        m.get("page"),
+        json.dumps(extra, ensure_ascii=False) if extra else None,
+    )
+
+
+def _row_to_meta(row: tuple) -> dict:
+    _, text, source, page, extra = row
+    m = {}
+    if page is not None:
+        m["page"] = page
+    if text is not None:
+        m["text"] = text
+    if source is not None:
+        m["source"] = source
+    if extra:
+        m.update(json.loads(extra))
+    return m
+
+
+def _write_meta_rows(path: Path, start: int, metas, table: str = "meta") -> int:
+    """
+    把 metas 寫成第 start 列起的主檔 meta（同一個 transaction）：
+    - 先刪掉 row >= start 的舊資料（上次寫到一半、或 reset 前留下的）
+    - 舊主檔的前 start 列完全不動，不用整份重寫
+    - table：寫到哪一張表（manifest 記錄的 meta 表；回收空間 / reset 時是新的 meta_<世代>）
+    回傳寫入的筆數。
+    """
+    conn = _connect_meta(path)
+    try:
+        with conn:
+            conn.execute(_META_SCHEMA.format(table=table))
+            conn.execute(f"DELETE FROM {table} WHERE row >= ?", (start,))
+            n = 0
+            batch = []
+            for m in metas:
+                batch.append(_meta_to_row(start + n, m))
+                n += 1
+                if len(batch) >= 1000:
+                    conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?)", batch)
+                    batch = []
+            if batch:
+                conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?)", batch)
+        return n
+    finally:
+        conn.close()
+
+
+def _meta_rows(path: Path, table: str = "meta") -> int:
+    """meta 表目前的列數（max(row)+1，走主鍵不用掃表）。"""
+    conn = _connect_meta(path)
+    try:
+        conn.execute(_META_SCHEMA.format(table=table))
+        (mx,) = conn.execute(f"SELECT MAX(row) FROM {table}").fetchone()
+        return 0 if mx is None else int(mx) + 1
+    finally:
+        conn.close()
+
+
+def _open_meta_base(p: dict, nb: int, table: str = "meta") -> _SqliteMeta | None:
+    """開啟主檔 meta，只採用前 nb 列（以 index 的向量數為準）。"""
+    if not p["meta"].exists():
+        return None
+    try:
+        return _SqliteMeta(p["meta"], min(nb, _meta_rows(p["meta"], table)), table)
+    except sqlite3.Error:
+        return None
+
+
+def _iter_jsonl(path: Path):
+    with open(path, "r", encoding="utf-8") as f:
+        for ln in f:
+            if ln.strip():
+                yield json.loads(ln)
+
+
+def _migrate_legacy_meta(p: dict):
+    """
+    舊版格式 → meta.sqlite，只在第一次載入舊 collection 時做一次：
+    - meta.json（整份 JSON list）
+    - meta.jsonl + meta.idx（一行一筆 + 位移表）
+    先寫到暫存檔再 rename，轉到一半中斷不會留下半份資料。
+    """
+    if p["legacy_meta"].exists():
+        try:
+            metas = json.loads(p["legacy_meta"].read_text(encoding="utf-8"))
+        except Exception:
+            metas = []
+        olds = [p["legacy_meta"]]
+    elif p["meta_jsonl"].exists():
+        metas = _iter_jsonl(p["meta_jsonl"])
+        olds = [p["meta_jsonl"], p["meta_idx"]]
+    else:
+        return
+
+    tmp = p["meta"].with_name(p["meta"].name + ".tmp")
+    for f in (tmp, tmp.with_name(tmp.name + "-wal"), tmp.with_name(tmp.name + "-shm")):
+        f.unlink(missing_ok=True)
+    _write_meta_rows(tmp, 0, metas)
+    os.replace(tmp, p["meta"])
+    for f in olds:
+        f.unlink(missing_ok=True)
+
+
+def _index_header_ntotal(path: Path) -> int | None:
+    """
+    只讀 index.faiss 的檔頭取得向量數（不載入 index）。
+    FAISS 所有索引的檔頭都是：fourcc(4) + d(int32) + ntotal(int64) ...
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(16)
+        return int(np.frombuffer(head[8:16], dtype="<i8")[0]) if len(head) == 16 else None
+    except OSError:
+        return None
+
+
+# ==========================
+# 關鍵字索引（BM25）：混合檢索用
+# ==========================
+# 藥名、ICD 代碼、劑量這類「字面要一樣」的詞，向量相似度常常抓不到。
+# 每個 collection 在 meta.sqlite 另有一張 FTS5 全文索引表（rowid = 列號）：
+# - 斷詞：中日韓文字切成相鄰兩字（bigram），英文 / 數字以整個單字為單位（保留 e11.9、5-ht3 這類寫法）
+# - 新增時跟段檔一起增量寫入；載入時若跟列數對不起來（寫到一半中斷、舊版 collection）就從 meta 補齊
+# - 表名跟著列號世代走（lex、lex_1…）：reset / 回收空間會換一張新的，舊的由 _collect_garbage 清掉
+# 排序用 FTS5 內建的 bm25()，不需要額外的 API 呼叫。
+_LEX_TOKEN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[0-9a-z]+(?:[.\-][0-9a-z]+)*")
+_LEX_TABLE_RE = re.compile(r"^lex(_\d+)?$")
+_LEX_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+    "tokens, tokenize = \"unicode61 remove_diacritics 0 tokenchars '.-'\")"
+)
+# 查詢最多用幾個不重複的詞（很長的問題也不會變成超大的 OR 查詢）
+_LEX_MAX_QUERY_TOKENS = 64
+# 列號範圍太零碎時不寫進 SQL，改成查完再過濾
+_LEX_MAX_SQL_RANGES = 32
+
+
+def _lex_tokens(text: str | None) -> list[str]:
+    """斷詞：先全形轉半形、轉小寫；中日韓文字 → 相鄰兩字，英文 / 數字 → 整個單字。"""
+    out: list[str] = []
+    for m in _LEX_TOKEN_RE.finditer(unicodedata.normalize("NFKC", text or "").lower()):
+        w = m.group()
+        if w[0] >= "\u3400":
+            out.extend([w] if len(w) == 1 else [w[i:i + 2] for i in range(len(w) - 1)])
+        else:
+            out.append(w)
+    return out
+
+
+def _lex_table(epoch: int) -> str:
+    return "lex" if not epoch else f"lex_{epoch}"
+
+
+class _LexicalIndex:
+    """
+    單一 collection（單一列號世代）的關鍵字索引，存在 meta.sqlite 的 FTS5 表。
+    新增與搜尋可能在不同執行緒：連線用鎖保護。
+    """
+
+    def __init__(self, path: Path, table: str):
+        self.path = path
+        self.table = table
+        self._conn = _connect_meta(path)
+        self._conn.execute(_LEX_SCHEMA.format(table=table))
+        self._lock = threading.Lock()
+
+    def add(self, start: int, metas) -> int:
+        """
+        把 metas 寫成第 start 列起的索引（同一個 transaction）：
+        先刪掉 row >= start 的舊資料（上次寫到一半留下的），再寫入。回傳寫入的筆數。
+        """
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE rowid >= ?", (start,))
+            n = 0
+            batch = []
+            for m in metas:
+                batch.append((start + n, " ".join(_lex_tokens(m.get("text")))))
+                n += 1
+                if len(batch) >= 1000:
+                    self._conn.executemany(f"INSERT INTO {self.table}(rowid, tokens) VALUES (?, ?)", batch)
+                    batch = []
+            if batch:
+                self._conn.executemany(f"INSERT INTO {self.table}(rowid, tokens) VALUES (?, ?)", batch)
+        return n
+
+    def sync(self, meta: _MetaView, n: int):
+        """載入時對齊列數：多出來的列刪掉，缺的列從 meta 補上（舊版 collection 第一次載入就是整份建立）。"""
+        with self._lock:
+            cnt, top = self._conn.execute(f"SELECT count(*), max(rowid) FROM {self.table}").fetchone()
+        top = -1 if top is None else top
+        # 索引一律從 0 連續寫入；中間有洞代表不一致 → 整份重建
+        start = min(top + 1, n) if cnt == top + 1 else 0
+        if start == n and top < n:
+            return
+        if n - start > 10000:
+            print(f"[vector_store] 建立關鍵字索引 {self.table}：{n - start} 列")
+        self.add(start, meta.rows(start, n))
+
+    def search(self, tokens: list[str], k: int, ranges: list[tuple[int, int]]) -> list[tuple[int, float]]:
+        """BM25 查詢，只回傳落在 ranges 內的列：[(列號, 分數)]，分數越大越相關。"""
+        terms = list(dict.fromkeys(tokens))[:_LEX_MAX_QUERY_TOKENS]
+        if not terms or not ranges or k <= 0:
+            return []
+        match = " OR ".join(f'"{t}"' for t in terms)
+        sql = f"SELECT rowid, bm25({self.table}) FROM {self.table} WHERE {self.table} MATCH ?"
+
+        if len(ranges) <= _LEX_MAX_SQL_RANGES:
+            sql += " AND (" + " OR ".join("(rowid >= ? AND rowid < ?)" for _ in ranges) + ") ORDER BY rank LIMIT ?"
+            args = [match] + [x for r in ranges for x in r] + [k]
+            with self._lock:
+                return [(row, -score) for row, score in self._conn.execute(sql, args).fetchall()]
+
+        # 範圍很零碎（例如刪除很多次）→ 依分數讀出，再用二分搜尋過濾，湊滿 k 筆就停
+        starts = [a for a, _ in ranges]
+        out = []
+        with self._lock:
+            for row, score in self._conn.execute(sql + " ORDER BY rank", (match,)):
+                j = bisect.bisect_right(starts, row) - 1
+                if j >= 0 and row < ranges[j][1]:
+                    out.append((row, -score))
+                    if len(out) >= k:
+                        break
+        return out
+
+
+def _open_lexical(cid: str, epoch: int, meta: _MetaView, n: int) -> _LexicalIndex | None:
+    """開啟（必要時補齊）collection 目前世代的關鍵字索引；關閉混合檢索時回傳 None。"""
+    if not HYBRID:
+        return None
+    p = _paths(cid)
+    p["root"].mkdir(parents=True, exist_ok=True)
+    lex = _LexicalIndex(p["meta"], _lex_table(epoch))
+    lex.sync(meta, n)
+    return lex
+
+
+def _reset_lexical(cid: str, epoch: int) -> _LexicalIndex | None:
+    """建立世代 epoch 的空白關鍵字索引（reset / 回收空間用；同名的舊表先丟掉）。"""
+    if not HYBRID:
+        return None
+    p = _paths(cid)
+    p["root"].mkdir(parents=True, exist_ok=True)
+    conn = _connect_meta(p["meta"])
+    try:
+        conn.execute(f"DROP TABLE IF EXISTS {_lex_table(epoch)}")
+    finally:
+        conn.close()
+    return _LexicalIndex(p["meta"], _lex_table(epoch))
+
+
+# ==========================
+# 段檔（segments）：manifest 之後的新增（WAL）
+# ==========================
+def _segments_dir(cid: str, epoch: int = 0) -> Path:
+    """
+    段檔資料夾：每個列號世代各一個（世代 0 沿用 segments/，之後是 segments.<世代>/）。
+    reset / 回收空間會換世代：新世代的段檔寫在新資料夾，manifest 提交後舊資料夾整個丟掉。
+    """
+    seg = _paths(cid)["segments"]
+    return seg if not epoch else seg.with_name(f"segments.{epoch}")
+
+
+def _segment_files(cid: str, epoch: int = 0) -> list[tuple[int, Path, Path]]:
+    """
+    列出 collection（某個列號世代）的所有段檔，依起始列號排序。
+
+    回傳：[(起始列號, 向量檔 .npy, meta 檔 .jsonl), ...]
+    """
+    seg_dir = _segments_dir(cid, epoch)
+    if not seg_dir.exists():
+        return []
+
+    out = []
+    for vec_path in seg_dir.glob("*.npy"):
+        try:
+            start = int(vec_path.stem)
+        except ValueError:
+            continue
+        out.append((start, vec_path, vec_path.with_suffix(".jsonl")))
+    out.sort(key=lambda x: x[0])
+    return out
+
+
+def _replace_path(vec_path: Path) -> Path:
+    """段檔的取代記錄（<起始列號>.replace.json）：這批是 replace_source 寫的，記下被取代的來源。"""
+    return vec_path.with_suffix(".replace.json")
+
+
+def _write_segment(
+    cid: str, start: int, arr: np.ndarray, metas: list[dict], epoch: int = 0, replace: str | None = None,
+):
+    """
+    把一批新增的向量與 meta 寫成一組段檔（只寫這一批，不動主檔）。
+
+    - 先寫 .jsonl 再寫 .npy（兩個都 fsync）；.npy 以 rename 落地，
+      所以載入時「.npy 存在」就代表這組段檔是完整的。
+    - replace：這批是取代某個來源 → 在 .npy 落地前先寫好取代記錄，
+      「刪掉舊列」跟「加入新列」就跟著同一個 rename 一起提交，重播時一起套用
+      （不然在 manifest 寫入刪除範圍之前中斷，載入後新舊兩份都還在）。
+    """
+    seg_dir = _segments_dir(cid, epoch)
+    seg_dir.mkdir(parents=True, exist_ok=True)
+
+    stem = f"{start:012d}"
+    meta_path = seg_dir / f"{stem}.jsonl"
+    vec_path = seg_dir / f"{stem}.npy"
+
+    lines = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in metas)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        f.write(lines)
+        _fsync(f)
+
+    rep_path = _replace_path(vec_path)
+    if replace is not None:
+        with open(rep_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"source": replace}, ensure_ascii=False))
+            _fsync(f)
+    else:
+        # 同一個起始列號上次寫到一半留下的取代記錄，不能算到這一批頭上
+        rep_path.unlink(missing_ok=True)
+
+    tmp = seg_dir / f"{stem}.npy.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, arr)
+        _fsync(f)
+    os.replace(tmp, vec_path)
+    _fsync_dir(seg_dir)
+
+
+def _read_replace(vec_path: Path) -> str | None:
+    """讀取段檔的取代記錄；沒有（一般新增）回傳 None。"""
+    try:
+        return json.loads(_replace_path(vec_path).read_text(encoding="utf-8"))["source"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _read_segment(vec_path: Path, meta_path: Path):
+    """讀取一組段檔，回傳 (向量 ndarray, meta 列表)；檔案不完整時回傳 None。"""
+    try:
+        arr = np.load(vec_path)
+        metas = [
+            json.loads(ln)
+            for ln in meta_path.read_text(encoding="utf-8").splitlines()
+            if ln.strip()
+        ]
+    except Exception:
+        return None
+    if arr.ndim != 2 or len(arr) != len(metas):
+        return None
+    return arr.astype("float32", copy=False), metas
+
+
+def _clear_segments(cid: str, upto: int | None = None, epoch: int = 0):
+    """
+    刪除段檔：
+    - upto=None：全部刪除
+    - upto=N：只刪除起始列號 < N 的段檔（已經被 compaction 併進主檔）
+    """
+    for start, vec_path, meta_path in _segment_files(cid, epoch):
+        if upto is not None and start >= upto:
+            continue
+        for fp in (vec_path, meta_path, _replace_path(vec_path)):
+            try:
+                fp.unlink()
+            except FileNotFoundError:
+                pass
+
+
+# ==========================
+# 載入與儲存
+# ==========================
+def _ntotal(obj: dict) -> int:
+    """collection 目前的總向量數（base + delta）。"""
+    n = 0
+    if obj.get("index") is not None:
+        n += obj["index"].ntotal
+    if obj.get("delta") is not None:
+        n += obj["delta"].ntotal
+    return n
+
+
+def _index_bytes(index, mmapped: bool = False) -> int:
+    """估算 FAISS index 常駐記憶體大小；mmap 的主檔由作業系統分頁管理，不計入。"""
+    if index is None or mmapped:
+        return 0
+    n = int(index.ntotal)
+    if isinstance(index, faiss.IndexHNSW):
+        # 向量（可能已量化）+ 每個節點約 2·M 條鄰居連結（int32）
+        storage = faiss.downcast_index(index.storage)
+        code_size = getattr(storage, "code_size", 0) or index.d * 4
+        return n * (int(code_size) + index.hnsw.nb_neighbors(0) * 4)
+    if isinstance(index, faiss.IndexIVF):
+        # 量化後的 code + 每筆 8 bytes 的 id
+        return n * (int(index.code_size) + 8)
+    code_size = getattr(index, "code_size", 0) or index.d * 4
+    return n * int(code_size)
+
+
+def _resident_bytes(obj: dict) -> int:
+    """collection 的常駐大小 = base + delta 向量 + 已讀入的 meta。"""
+    n = _index_bytes(obj.get("index"), obj.get("mmap", False))
+    n += _index_bytes(obj.get("delta"))
+    meta = obj.get("meta")
+    if meta is not None:
+        n += meta.nbytes()
+    return n
+
+
+# ==========================
+# 來源（source）→ 列號範圍
+# ==========================
+# 每個 collection 維護 {source: [[start, end), ...]}，
+# 同一份檔案的段落通常是一起新增的，所以範圍數量很少。
+# 指定 sources 搜尋時直接轉成 FAISS 的 IDSelector，只掃描這些列。
+
+def _add_source_ranges(ranges: dict, start: int, metas: list[dict]):
+    """把新增的一批 meta（起始列號 start）登記到 ranges（相鄰列號會合併成同一段）。"""
+    for i, m in enumerate(metas):
+        src = m.get("source")
+        if src is None:
+            continue
+        row = start + i
+        lst = ranges.setdefault(src, [])
+        if lst and lst[-1][1] == row:
+            lst[-1][1] = row + 1
+        else:
+            lst.append([row, row + 1])
+
+
+def _clip_ranges(ranges: dict, n: int) -> dict:
+    """只保留列號 < n 的部分（寫主檔時用）。"""
+    out = {}
+    for src, lst in ranges.items():
+        kept = [[a, min(b, n)] for a, b in lst if a < n]
+        if kept:
+            out[src] = kept
+    return out
+
+
+def _load_source_ranges(p: dict, base_meta: _SqliteMeta | None, nb: int) -> dict:
+    """
+    讀取主檔的 sources.json；
+    舊 collection 沒有這個檔時，掃一次主檔 meta 建立並寫回（之後就不用再掃）。
+    """
+    if p["sources"].exists():
+        try:
+            return _clip_ranges(json.loads(p["sources"].read_text(encoding="utf-8")), nb)
+        except Exception:
+            pass
+
+    ranges: dict = {}
+    if base_meta is not None and nb:
+        # 只讀 source 欄，不用把段落文字讀進來
+        for row, src in base_meta.sources():
+            _add_source_ranges(ranges, row, [{"source": src}])
+    try:
+        _atomic_write_bytes(p["sources"], json.dumps(ranges, ensure_ascii=False).encode("utf-8"))
+    except OSError:
+        pass
+    return ranges
+
+
+def _merge_ranges(spans) -> list[tuple[int, int]]:
+    """把一堆列號範圍合併成排序好、不重疊的範圍。"""
+    merged: list[list[int]] = []
+    for a, b in sorted((int(a), int(b)) for a, b in spans):
+        if merged and a <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    return [(a, b) for a, b in merged]
+
+
+def _selected_ranges(obj: dict, sources: list[str]) -> list[tuple[int, int]]:
+    """把多個 source 的範圍合併成一份排序好、不重疊的列號範圍。"""
+    return _merge_ranges(
+        (a, b)
+        for src in set(sources)
+        for a, b in obj["sources"].get(src, [])
+    )
+
+
+# ==========================
+# 刪除（tombstone）與空間回收
+# ==========================
+# 刪除只是把列號範圍記進 manifest（搜尋時排除），向量與 meta 都先不動；
+# 已刪除的比例達到 RECLAIM_RATIO 時，compaction 改成「只留下還活著的列」重建主檔，
+# 這時列號會重新編號（epoch +1）。
+
+def _subtract_ranges(ranges, dead: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """ranges 扣掉 dead（兩者都是排序好、不重疊的範圍）。"""
+    out = []
+    for a, b in _merge_ranges(ranges):
+        for da, db in dead:
+            if db <= a or da >= b:
+                continue
+            if da > a:
+                out.append((a, da))
+            a = max(a, db)
+            if a >= b:
+                break
+        if a < b:
+            out.append((a, b))
+    return out
+
+
+def _live_ranges(obj: dict) -> list[tuple[int, int]]:
+    """collection 中還沒被刪除的列號範圍。"""
+    return _subtract_ranges([(0, _ntotal(obj))], obj.get("deleted") or [])
+
+
+def _dead_count(obj: dict) -> int:
+    return sum(b - a for a, b in obj.get("deleted") or [])
+
+
+def _needs_reclaim(obj: dict) -> bool:
+    """已刪除的列數是否多到值得回收空間。"""
+    dead = _dead_count(obj)
+    return dead > 0 and dead >= RECLAIM_RATIO * max(_ntotal(obj), 1)
+
+
+def _row_shift(dead: list[tuple[int, int]]):
+    """回收 dead 之後的列號對應：舊列號 x → x - (x 之前被刪掉的列數)。"""
+    starts = np.array([a for a, _ in dead], dtype=np.int64)
+    ends = np.array([b for _, b in dead], dtype=np.int64)
+
+    def shift(x: int) -> int:
+        return int(x - np.clip(x - starts, 0, ends - starts).sum())
+
+    return shift
+
+
+def _read_deleted(p: dict) -> tuple[int, list[tuple[int, int]]]:
+    """讀取舊版的 deleted.json，回傳 (列號世代, 已刪除範圍)（沒有 manifest 的 collection 才會用到）。"""
+    try:
+        d = json.loads(p["deleted"].read_text(encoding="utf-8"))
+        return int(d.get("epoch", 0)), _merge_ranges(d.get("ranges") or [])
+    except (OSError, ValueError):
+        return 0, []
+
+
+def _write_deleted(cid: str, obj: dict):
+    """把目前的已刪除範圍寫進 manifest（主檔本身不動）；呼叫端持有 _lock(cid)。"""
+    man = _new_manifest(obj.get("manifest"), deleted=[list(r) for r in obj.get("deleted") or []])
+    _write_manifest(cid, man)
+    obj["manifest"] = man
+
+
+def _reclaim_collection(cid: str, obj: dict):
+    """
+    回收空間：只留下還活著的列，重建主檔（index / meta / 原始向量），列號重新編號。
+    - 跟一般 compaction 一樣：鎖內拍快照、鎖外重建
+    - 新主檔都寫成新的檔名 / 新的 meta 表，快照之後才新增的列以新列號寫成新世代的段檔，
+      最後寫入 manifest 才算提交（提交前中斷，載入時仍是舊主檔 + 舊段檔）
+    - 提交後在寫鎖內換上新的 base，舊檔、舊表與舊世代的段檔再清掉
+    """
+    with _lock(cid):
+        if _COLLECTIONS.peek(cid) is not obj or not _needs_reclaim(obj):
+            return
+        base, delta = obj["index"], obj["delta"]
+        dim, metric = obj["dim"], obj["metric"]
+        nb, nd = base.ntotal, delta.ntotal
+        n = nb + nd
+        dead = list(obj["deleted"])
+        live = _subtract_ranges([(0, n)], dead)
+        n_live = sum(b - a for a, b in live)
+        delta_vecs = delta.reconstruct_n(0, nd) if nd else None
+        delta_metas = list(obj["meta"].tail[:nd])
+        base_meta = obj["meta"].base
+        base_full = obj.get("full")
+        obj["segments"] = 0
+        kind = _target_kind(obj, n_live)
+        quant = _target_quant(obj, kind, n_live)
+        gen = int((obj.get("manifest") or {}).get("generation") or 0) + 1
+        epoch = obj.get("epoch", 0) + 1
+
+    # 只留下活著的向量重建（有原始向量就用原始向量）
+    keep_full = base_full is not None or nb == 0 or not _is_lossy(base)
+    base_vecs = np.asarray(base_full) if base_full is not None else (_reconstruct_all(base) if nb else None)
+    parts = [v for v in (base_vecs, delta_vecs) if v is not None]
+    vectors = np.concatenate(parts) if parts else np.zeros((0, dim), dtype="float32")
+    vectors = np.concatenate([vectors[a:b] for a, b in live]) if live else vectors[:0]
+    new_index = _build_index(kind, dim, vectors if n_live else None, metric, quant)
+
+    def _live_metas():
+        for a, b in live:
+            if a < nb:
+                yield from base_meta.rows(a, min(b, nb)) if base_meta is not None else [{}] * (min(b, nb) - a)
+            if b > nb:
+                yield from delta_metas[max(a, nb) - nb:b - nb]
+
+    p = _paths(cid)
+    root = p["root"]
+    table = f"meta_{gen}"
+    index_name = f"index.{gen:06d}.faiss"
+    vectors_name = f"vectors.{gen:06d}.f32" if _is_lossy(new_index) and keep_full else None
+    with _io_lock(cid):
+        if _COLLECTIONS.peek(cid) is not obj:
+            return
+        # meta 寫到同一個 meta.sqlite 的新表（搜尋照常讀舊表）
+        _write_meta_rows(p["meta"], 0, _live_metas(), table=table)
+        new_lex = _reset_lexical(cid, epoch)
+        if new_lex is not None:
+            new_lex.add(0, _live_metas())
+        if vectors_name:
+            _write_full_vectors(root / vectors_name, 0, dim, vectors)
+        data = faiss.serialize_index(new_index).tobytes()
+        checksum = _bytes_checksum(data)
+        _atomic_write_bytes(root / index_name, data)
+        if _mmap_readable(root / index_name):
+            new_index = _read_index(root / index_name)
+
+        with _lock(cid):
+            if _COLLECTIONS.peek(cid) is not obj:
+                return
+            shift = _row_shift(dead)
+            # 快照之後才新增的向量留在新的 delta；來源範圍與之後的刪除都換成新列號
+            rest = obj["delta"].ntotal - nd
+            rest_vecs = obj["delta"].reconstruct_n(nd, rest) if rest > 0 else None
+            new_delta = _flat_index(dim, metric)
+            if rest_vecs is not None:
+                new_delta.add(rest_vecs)
+            new_sources = {
+                src: [[shift(a), shift(b)] for a, b in lst]
+                for src, lst in obj["sources"].items()
+            }
+            new_dead = [(shift(a), shift(b)) for a, b in _subtract_ranges(obj["deleted"], dead)]
+            tail = obj["meta"].tail[nd:]
+
+            # 這些列以新列號寫成新世代的第一個段檔（提交前就寫好）
+            _clear_segments(cid, epoch=epoch)
+            if rest_vecs is not None:
+                _write_segment(cid, n_live, rest_vecs, list(tail), epoch)
+                if new_lex is not None:
+                    new_lex.add(n_live, tail)
+
+            man = _new_manifest(
+                obj.get("manifest"),
+                generation=gen,
+                ntotal=n_live,
+                index=index_name,
+                checksum=checksum,
+                vectors=vectors_name,
+                meta_table=table,
+                sources=_clip_ranges(new_sources, n_live),
+                deleted=[list(r) for r in new_dead],
+                epoch=epoch,
+            )
+            man["superseded"] = _superseded(obj.get("manifest"), man)
+            # 提交點
+            _write_manifest(cid, man)
+
+            with _rw_lock(cid).write():
+                # 沒有搜尋在跑：換上新的 base（舊的 meta 連線先關掉，之後舊表會被清掉）
+                if base_meta is not None:
+                    base_meta.close()
+                obj["index"] = new_index
+                obj["delta"] = new_delta
+                obj["mmap"] = _mmap_readable(root / index_name)
+                obj["full"] = _open_full_vectors(root / vectors_name, dim, n_live) if vectors_name else None
+                obj["meta"] = _MetaView(_open_meta_base(p, n_live, table), tail)
+                obj["sources"] = new_sources
+                obj["deleted"] = new_dead
+                obj["epoch"] = epoch
+                obj["manifest"] = man
+                obj["lex"] = new_lex
+                obj["segments"] = 1 if rest_vecs is not None else 0
+                obj["version"] = obj.get("version", 0) + 1
+
+            _collect_garbage(cid, man)
+
+
+# ==========================
+# Manifest：主檔的提交點
+# ==========================
+# manifest.json 記錄目前採用的主檔：
+#   index 檔名與校驗碼、已提交的向量數（ntotal）、meta 表名、原始向量檔名、
+#   來源範圍、已刪除範圍、列號世代（epoch，也決定段檔資料夾）
+# compaction / 回收空間都把新主檔寫成「新的檔名」，最後 rename 新的 manifest 才算提交：
+# - 提交前中斷 → 載入時仍是上一版完整的主檔，加上還沒刪的段檔（WAL）重播，資料不會少
+# - 被這次提交取代的舊檔名 / 舊表記在 manifest 的 superseded，提交後 / 載入時只清這些
+#   （載入時再加上下一個世代寫到一半的新檔），資料夾裡其他檔案一律不碰
+# 載入時會比對校驗碼與向量數，index 跟 meta 對不起來就直接拋錯，不會帶著錯位的資料繼續搜尋。
+_MANIFEST_FORMAT = 1
+
+
+def _bytes_checksum(data: bytes) -> str:
+    return f"crc32:{zlib.crc32(data):08x}"
+
+
+def _file_checksum(path: Path) -> str:
+    """分塊計算檔案的 CRC32（不用整份讀進記憶體）。"""
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(chunk, crc)
+    return f"crc32:{crc:08x}"
+
+
+def _new_manifest(old: dict | None = None, **changes) -> dict:
+    """以 old 為底（沒有就用空的 collection）套上 changes，回傳新的 manifest。"""
+    man = {
+        "format": _MANIFEST_FORMAT,
+        "generation": 0,
+        "ntotal": 0,
+        "index": None,
+        "checksum": None,
+        "vectors": None,
+        "meta_table": "meta",
+        "sources": {},
+        "deleted": [],
+        "epoch": 0,
+        "superseded": {},
+    }
+    if old:
+        man.update(old)
+    man.update(changes)
+    return man
+
+
+def _read_manifest(p: dict) -> dict | None:
+    """讀取 manifest；沒有（舊版 collection）回傳 None，壞掉就拋錯（manifest 一律整份 rename，不會寫到一半）。"""
+    if not p["manifest"].exists():
+        return None
+    try:
+        return json.loads(p["manifest"].read_text(encoding="utf-8"))
+    except (OSError, ValueError) as e:
+        raise RuntimeError(f"[vector_store] manifest 無法讀取：{p['manifest']}（{e}）")
+
+
+def _write_manifest(cid: str, man: dict):
+    """寫入 manifest（暫存檔 + fsync + rename）：這一步就是提交。"""
+    p = _paths(cid)
+    p["root"].mkdir(parents=True, exist_ok=True)
+    _atomic_write_bytes(p["manifest"], json.dumps(man, ensure_ascii=False).encode("utf-8"))
+
+
+def _legacy_manifest(cid: str, p: dict) -> dict:
+    """
+    舊版（沒有 manifest）的 collection 第一次載入時補建 manifest：
+    沿用現有的 index.faiss / vectors.f32 / meta 表 / sources.json / deleted.json，之後都以 manifest 為準。
+    """
+    epoch, deleted = _read_deleted(p)
+    man = _new_manifest(epoch=epoch, deleted=[list(r) for r in deleted])
+    if p["index"].exists():
+        nb = _index_header_ntotal(p["index"])
+        if nb is None:
+            nb = faiss.read_index(str(p["index"])).ntotal
+        base_meta = _open_meta_base(p, nb)
+        man.update(
+            ntotal=nb,
+            index=p["index"].name,
+            checksum=_file_checksum(p["index"]),
+            vectors=p["vectors"].name if p["vectors"].exists() else None,
+            sources=_load_source_ranges(p, base_meta, nb),
+        )
+        if base_meta is not None:
+            base_meta.close()
+
+    # 世代不是 0 的舊段檔搬到對應的資料夾
+    if epoch and p["segments"].exists() and not _segments_dir(cid, epoch).exists():
+        os.replace(p["segments"], _segments_dir(cid, epoch))
+
+    _write_manifest(cid, man)
+    for f in (p["sources"], p["deleted"]):
+        f.unlink(missing_ok=True)
+    return man
+
+
+def _superseded(old: dict | None, new: dict) -> dict:
+    """提交 new 之後，old 用到、new 已經不用的檔案 / 段檔資料夾 / 資料表（記在 new 的 manifest，交給 _collect_garbage 清）。"""
+    old = old or {}
+    files = [old[k] for k in ("index", "vectors") if old.get(k) and old.get(k) != new.get(k)]
+    dirs, tables = [], []
+    old_table = old.get("meta_table") or "meta"
+    if old_table != new.get("meta_table"):
+        tables.append(old_table)
+    old_epoch = int(old.get("epoch") or 0)
+    if old_epoch != int(new.get("epoch") or 0):
+        dirs.append("segments" if not old_epoch else f"segments.{old_epoch}")
+        tables.append(_lex_table(old_epoch))
+    return {"files": files, "dirs": dirs, "tables": tables}
+
+
+def _pending(man: dict) -> dict:
+    """
+    manifest 之後「下一次」提交才會用到的名稱：compaction / 回收空間寫到一半就中斷時留下的。
+    只在載入時清（載入前不會有別的寫入在進行）。
+    """
+    gen = int(man.get("generation") or 0) + 1
+    epoch = int(man.get("epoch") or 0) + 1
+    return {
+        "files": [f"index.{gen:06d}.faiss", f"vectors.{gen:06d}.f32"],
+        "dirs": [f"segments.{epoch}"],
+        "tables": [f"meta_{gen}", _lex_table(epoch)],
     }
 
 
+def _collect_garbage(cid: str, man: dict, pending: bool = False):
+    """
+    清掉 manifest 記錄為「已被取代」的東西：舊的主檔與原始向量檔、舊世代的段檔資料夾、
+    舊的 meta 表與關鍵字索引，以及這些檔案寫到一半的暫存檔。
+    pending=True（載入時）再加上下一次提交才會用到、寫到一半中斷留下的檔案。
+    只動名單上的名稱，資料夾裡其他的檔案一律不碰。呼叫端持有 _lock(cid)（或 collection 尚未載入）。
+    """
+    root = _check_root(cid)
+    if not root.exists():
+        return
+    groups = [man.get("superseded") or {}]
+    if pending:
+        groups.append(_pending(man))
+    keep_files = {man.get("index"), man.get("vectors")}
+    keep_dir = _segments_dir(cid, int(man.get("epoch") or 0)).name
+    keep_tables = {man.get("meta_table") or "meta", _lex_table(int(man.get("epoch") or 0))}
+
+    files = {n for g in groups for n in g.get("files") or [] if n and n not in keep_files}
+    # 提交點與設定檔的暫存檔（寫到一半中斷）也一併清掉
+    files |= {f"{n}.tmp" for n in files | {"manifest.json", "config.json"}}
+    for name in files:
+        if "/" not in name:
+            (root / name).unlink(missing_ok=True)
+
+    for name in {n for g in groups for n in g.get("dirs") or []}:
+        if name != keep_dir and (name == "segments" or name.startswith("segments.")):
+            shutil.rmtree(root / name, ignore_errors=True)
+
+    tables = {n for g in groups for n in g.get("tables") or []} - keep_tables
+    meta_path = _paths(cid)["meta"]
+    if tables and meta_path.exists():
+        conn = _connect_meta(meta_path)
+        try:
+            with conn:
+                existing = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                for name in tables & existing:
+                    # FTS5 的內部表（lex_data 等）會跟著主表一起刪
+                    if name == "meta" or name.startswith("meta_") or _LEX_TABLE_RE.match(name):
+                        conn.execute(f"DROP TABLE {name}")
+        finally:
+            conn.close()
+
+
 # ==========================
-# 載入與儲存
+# 載入與 compaction
 # ==========================
 def _load_collection(cid: str):
     """
     載入指定 collection：
-    - 嘗試從磁碟讀取 index.faiss 與 meta.json。
-    - 若沒有檔案，就回傳 (None, [])。
+    - 依 manifest 開啟主檔 index（mmap 模式下只建立對應，不整份讀入），
+      並比對校驗碼與向量數；對不起來就拋錯。
+    - 舊版（沒有 manifest）的 collection 會先補建 manifest；meta.json / meta.jsonl 會自動轉成 meta.sqlite。
+    - 再依序重播段檔（WAL）：把尚未 compaction 的段檔讀進 delta。
+    - 最後清掉沒被 manifest 採用的檔案（上次 compaction 寫到一半中斷留下的）。
+    - 若沒有檔案，就回傳 (None, None, _MetaView(), {}, 0, manifest)。
+
+    回傳：(base index, delta index, meta, 來源列號範圍, 段檔數, manifest)
     """
+    _check_root(cid)
     p = _paths(cid)
     p["root"].mkdir(parents=True, exist_ok=True)
 
-    # 讀取 meta.json（段落中繼資料）
-    meta = []
-    if p["meta"].exists():
-        try:
-            meta = json.loads(p["meta"].read_text(encoding="utf-8"))
-        except Exception:
-            meta = []
+    if not p["meta"].exists():
+        _migrate_legacy_meta(p)
 
-    # 讀取 FAISS 向量索引
+    man = _read_manifest(p)
+    if man is None:
+        man = _legacy_manifest(cid, p)
+    epoch = int(man.get("epoch") or 0)
+
+    # 讀取 FAISS 向量索引：只認 manifest 記錄的檔案
     index = None
-    if p["index"].exists():
-        index = faiss.read_index(str(p["index"]))
+    nb = 0
+    if man.get("index"):
+        path = p["root"] / man["index"]
+        if not path.exists():
+            raise RuntimeError(f"[vector_store] {cid} 主檔不存在：{path.name}")
+        if man.get("checksum") and _file_checksum(path) != man["checksum"]:
+            raise RuntimeError(f"[vector_store] {cid} 主檔校驗碼不符：{path.name}")
+        index = _read_index(path)
+        nb = index.ntotal
+        if nb != int(man.get("ntotal") or 0):
+            raise RuntimeError(f"[vector_store] {cid} 主檔向量數 {nb} 與 manifest（{man.get('ntotal')}）不符")
+
+    # 主檔 meta（分頁；meta 多出來的列是寫到一半的 compaction，不採用）
+    base_meta = _open_meta_base(p, nb, man.get("meta_table") or "meta") if nb else None
+    if nb and (base_meta is None or len(base_meta) < nb):
+        raise RuntimeError(f"[vector_store] {cid} 主檔 meta 少於 {nb} 列，index 與 meta 對不起來")
+    meta = _MetaView(base_meta)
+    source_ranges = _clip_ranges(man.get("sources") or {}, nb)
+
+    # 有主檔就沿用主檔的度量，否則看 collection 設定
+    metric = _index_metric(index) if index is not None else _config_metric(_read_config(cid))
+    delta = _flat_index(index.d, metric) if index is not None else None
+
+    # 重播段檔：只接上「起始列號 == 目前列數」的段檔
+    n = nb
+    n_segments = 0
+    replaced: list = []
+    for start, vec_path, meta_path in _segment_files(cid, epoch):
+        if start < n:
+            # 已經併進主檔（compaction 提交後來不及刪），直接清掉
+            _clear_segments(cid, upto=n, epoch=epoch)
+            continue
+        if start > n:
+            print(f"[vector_store] {cid} 段檔不連續（預期 {n}，遇到 {start}），略過後續段檔")
+            break
+
+        seg = _read_segment(vec_path, meta_path)
+        if seg is None:
+            print(f"[vector_store] {cid} 段檔 {vec_path.name} 不完整，略過後續段檔")
+            break
+        arr, metas = seg
+
+        if delta is None:
+            delta = _flat_index(arr.shape[1], metric)
+        delta.add(arr)
+        meta.extend(metas)
+        # 取代記錄：舊列跟這批新列是同一次提交，manifest 還沒記到的刪除範圍在這裡補上
+        src = _read_replace(vec_path)
+        if src is not None:
+            replaced.extend(source_ranges.pop(src, []))
+        _add_source_ranges(source_ranges, n, metas)
+        n += len(arr)
+        n_segments += 1
 
-    return index, meta
+    if replaced:
+        man = dict(man, deleted=[list(r) for r in _merge_ranges(list(man.get("deleted") or []) + replaced)])
+    _collect_garbage(cid, man, pending=True)
+    return index, delta, meta, source_ranges, n_segments, man
 
 
 def _save_collection(cid: str):
     """
-    儲存指定 collection：
-    - 將 index.faiss 與 meta.json 寫回磁碟。
+    Compaction：把 base + delta 合併成新的主檔。
+    - 在鎖內只拍「快照」（delta 的向量與 meta），寫檔在鎖外做，不擋住新增與搜尋。
+    - 新主檔寫成新的檔名（index.{世代}.faiss），寫完後更新 manifest 才算提交。
+    - 提交後換上新的 base，快照之後才進來的向量留在 delta。
+    - 刪除已經包含在主檔裡的段檔與舊的主檔。
     - 若該 collection 尚未初始化則略過。
     """
-    obj = _COLLECTIONS.get(cid)
+    obj = _COLLECTIONS.peek(cid)
     if not obj:
         return
 
+    # 已刪除的列夠多 → 這次改成回收空間（只留下活著的列重建）
+    if obj.get("index") is not None and _needs_reclaim(obj):
+        _reclaim_collection(cid, obj)
+        return
+
+    with _lock(cid):
+        base, delta = obj.get("index"), obj.get("delta")
+        if base is None and delta is None:
+            return
+        dim = obj["dim"]
+        metric = obj["metric"]
+        nb = base.ntotal if base is not None else 0
+        nd = delta.ntotal if delta is not None else 0
+        delta_vecs = delta.reconstruct_n(0, nd) if nd else None
+        delta_metas = list(obj["meta"].tail[:nd])
+        base_meta = obj["meta"].base
+        source_ranges = _clip_ranges(obj["sources"], nb + nd)
+        base_full = obj.get("full")
+        obj["segments"] = 0
+        n = nb + nd
+        kind = _target_kind(obj, n)
+        quant = _target_quant(obj, kind, n)
+        old_man = obj.get("manifest") or _new_manifest()
+
+    # 量化的 base 需要保留原始向量：
+    # - 已經有原始向量檔 → 直接用（重建時也不會從近似值重建）
+    # - 舊 base 沒有量化 → 從它取回的就是原始向量
+    # - 舊 base 已量化但沒有原始向量檔（例如舊版的 IVFPQ）→ 無法取得原始向量，就不存
+    base_vecs = base_full
+    keep_full = base_full is not None or nb == 0 or not _is_lossy(base)
+    if base_vecs is None and nb and keep_full and (kind == "ivfpq" or quant != "none"):
+        base_vecs = _reconstruct_all(base)
+
+    # 新 base = 舊 base + delta 快照（依策略可能同時升級成 HNSW / IVFPQ，或改變量化方式）
+    # 這段可能要訓練很久，期間舊的 base 照常服務查詢
+    new_index = _merge_base(base, delta_vecs, kind, dim, metric, quant, base_vecs)
+
     p = _paths(cid)
-    p["root"].mkdir(parents=True, exist_ok=True)
+    root = p["root"]
+    gen = int(old_man.get("generation") or 0) + 1
+    index_name = f"index.{gen:06d}.faiss"
+    # 沿用舊主檔 → 接在同一張 meta 表後面；全新的 base（例如 reset 後）→ 寫到新表，舊表提交前都不動
+    table = (old_man.get("meta_table") or "meta") if base_meta is not None else f"meta_{gen}"
+    with _io_lock(cid):
+        # 若寫檔前 collection 已被 reset 換掉，這份快照就不能再寫回去
+        if _COLLECTIONS.peek(cid) is not obj:
+            return
 
-    # 寫入 FAISS index
-    if obj.get("index") is not None:
-        faiss.write_index(obj["index"], str(p["index"]))
+        root.mkdir(parents=True, exist_ok=True)
+
+        # 原始向量：量化的 base 才需要（有舊檔就只接上 delta 的部分；
+        # 舊 manifest 只採用前 nb 列，接到一半中斷也不影響）
+        vectors_name = None
+        if _is_lossy(new_index) and keep_full:
+            if base_full is not None and old_man.get("vectors"):
+                vectors_name = old_man["vectors"]
+                _write_full_vectors(root / vectors_name, nb, dim, delta_vecs)
+            else:
+                vectors_name = f"vectors.{gen:06d}.f32"
+                parts = [v for v in (base_vecs, delta_vecs) if v is not None]
+                _write_full_vectors(root / vectors_name, 0, dim, np.concatenate(parts) if parts else None)
+
+        # meta：只在舊主檔後面接上 delta 的部分（舊的列完全不動）
+        # 若在提交前中斷，多出來的列載入時會被忽略，段檔也還在
+        _write_meta_rows(p["meta"], nb if base_meta is not None else 0, delta_metas, table=table)
+
+        # 寫入 FAISS index（新檔名，不覆蓋正在使用的主檔）
+        data = faiss.serialize_index(new_index).tobytes()
+        _atomic_write_bytes(root / index_name, data)
+
+        with _lock(cid):
+            if _COLLECTIONS.peek(cid) is not obj:
+                return
+            # 提交點：刪除範圍在 compaction 期間可能又有變動，以目前的為準
+            man = _new_manifest(
+                obj.get("manifest"),
+                generation=gen,
+                ntotal=n,
+                index=index_name,
+                checksum=_bytes_checksum(data),
+                vectors=vectors_name,
+                meta_table=table,
+                sources=source_ranges,
+                deleted=[list(r) for r in obj.get("deleted") or []],
+                epoch=obj.get("epoch", 0),
+            )
+            man["superseded"] = _superseded(obj.get("manifest"), man)
+            _write_manifest(cid, man)
+            obj["manifest"] = man
+
+        _clear_segments(cid, upto=n, epoch=man["epoch"])
+
+    # mmap 模式改成對應剛寫好的檔案，釋放記憶體中的副本
+    mmapped = _mmap_readable(root / index_name)
+    if mmapped:
+        new_index = _read_index(root / index_name)
+    new_meta = _open_meta_base(p, n, table)
+    new_full = _open_full_vectors(root / vectors_name, dim, n) if vectors_name else None
+
+    with _lock(cid):
+        if _COLLECTIONS.peek(cid) is not obj:
+            return
+        # 快照之後才新增的向量，留在新的 delta（持有 _lock，不會再有新增進來）
+        delta = obj["delta"]
+        rest = delta.ntotal - nd
+        new_delta = _flat_index(dim, metric)
+        if rest > 0:
+            new_delta.add(delta.reconstruct_n(nd, rest))
+        new_view = _MetaView(new_meta, obj["meta"].tail[nd:])
+
+        # 一次換上：搜尋端只會看到整組舊的或整組新的 base / delta / meta
+        with _rw_lock(cid).write():
+            obj["index"] = new_index
+            obj["delta"] = new_delta
+            obj["mmap"] = mmapped
+            obj["full"] = new_full
+            obj["meta"] = new_view
+            obj["version"] = obj.get("version", 0) + 1
+
+        # 舊的主檔已經沒有人用（mmap 的舊對應已換掉），可以清掉
+        _collect_garbage(cid, man)
+
+
+def compact_collection(cid: str):
+    """
+    Compaction：把段檔合併回主檔（index + meta.sqlite，以 manifest 提交）。
+    可直接呼叫；add_embeddings 在段檔累積到 COMPACT_SEGMENTS 時，
+    或向量數跨過 ANN 門檻需要升級索引時，也會在背景自動觸發。
+    """
+    _save_collection(cid)
 
-    # 寫入 meta.json
-    p["meta"].write_text(
-        json.dumps(obj.get("meta", []), ensure_ascii=False, indent=2),
-        encoding="utf-8"
-    )
+
+def _schedule_compaction(cid: str):
+    """在背景執行緒跑 compaction；同一個 collection 同時只會有一個在跑。"""
+    # 檢查與設定 compacting 要在同一個鎖內，兩個同時觸發的呼叫才不會各自啟動一個
+    with _lock(cid):
+        obj = _COLLECTIONS.peek(cid)
+        if not obj or obj.get("compacting"):
+            return
+        obj["compacting"] = True
+        cfg = obj.get("config")
+
+    def _job():
+        ok = False
+        try:
+            compact_collection(cid)
+            ok = True
+        except Exception as e:
+            print(f"[vector_store] {cid} compaction 失敗: {e}")
+        finally:
+            with _lock(cid):
+                obj["compacting"] = False
+                # 跑的期間又累積了夠多段檔或刪除（觸發的呼叫看到 compacting 就略過了），
+                # 或設定又被改過（例如先改量化再改索引策略）→ 再跑一次；失敗就不重試，避免空轉
+                again = ok and _COLLECTIONS.peek(cid) is obj and (
+                    obj.get("segments", 0) >= COMPACT_SEGMENTS
+                    or _needs_reclaim(obj)
+                    or (obj.get("config") is not cfg and _needs_rebuild(obj))
+                )
+        if again:
+            _schedule_compaction(cid)
+
+    # 背景執行，不阻塞上傳請求
+    threading.Thread(target=_job, daemon=True).start()
 
 
 # ==========================
@@ -228,51 +2150,171 @@ def list_collections() -> list[str]:
     return [d.name for d in BASE_DIR.iterdir() if d.is_dir()]
 
 
+def exists(cid: str) -> bool:
+    """collection 是否已經建立（在記憶體裡，或資料夾裡有 manifest / 主檔）；不會載入或建立任何東西。"""
+    if _COLLECTIONS.peek(cid) is not None:
+        return True
+    p = _paths(cid)
+    return p["manifest"].exists() or p["index"].exists()
+
+
+def count(cid: str) -> int:
+    """
+    回傳 collection 的向量數，盡量不載入整個 collection：
+    - 已在記憶體 → 直接回傳
+    - 否則只讀 manifest 與段檔的 .npy 檔頭
+    適合「只想知道有沒有資料」的情境（例如 qna._has_collection_data）。
+    """
+    obj = _COLLECTIONS.peek(cid)
+    if obj:
+        return _ntotal(obj)
+
+    p = _paths(cid)
+    if not p["root"].exists():
+        return 0
+
+    try:
+        man = _read_manifest(p)
+    except RuntimeError:
+        man = None
+    if man is None:
+        # 舊版 collection（或 manifest 壞掉）→ 走完整載入（會補建 manifest / 拋出錯誤）
+        return _ntotal(ensure_collection(cid))
+
+    n = int(man.get("ntotal") or 0)
+    for start, vec_path, _ in _segment_files(cid, int(man.get("epoch") or 0)):
+        if start < n:
+            continue
+        if start > n:
+            break
+        try:
+            n += np.load(vec_path, mmap_mode="r").shape[0]
+        except Exception:
+            break
+    return n
+
+
 def ensure_collection(cid: str, dim: int | None = None):
     """
     確保 collection 已載入。
     若記憶體中沒有：
-      → 從磁碟讀取 index.faiss + meta.json。
+      → 依 manifest 從磁碟讀取主檔（index + meta），再把段檔讀進 delta。
     若 index 不存在但提供了 dim：
-      → 新建空的 IndexFlatL2(dim)。
+      → 新建空的 flat index（度量依 VECTOR_METRIC / config.json）。
 
     回傳：
       {
-        "index": faiss.Index 或 None,
+        "index": base faiss.Index 或 None,
+        "delta": 段檔的 faiss.Index 或 None,
         "dim": 向量維度,
-        "meta": 段落列表
+        "meta": 段落列表（_MetaView）,
+        "metric": "cosine" 或 "l2",
+        "segments": 尚未 compaction 的段檔數,
       }
     """
-    obj = _COLLECTIONS.get(cid)
+    obj = _COLLECTIONS.lookup(cid, count_miss=False)
     if obj:
         return obj
 
-    # 從磁碟讀
-    index, meta = _load_collection(cid)
+    with _lock(cid):
+        obj = _COLLECTIONS.lookup(cid)
+        if obj:
+            return obj
 
-    # 若沒有索引但有給維度 → 新建
-    if index is None and dim is not None:
-        index = faiss.IndexFlatL2(dim)
+        # 從磁碟讀
+        index, delta, meta, source_ranges, n_segments, man = _load_collection(cid)
+        root = _paths(cid)["root"]
+        mmapped = index is not None and _mmap_readable(root / man["index"])
+        cfg = _read_config(cid)
+        # 有主檔或段檔時 delta 已依既有度量建好；全新的 collection 才看設定
+        metric = _index_metric(delta) if delta is not None else _config_metric(cfg)
 
-    # 若都沒有，就留空等第一次 add_embeddings 時才建
-    if index is None:
-        obj = {"index": None, "dim": dim, "meta": meta}
-    else:
-        obj = {"index": index, "dim": index.d, "meta": meta}
+        # 只有段檔、沒有主檔 → base 先用空的
+        if index is None and delta is not None:
+            index = _flat_index(delta.d, metric)
+
+        # 若沒有索引但有給維度 → 新建
+        if index is None and dim is not None:
+            index = _flat_index(dim, metric)
+            delta = _flat_index(dim, metric)
 
-    _COLLECTIONS[cid] = obj
+        # 若都沒有，就留空等第一次 add_embeddings 時才建
+        if index is None:
+            obj = {"index": None, "delta": None, "dim": dim, "meta": meta}
+        else:
+            obj = {"index": index, "delta": delta, "dim": index.d, "meta": meta}
+        obj["metric"] = metric
+        obj["full"] = (
+            _open_full_vectors(root / man["vectors"], index.d, index.ntotal)
+            if index is not None and _is_lossy(index) and man.get("vectors") else None
+        )
+        # 已刪除（尚未回收）的列：從來源範圍扣掉，搜尋時就不會再出現
+        epoch = int(man.get("epoch") or 0)
+        deleted = _subtract_ranges(_merge_ranges(man.get("deleted") or []), [(_ntotal(obj), 1 << 62)])
+        obj["sources"] = {}
+        for src, lst in source_ranges.items():
+            kept = _subtract_ranges(lst, deleted)
+            if kept:
+                obj["sources"][src] = [list(r) for r in kept]
+        obj["deleted"] = deleted
+        obj["epoch"] = epoch
+        obj["manifest"] = man
+        obj["lex"] = _open_lexical(cid, epoch, meta, _ntotal(obj))
+        obj["segments"] = n_segments
+        obj["compacting"] = False
+        obj["mmap"] = mmapped
+        obj["config"] = cfg
+
+        _COLLECTIONS[cid] = obj
+    _COLLECTIONS.evict_over_budget(keep=cid)
     return obj
 
 
 def reset_collection(cid: str, dim: int):
     """
     重建 collection（覆蓋舊資料）：
-    - 建立新的空 index
-    - 清空 meta
-    - 立即儲存到磁碟
+    - 建立新的空 index（度量改用目前的設定，舊的 L2 collection 重建後就換成 cosine）
+    - 清空 meta 與所有段檔（換到新世代的段檔資料夾，舊的在提交後清掉）
+    - 立即儲存到磁碟（寫入 manifest 前中斷，載入時仍是舊資料）
     """
-    obj = {"index": faiss.IndexFlatL2(dim), "dim": dim, "meta": []}
-    _COLLECTIONS[cid] = obj
+    _check_root(cid)
+    cfg = _read_config(cid)
+    metric = _config_metric(cfg)
+    # 列號全部重來 → 列號世代 +1（進行中的重新向量化會知道要放棄）
+    old = _COLLECTIONS.peek(cid)
+    if old:
+        old_man = old.get("manifest")
+    else:
+        try:
+            old_man = _read_manifest(_paths(cid))
+        except RuntimeError:
+            old_man = None
+    if old:
+        epoch = old.get("epoch", 0) + 1
+    else:
+        epoch = (int(old_man.get("epoch") or 0) if old_man else _read_deleted(_paths(cid))[0]) + 1
+    obj = {
+        "index": _flat_index(dim, metric),
+        "delta": _flat_index(dim, metric),
+        "dim": dim,
+        "meta": _MetaView(),
+        "metric": metric,
+        "full": None,
+        "sources": {},
+        "segments": 0,
+        "compacting": False,
+        "mmap": False,
+        "config": cfg,                 # 覆蓋資料時保留 collection 的設定
+        "deleted": [],
+        "epoch": epoch,
+        "manifest": old_man,           # 沿用世代編號，新主檔不會跟舊檔同名
+    }
+    with _io_lock(cid):
+        with _lock(cid):
+            _paths(cid)["root"].mkdir(parents=True, exist_ok=True)
+            _clear_segments(cid, epoch=epoch)
+            obj["lex"] = _reset_lexical(cid, epoch)
+            _COLLECTIONS[cid] = obj
     _save_collection(cid)
 
 
@@ -284,8 +2326,10 @@ def init_collection(cid: str, dim: int):
     """
     obj = ensure_collection(cid, dim)
     if obj["index"] is None:
-        obj["index"] = faiss.IndexFlatL2(dim)
-        obj["dim"] = dim
+        with _lock(cid), _rw_lock(cid).write():
+            obj["index"] = _flat_index(dim, obj["metric"])
+            obj["delta"] = _flat_index(dim, obj["metric"])
+            obj["dim"] = dim
         _save_collection(cid)
 
 
@@ -296,80 +2340,724 @@ def add_embeddings(cid: str, vectors: list[list[float]] | np.ndarray, metas: lis
     """
     將多個向量（vectors）及其對應的 meta（段落資訊）加入指定 collection。
 
-    - 若 collection 尚未建立，會自動建立 IndexFlatL2。
-    - 每次新增都會同步更新 meta.json。
+    - 若 collection 尚未建立，會自動建立 flat index（cosine 模式下向量會先正規化）。
+    - 每次新增只寫一組段檔（成本與這批大小成正比，不會重寫整個主檔）。
+    - 新向量放在記憶體的 delta；段檔累積到 COMPACT_SEGMENTS 個時，背景自動 compaction。
     - 維度不符會拋出 ValueError。
     """
+    arr = np.asarray(vectors, dtype="float32")
+    if len(arr) == 0:
+        return
+    if len(arr) != len(metas):
+        raise ValueError(f"Length mismatch: {len(arr)} vectors vs {len(metas)} metas")
+    _add(cid, arr, metas)
+
+
+def _add(cid: str, arr: np.ndarray, metas: list[dict], replace: str | None = None) -> int:
+    """新增一批向量（replace 有值時同時刪掉該來源原本的列）；回傳刪掉的列數。"""
+    while True:
+        obj = ensure_collection(cid)
+        with _lock(cid):
+            # 等鎖期間 collection 被 reset / 整批替換 / 移出快取 → 重新取得目前的那一份
+            if _COLLECTIONS.peek(cid) is not obj:
+                continue
+            removed, need_compact = _add_locked(cid, obj, arr, metas, replace)
+        break
+
+    if need_compact:
+        _schedule_compaction(cid)
+    _COLLECTIONS.evict_over_budget(keep=cid)
+    return removed
+
+
+def _add_locked(
+    cid: str, obj: dict, arr: np.ndarray, metas: list[dict], replace: str | None = None,
+) -> tuple[int, bool]:
+    """
+    add_embeddings 的本體（呼叫端已持有 _lock(cid)）；回傳 (刪掉的列數, 是否需要 compaction)。
+    寫段檔不拿讀寫鎖（搜尋照常進行），只有套用到記憶體這一步才拿寫鎖：
+    replace 時「刪掉舊列」與「加入新列」在同一次套用，搜尋不會看到兩份或零份。
+    """
+    # 維度檢查（第一次新增時以這批的維度為準）
+    dim = obj["dim"] if obj["index"] is not None else arr.shape[1]
+    if arr.shape[1] != dim:
+        raise ValueError(f"Dimension mismatch: vec {arr.shape[1]} vs index {dim}")
+
+    # cosine：段檔裡存的就是正規化後的向量
+    arr = _prepare_vectors(arr, obj["metric"])
+
+    # 先落地段檔，再更新記憶體（起始列號 = 目前列數）
+    start = _ntotal(obj)
+    _write_segment(cid, start, arr, metas, obj.get("epoch", 0), replace)
+    if obj.get("lex") is not None:
+        obj["lex"].add(start, metas)
+
+    # 實際加入向量（只進 delta，base 不動）：向量、meta、來源範圍一起套用
+    with _rw_lock(cid).write():
+        # 若第一次新增 → 新建 index
+        if obj["index"] is None:
+            obj["index"] = _flat_index(dim, obj["metric"])
+            obj["delta"] = _flat_index(dim, obj["metric"])
+            obj["dim"] = dim
+        dead = obj["sources"].pop(replace, []) if replace is not None else []
+        if dead:
+            obj["deleted"] = _merge_ranges(list(obj.get("deleted") or []) + dead)
+        obj["delta"].add(arr)
+        obj["meta"].extend(metas)
+        _add_source_ranges(obj["sources"], start, metas)
+        obj["version"] = obj.get("version", 0) + 1
+    if dead:
+        _write_deleted(cid, obj)
+
+    obj["segments"] = obj.get("segments", 0) + 1
+    need_compact = obj["segments"] >= COMPACT_SEGMENTS or _needs_rebuild(obj) or _needs_reclaim(obj)
+    return sum(b - a for a, b in dead), need_compact
+
+
+# ==========================
+# 依來源刪除 / 替換
+# ==========================
+def list_sources(cid: str) -> dict[str, int]:
+    """回傳 collection 內每個來源（檔名）目前的段落數。"""
     obj = ensure_collection(cid)
+    with _rw_lock(cid).read():
+        return {src: sum(b - a for a, b in lst) for src, lst in obj["sources"].items()}
 
-    # 若第一次新增 → 新建 index
-    if obj["index"] is None:
-        dim = len(vectors[0])
-        obj["index"] = faiss.IndexFlatL2(dim)
-        obj["dim"] = dim
 
-    arr = np.asarray(vectors, dtype="float32")
+def delete_source(cid: str, source: str) -> int:
+    """
+    刪除某個來源（檔名）的所有段落，回傳刪掉的段落數（不存在就回傳 0）。
+    只標記為已刪除、搜尋時排除，不用重建 collection；
+    已刪除的比例達到 RECLAIM_RATIO 時才在背景 compaction 時回收空間。
+    """
+    while True:
+        obj = ensure_collection(cid)
+        with _lock(cid):
+            if _COLLECTIONS.peek(cid) is not obj:
+                continue
+            if not obj["sources"].get(source):
+                return 0
+            with _rw_lock(cid).write():
+                dead = obj["sources"].pop(source)
+                obj["deleted"] = _merge_ranges(list(obj.get("deleted") or []) + dead)
+                obj["version"] = obj.get("version", 0) + 1
+            _write_deleted(cid, obj)
+            need_reclaim = _needs_reclaim(obj)
+        break
 
-    # 維度檢查
-    if arr.shape[1] != obj["dim"]:
-        raise ValueError(f"Dimension mismatch: vec {arr.shape[1]} vs index {obj['dim']}")
+    if need_reclaim:
+        _schedule_compaction(cid)
+    return sum(b - a for a, b in dead)
 
-    # 實際加入向量
-    obj["index"].add(arr)
-    obj["meta"].extend(metas)
 
-    _save_collection(cid)
+def replace_source(cid: str, source: str, vectors: list[list[float]] | np.ndarray, metas: list[dict]) -> dict:
+    """
+    用新的一批段落取代某個來源（例如更新過的同一份 PDF）：
+    舊段落標記為已刪除、新段落加到 delta，搜尋端一次看到整份新的。
+    回傳 {"deleted": 刪掉的段落數, "added": 新增的段落數}。
+    """
+    arr = np.asarray(vectors, dtype="float32")
+    if len(arr) != len(metas):
+        raise ValueError(f"Length mismatch: {len(arr)} vectors vs {len(metas)} metas")
+    if len(arr) == 0:
+        return {"deleted": delete_source(cid, source), "added": 0}
+    metas = [dict(m, source=source) for m in metas]
+    return {"deleted": _add(cid, arr, metas, replace=source), "added": len(metas)}
 
 
 # ==========================
 # 相似度搜尋
 # ==========================
-def search(cid: str, query_vec: list[float], top_k: int = 5, sources: list[str] | None = None):
+def _merge_results(parts_d: list, parts_i: list, k: int):
+    """把多份 (D, I) 依距離合併，取前 k 名；沒有任何結果時回傳 (None, None)。"""
+    if not parts_d:
+        return None, None
+    if len(parts_d) == 1 and parts_d[0].shape[1] <= k:
+        return parts_d[0], parts_i[0]
+    D = np.concatenate(parts_d, axis=1)
+    I = np.concatenate(parts_i, axis=1)
+    order = np.argsort(D, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+
+def _ranges_selector(ranges: list[tuple[int, int]], lo: int, hi: int):
+    """
+    把全域列號範圍中落在 [lo, hi) 的部分，轉成以 lo 為 0 的 FAISS IDSelector。
+
+    回傳 (selector, keepalive, local_ranges, 符合的數量)
+    - 只有一段 → IDSelectorRange
+    - 多段 → IDSelectorBitmap（keepalive 是 bitmap 陣列，搜尋完之前要留著）
+    """
+    local = [(max(a, lo) - lo, min(b, hi) - lo) for a, b in ranges if a < hi and b > lo]
+    cnt = sum(b - a for a, b in local)
+    if not local:
+        return None, None, local, 0
+    if len(local) == 1:
+        return faiss.IDSelectorRange(local[0][0], local[0][1]), None, local, cnt
+
+    bits = np.zeros(hi - lo, dtype=bool)
+    for a, b in local:
+        bits[a:b] = True
+    packed = np.packbits(bits, bitorder="little")
+    return faiss.IDSelectorBitmap(hi - lo, faiss.swig_ptr(packed)), packed, local, cnt
+
+
+def _exact_subset_search(
+    index, q: np.ndarray, k: int, local: list[tuple[int, int]], sel, full=None, chunk: int = 4096,
+):
+    """
+    只對 local 範圍內的向量做完整比對（分塊計算，記憶體只用到一塊）。
+    - 有原始向量 full（量化的 base）→ 直接用原始向量，精確距離
+    - IVF：用 selector + nprobe=nlist 掃過所有 list（距離為 PQ 近似值，但筆數一定湊滿）
+    - HNSW / flat：讀底層 storage 的向量（flat 直接讀，量化的就逐塊解碼）
+    回傳的 D 已轉成「越小越相似」（見 _as_distance）。
+    """
+    if full is None and isinstance(index, faiss.IndexIVF):
+        D, I = index.search(q, k, params=faiss.SearchParametersIVF(sel=sel, nprobe=index.nlist))
+        return _as_distance(index, D), I
+
+    storage = faiss.downcast_index(index.storage) if isinstance(index, faiss.IndexHNSW) else index
+    if full is not None:
+        rows = lambda a, b: np.asarray(full[a:b])
+    elif isinstance(storage, faiss.IndexFlat):
+        xb = faiss.rev_swig_ptr(storage.get_xb(), storage.ntotal * storage.d).reshape(-1, storage.d)
+        rows = lambda a, b: xb[a:b]
+    else:
+        rows = lambda a, b: storage.reconstruct_n(a, b - a)
+
+    best_d, best_i = [], []
+    for a, b in local:
+        for s0 in range(a, b, chunk):
+            s1 = min(s0 + chunk, b)
+            D, I = faiss.knn(q, rows(s0, s1), min(k, s1 - s0), metric=index.metric_type)
+            D = _as_distance(index, D)
+            D, I = _merge_results(best_d + [D], best_i + [np.where(I >= 0, I + s0, -1)], k)
+            best_d, best_i = [D], [I]
+    return best_d[0], best_i[0]
+
+
+def _rerank(index, q: np.ndarray, D: np.ndarray, I: np.ndarray, full, k: int):
+    """
+    用原始向量重新計算候選（I）的精確距離，再取前 k 名。
+    candidates 來自量化的 index，距離只是近似值；重排後的 D 一樣是「越小越相似」。
+    """
+    out_d = np.full((len(q), k), np.finfo("float32").max, dtype="float32")
+    out_i = np.full((len(q), k), -1, dtype="int64")
+    for r in range(len(q)):
+        ids = np.unique(I[r][I[r] >= 0])   # 排序過，mmap 讀取比較連續
+        if len(ids) == 0:
+            continue
+        vecs = np.asarray(full[ids])
+        if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            d = -(vecs @ q[r])
+        else:
+            d = ((vecs - q[r]) ** 2).sum(axis=1)
+        order = np.argsort(d, kind="stable")[:k]
+        out_d[r, : len(order)] = d[order]
+        out_i[r, : len(order)] = ids[order]
+    return out_d, out_i
+
+
+def _search_part(index, q: np.ndarray, k: int, ranges, lo: int, full=None):
+    """
+    查 base 或 delta 其中一層（列號從 lo 開始）。
+    ranges=None 代表不過濾；否則只查範圍內的向量。
+    full：量化的 base 才有的原始向量；有的話先多取 RERANK 倍候選再用原始向量重排。
+    回傳的 I 已換成全域列號，D 已轉成「越小越相似」。
+    """
+    n = index.ntotal if index is not None else 0
+    if n == 0:
+        return None, None
+
+    rerank = full is not None and RERANK > 1
+    kc = k * RERANK if rerank else k   # 近似搜尋要取的候選數
+
+    if ranges is None:
+        if rerank and isinstance(index, faiss.IndexIVF):
+            D, I = index.search(q, min(kc, n), params=faiss.SearchParametersIVF(nprobe=_ivf_nprobe(index, True)))
+        else:
+            D, I = index.search(q, min(kc, n))
+        D = _as_distance(index, D)
+        exact = not rerank
+    else:
+        sel, _keep, local, cnt = _ranges_selector(ranges, lo, lo + n)
+        if cnt == 0:
+            return None, None
+        kk = min(k, cnt)
+        kind = _index_kind(index)
+        exact = False
+
+        if kind == "flat" and not isinstance(index, faiss.IndexPQ):
+            # flat：selector 過濾後就是精確的 top_k（量化的 flat 則是近似，之後再重排）
+            D, I = index.search(q, min(kc, cnt), params=faiss.SearchParameters(sel=sel))
+            D = _as_distance(index, D)
+            exact = not rerank
+        elif cnt <= FILTER_EXACT_MAX or kind == "flat":
+            # IndexPQ 不支援 selector，一律走完整比對
+            D, I = _exact_subset_search(index, q, kk, local, sel, full)
+            exact = True
+        else:
+            if kind == "hnsw":
+                params = faiss.SearchParametersHNSW(sel=sel, efSearch=max(HNSW_EF_SEARCH, min(kc, cnt)))
+            else:
+                params = faiss.SearchParametersIVF(sel=sel, nprobe=_ivf_nprobe(index, rerank))
+            D, I = index.search(q, min(kc, cnt), params=params)
+            D = _as_distance(index, D)
+            # ANN 過濾搜尋偶爾湊不滿 → 改用完整比對補齊
+            if (I >= 0).sum(axis=1).min() < kk:
+                D, I = _exact_subset_search(index, q, kk, local, sel, full)
+                exact = True
+
+    if rerank and not exact:
+        D, I = _rerank(index, q, D, I, full, k)
+
+    return D, np.where(I >= 0, I + lo, -1)
+
+
+def _search_index(obj: dict, q: np.ndarray, k: int, ranges: list[tuple[int, int]] | None = None):
+    """
+    同時查 base 與 delta，再依距離合併成一份結果。
+    - ranges：只查這些列號範圍（指定 sources 時），None 代表全部
+    回傳 (D, I)，D 越小越相似，I 為整個 collection 的列號；完全沒有結果時回傳 (None, None)。
+    """
+    base, delta = obj.get("index"), obj.get("delta")
+    nb = base.ntotal if base is not None else 0
+
+    parts_d, parts_i = [], []
+    for index, lo, full in ((base, 0, obj.get("full")), (delta, nb, None)):
+        D, I = _search_part(index, q, k, ranges, lo, full)
+        if D is not None:
+            parts_d.append(D)
+            parts_i.append(I)
+    return _merge_results(parts_d, parts_i, k)
+
+
+def _collect_hits(
+    obj: dict, D_row: np.ndarray, I_row: np.ndarray, top_k: int, sources: list[str] | None, rows: bool = False,
+):
+    """把單一查詢的 (D, I) 轉成段落 meta（複本）+ 分數的列表（rows=True 時另外帶列號 row）。"""
+    scores = _to_score(D_row, obj["metric"])
+    hits = []
+    meta = obj["meta"]
+
+    # 根據搜尋結果的索引編號取出 meta
+    for idx, score in zip(I_row, scores):
+        if idx < 0 or idx >= len(meta):
+            continue
+        m = meta[idx]
+
+        # 保險：範圍表與 meta 不一致時仍以 meta 的 source 為準
+        if sources and m.get("source") not in sources:
+            continue
+
+        # 複製一份再加分數，不要改到快取裡的 meta
+        hit = dict(m)
+        hit["score"] = float(score)
+        if rows:
+            hit["row"] = int(idx)
+        hits.append(hit)
+        if len(hits) >= top_k:
+            break
+    return hits
+
+
+def search_batch(
+    cid: str,
+    query_matrix: list[list[float]] | np.ndarray,
+    top_k: int = 5,
+    filters: list[str] | list[list[str] | None] | None = None,
+    texts: list[str | None] | None = None,
+    with_vectors: bool = False,
+) -> list[list[dict]]:
+    """
+    一次搜尋多個查詢向量（每組相同過濾條件只呼叫一次 FAISS，用整個矩陣查）。
+
+    參數：
+      - query_matrix：n×dim 的查詢向量
+      - top_k：每個查詢最多取幾個結果
+      - filters：來源過濾，可以是
+          * None：全部不過濾
+          * ["a.pdf", ...]：所有查詢共用同一組 sources
+          * [["a.pdf"], None, ...]：每個查詢各自的 sources（長度要等於查詢數）
+      - texts：每個查詢的原始文字（長度要等於查詢數）；有給就同時做關鍵字檢索（BM25），
+        跟向量結果以 RRF 合併（VECTOR_HYBRID=0 時忽略）
+      - with_vectors：True 時每個結果另外帶 row（列號）與 vector（段落向量，np.float32；
+        取不回來時為 None），給上層去除重複段落、合併相鄰段落用
+
+    回傳：
+      長度 n 的列表，第 i 項是第 i 個查詢的結果（格式同 search()）。
+    """
+    q = np.asarray(query_matrix, dtype="float32")
+    if q.ndim == 1:
+        q = q.reshape(1, -1)
+    n = len(q)
+    if n == 0:
+        return []
+
+    # 統一成「每個查詢一組 sources」
+    if filters is None or all(isinstance(f, str) for f in filters):
+        per_query = [list(filters) if filters else None] * n
+    else:
+        if len(filters) != n:
+            raise ValueError(f"Length mismatch: {n} queries vs {len(filters)} filters")
+        per_query = [list(f) if f else None for f in filters]
+    if texts is not None and len(texts) != n:
+        raise ValueError(f"Length mismatch: {n} queries vs {len(texts)} texts")
+
+    obj = ensure_collection(cid)
+    # 整個搜尋過程持有讀鎖：看到的 base / delta / meta 一定是同一個版本
+    with _rw_lock(cid).read():
+        results = _search_batch_locked(obj, q, top_k, per_query, texts, with_vectors)
+
+    # mmap 模式下搜尋會讀入新的 meta 分頁，順便檢查預算
+    _COLLECTIONS.evict_over_budget(keep=cid)
+    return results
+
+
+def _search_batch_locked(
+    obj: dict, q: np.ndarray, top_k: int, per_query: list, texts: list[str | None] | None = None,
+    with_vectors: bool = False,
+) -> list[list[dict]]:
+    """search_batch 的本體（呼叫端已持有讀鎖）。"""
+    n = len(q)
+    results: list[list[dict]] = [[] for _ in range(n)]
+
+    # 若還沒建立 index 或裡面沒資料 → 全部回傳空列表
+    if obj["index"] is None or _ntotal(obj) == 0:
+        return results
+    if q.shape[1] != obj["dim"]:
+        raise ValueError(f"Dimension mismatch: query {q.shape[1]} vs index {obj['dim']}")
+
+    # 有已刪除（尚未回收）的列時，不指定 sources 的查詢也改成只查活著的範圍
+    live = _live_ranges(obj) if obj.get("deleted") else None
+
+    # 混合檢索：有查詢文字、且有關鍵字索引時，兩邊各取前 depth 名再合併
+    lex = obj.get("lex")
+    tokens = [_lex_tokens(t) for t in texts] if lex is not None and texts is not None else [None] * n
+    depth = max(top_k, HYBRID_DEPTH)
+
+    # cosine 模式下先正規化
+    q = _prepare_vectors(q, obj["metric"])
+
+    # 依過濾條件分組：同一組的查詢一起送進 FAISS
+    groups: dict[tuple | None, list[int]] = {}
+    for i, src in enumerate(per_query):
+        key = tuple(sorted(set(src))) if src else None
+        groups.setdefault(key, []).append(i)
+
+    for key, rows in groups.items():
+        # 有指定 sources → 先查出這些來源的列號範圍，只在範圍內搜尋（不再多抓再過濾）
+        ranges = _selected_ranges(obj, list(key)) if key else live
+        if ranges is not None and not ranges:
+            continue
+
+        hybrid = any(tokens[i] for i in rows)
+        D, I = _search_index(obj, q[rows], depth if hybrid else top_k, ranges)
+        for j, i in enumerate(rows):
+            if tokens[i]:
+                lexical = lex.search(tokens[i], depth, ranges if ranges is not None else [(0, _ntotal(obj))])
+                results[i] = _fuse_hits(
+                    obj, D[j] if I is not None else None, I[j] if I is not None else None,
+                    lexical, top_k, per_query[i], with_vectors,
+                )
+            elif I is not None:
+                results[i] = _collect_hits(obj, D[j], I[j], top_k, per_query[i], with_vectors)
+            if with_vectors:
+                _attach_vectors(obj, results[i])
+    return results
+
+
+def _attach_vectors(obj: dict, hits: list[dict]):
+    """
+    依 hit["row"] 取回段落向量放進 hit["vector"]（呼叫端已持有讀鎖）。
+    base 有原始向量（量化時）就用原始向量，否則從 index 取（量化的是近似值）；
+    IVF 沒有 direct map 取不回來 → None。
+    """
+    base, delta, full = obj["index"], obj.get("delta"), obj.get("full")
+    nb = base.ntotal if base is not None else 0
+    for hit in hits:
+        row = hit["row"]
+        try:
+            if row >= nb:
+                vec = delta.reconstruct(row - nb)
+            elif full is not None:
+                vec = np.asarray(full[row], dtype="float32")
+            else:
+                vec = base.reconstruct(row)
+        except RuntimeError:
+            vec = None
+        hit["vector"] = vec
+
+
+def _fuse_hits(
+    obj: dict, D_row: np.ndarray | None, I_row: np.ndarray | None,
+    lexical: list[tuple[int, float]], top_k: int, sources: list[str] | None, rows: bool = False,
+) -> list[dict]:
+    """
+    向量結果與關鍵字結果以 RRF（reciprocal rank fusion）合併：
+    每個列號的分數 = Σ 1 / (RRF_K + 名次)，兩邊都排前面的段落自然排最前。
+    回傳的段落除了 score（cosine 相似度；只被關鍵字找到的為 None），
+    另有 bm25（關鍵字分數；只被向量找到的為 None）與 rrf（合併後的分數）。
+    """
+    fused: dict[int, float] = {}
+    vec_scores: dict[int, float] = {}
+    lex_scores: dict[int, float] = {}
+
+    if I_row is not None:
+        scores = _to_score(D_row, obj["metric"])
+        rank = 0
+        for idx, score in zip(I_row, scores):
+            if idx < 0:
+                continue
+            idx = int(idx)
+            rank += 1
+            vec_scores[idx] = float(score)
+            fused[idx] = fused.get(idx, 0.0) + 1.0 / (RRF_K + rank)
+    for rank, (idx, score) in enumerate(lexical, start=1):
+        lex_scores[idx] = score
+        fused[idx] = fused.get(idx, 0.0) + 1.0 / (RRF_K + rank)
+
+    hits = []
+    meta = obj["meta"]
+    for idx in sorted(fused, key=fused.get, reverse=True):
+        if idx >= len(meta):
+            continue
+        m = meta[idx]
+
+        # 保險：範圍表與 meta 不一致時仍以 meta 的 source 為準
+        if sources and m.get("source") not in sources:
+            continue
+
+        # 複製一份再加分數，不要改到快取裡的 meta
+        hit = dict(m)
+        hit["score"] = vec_scores.get(idx)
+        hit["bm25"] = lex_scores.get(idx)
+        hit["rrf"] = fused[idx]
+        if rows:
+            hit["row"] = idx
+        hits.append(hit)
+        if len(hits) >= top_k:
+            break
+    return hits
+
+
+def search(
+    cid: str,
+    query_vec: list[float],
+    top_k: int = 5,
+    sources: list[str] | None = None,
+    query_text: str | None = None,
+    with_vectors: bool = False,
+):
     """
-    在指定 collection 中搜尋最相似的段落。
+    在指定 collection 中搜尋最相似的段落（單一查詢；多個查詢請用 search_batch）。
 
     參數：
       - cid：collection 名稱
       - query_vec：查詢向量（由使用者 query embedding 產出）
       - top_k：最多取幾個結果
       - sources：若指定，只從特定檔案來源過濾（如「只搜尋某個文件」）
+      - query_text：查詢的原始文字；有給就同時做關鍵字檢索（BM25），以 RRF 合併名次，
+        結果另外帶 bm25 / rrf 兩個分數（只被關鍵字找到的段落 score 為 None）
+      - with_vectors：結果另外帶 row（列號）與 vector（段落向量），見 search_batch
 
     回傳：
-      List[Dict]，每項為一個段落 meta，例如：
+      List[Dict]，每項為一個段落 meta（複本）加上相似度分數，依分數由高到低，例如：
         {
           "page": 2,
           "text": "本文指出心肌梗塞的臨床診斷應...",
           "source": "NEJM_heart.pdf",
-          "score": 0.87
+          "score": 0.87      # cosine 相似度（L2 collection 會換算成 cosine）
         }
     """
+    texts = [query_text] if query_text else None
+    return search_batch(cid, [query_vec], top_k, [sources], texts, with_vectors)[0]
+
+
+# ==========================
+# 索引策略
+# ==========================
+def set_index_policy(cid: str, policy: str | None):
+    """
+    覆寫單一 collection 的索引策略（"auto" / "flat" / "hnsw" / "ivfpq"）。
+    - policy=None：取消覆寫，回到全域的 VECTOR_INDEX_POLICY
+    - 設定會寫進 config.json；若目前 base 的種類不符，背景重建索引
+      （重建期間舊索引照常服務查詢）
+    """
+    if policy is not None and policy not in INDEX_POLICIES:
+        raise ValueError(f"Unknown index policy: {policy}（可用：{', '.join(INDEX_POLICIES)}）")
+    _set_config_value(cid, "index_policy", policy)
+
+
+def set_quantization(cid: str, quant: str | None):
+    """
+    覆寫單一 collection 的量化方式（"none" / "fp16" / "int8" / "pq"）。
+    - quant=None：取消覆寫，回到全域的 VECTOR_QUANTIZATION
+    - 與 set_index_policy 相同：寫進 config.json，需要時在背景重建 base
+    """
+    if quant is not None and quant not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization: {quant}（可用：{', '.join(QUANTIZATIONS)}）")
+    _set_config_value(cid, "quantization", quant)
+
+
+def _set_config_value(cid: str, key: str, value):
+    """更新 config.json 的一個欄位（None 代表移除），base 不符合新設定時排程背景重建。"""
     obj = ensure_collection(cid)
+    with _lock(cid):
+        cfg = dict(obj.get("config") or {})
+        if value is None:
+            cfg.pop(key, None)
+        else:
+            cfg[key] = value
+        obj["config"] = cfg
+        _write_config(cid, cfg)
+        need_rebuild = _needs_rebuild(obj)
 
-    # 若還沒建立 index 或裡面沒資料 → 回傳空列表
-    if obj["index"] is None or obj["index"].ntotal == 0:
-        return []
+    if need_rebuild:
+        _schedule_compaction(cid)
 
-    # 把查詢向量包成 batch 形式（1×dim）
-    q = np.asarray([query_vec], dtype="float32")
 
-    # 取多一點結果，再根據 source 過濾
-    D, I = obj["index"].search(q, top_k * 3)
+def index_info(cid: str) -> dict:
+    """回傳 collection 目前的索引狀態（種類、度量、量化、策略、向量數、是否正在重建）。"""
+    obj = ensure_collection(cid)
+    n = _ntotal(obj)
+    kind = _target_kind(obj, n)
+    return {
+        "collection_id": cid,
+        "kind": _index_kind(obj.get("index")),
+        "metric": obj.get("metric"),
+        "quantization": _index_quant(obj.get("index")),
+        "target_kind": kind,
+        "target_quantization": _target_quant(obj, kind, n),
+        "rerank": RERANK if obj.get("full") is not None else 0,
+        "index_bytes": _index_bytes(obj.get("index"), obj.get("mmap", False)),
+        "policy": (obj.get("config") or {}).get("index_policy") or INDEX_POLICY,
+        "ntotal": n,
+        "delta": obj["delta"].ntotal if obj.get("delta") is not None else 0,
+        "compacting": bool(obj.get("compacting")),
+        "version": obj.get("version", 0),
+        "deleted": _dead_count(obj),
+        "epoch": obj.get("epoch", 0),
+        "generation": int((obj.get("manifest") or {}).get("generation") or 0),
+    }
 
-    hits = []
-    meta = obj["meta"]
 
-    # 根據搜尋結果的索引編號取出 meta
-    for idx in I[0]:
-        if idx < 0 or idx >= len(meta):
-            continue
-        m = meta[idx]
+# ==========================
+# Embedding 設定與整批替換（重新向量化用）
+# ==========================
+def embedding_profile(cid: str) -> dict | None:
+    """回傳 collection 記錄的 embedding 設定（{"model", "dimensions"}）；沒記錄就回傳 None。"""
+    obj = _COLLECTIONS.peek(cid)
+    cfg = obj.get("config") if obj else _read_config(cid)
+    return (cfg or {}).get("embedding")
 
-        # 如果 sources 有設定，且該段落來源不在 sources 裡 → 跳過
-        if sources and m.get("source") not in sources:
-            continue
 
-        hits.append(m)
-        if len(hits) >= top_k:
-            break
+def set_embedding_profile(cid: str, profile: dict | None):
+    """記錄 collection 的 embedding 設定（寫進 config.json；不會動到既有向量）。"""
+    _set_config_value(cid, "embedding", profile)
+
+
+def content_version(cid: str) -> str:
+    """
+    collection 內容的版本字串（給上層的快取判斷是否過期）：
+    新增、刪除、reset、整批替換、重新載入後都會不同；同一個版本字串代表內容沒變過。
+    只在這個行程內有意義，不要存到磁碟。
+    """
+    obj = ensure_collection(cid)
+    with _rw_lock(cid).read():
+        return f"{obj.get('incarnation', 0)}.{obj.get('version', 0)}"
+
+
+def row_epoch(cid: str) -> int:
+    """列號世代：reset 或回收空間重新編號後就會改變（逐列搬移資料時用來確認列號仍然對得上）。"""
+    return ensure_collection(cid).get("epoch", 0)
+
+
+def read_metas(cid: str, start: int = 0, end: int | None = None) -> list[dict]:
+    """
+    依列號讀出一段段落 meta（[start, end)），例如重新向量化時逐批取出原文。
+    已刪除（尚未回收）的列也會回傳，讓呼叫端可以逐列對齊。
+    """
+    obj = ensure_collection(cid)
+    with _rw_lock(cid).read():
+        meta = obj["meta"]
+        end = len(meta) if end is None else min(end, len(meta))
+        return [meta[i] for i in range(start, end)]
+
+
+def create_shadow_collection(cid: str, shadow: str, dim: int, profile: dict):
+    """
+    建立 cid 的「影子」collection（重新向量化時先寫到這裡）：
+    沿用 cid 的設定（索引策略、量化、度量），只換掉 embedding 設定。
+    """
+    drop_collection(shadow)
+    cfg = dict(_read_config(cid))
+    cfg["embedding"] = profile
+    _write_config(shadow, cfg)
+    reset_collection(shadow, dim)
+
+
+def replace_collection(cid: str, shadow: str, expected_n: int, expected_epoch: int = 0) -> bool:
+    """
+    用 shadow 整個取代 cid（資料夾直接換掉，查詢端下次載入就是新的）。
+    shadow 必須跟 cid 逐列對齊（第 i 列就是 cid 的第 i 列）。
+    - 只有當 cid 目前的向量數 == expected_n 時才換（代表 shadow 已經追上所有新增）；
+      否則回傳 False，讓呼叫端補完後再試。
+    - cid 的列號世代跟 expected_epoch 不同（期間被 reset 或回收空間）→ 列號已對不上，拋出 ValueError。
+    - 期間在 cid 做的刪除，會一起帶到 shadow。
+    - 換的時候持有兩邊的鎖：新增與 compaction 都會等，不會寫到一半被換掉。
+    """
+    ensure_collection(cid)
+    with _io_lock(cid), _lock(cid):
+        obj = _COLLECTIONS.peek(cid)
+        if obj is None:
+            return False
+        if obj.get("epoch", 0) != expected_epoch:
+            raise ValueError(f"{cid} 的列號在搬移期間改變了（reset 或回收空間），請重新執行")
+        if _ntotal(obj) != expected_n:
+            return False
+
+        with _io_lock(shadow), _lock(shadow):
+            # shadow 的 manifest 帶上 cid 的刪除範圍（列號對齊；shadow 自己的列號世代不變）
+            sobj = _COLLECTIONS.peek(shadow)
+            sman = (sobj.get("manifest") if sobj else None) or _read_manifest(_paths(shadow))
+            _write_manifest(shadow, _new_manifest(sman, deleted=[list(r) for r in obj.get("deleted") or []]))
+            _COLLECTIONS.pop(shadow)
+            _COLLECTIONS.pop(cid)
+            root, src = _paths(cid)["root"], _paths(shadow)["root"]
+            trash = root.with_name(f"{root.name}.old")
+            if trash.exists():
+                shutil.rmtree(trash)
+            if root.exists():
+                os.replace(root, trash)
+            os.replace(src, root)
+
+    shutil.rmtree(trash, ignore_errors=True)
+    return True
+
+
+def drop_collection(cid: str):
+    """刪除整個 collection（記憶體與檔案）。"""
+    root = _check_root(cid)
+    with _io_lock(cid), _lock(cid):
+        _COLLECTIONS.pop(cid)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+# ==========================
+# 快取管理
+# ==========================
+def evict(cid: str):
+    """
+    主動把 collection 移出記憶體快取（不刪檔案）。
+    例如 /fetch_url 的 _url_<sha> 臨時 collection 用完就可以釋放。
+    """
+    with _lock(cid):
+        obj = _COLLECTIONS.peek(cid)
+        if obj is not None and not obj.get("compacting"):
+            _COLLECTIONS.pop(cid)
+
 
-    return hits
\ No newline at end of file
+def cache_stats() -> dict:
+    """回傳 collection 快取的統計：hits / misses / evictions / 常駐大小 / 預算。"""
+    return _COLLECTIONS.stats()
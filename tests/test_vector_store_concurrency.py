@@ -0,0 +1,153 @@
+# tests/test_vector_store_concurrency.py
+# ---------------------------------------------
+# vector_store 的並行測試：
+# - 多個寫入執行緒同時新增 / 取代 / 刪除來源（段檔累積很快，背景 compaction、回收空間會一直被觸發）
+# - 同時有讀取執行緒在做「指定來源」的過濾搜尋與混合（向量 + 關鍵字）搜尋
+# - 檢查：搜尋永遠不會拿到別的來源、也不會看到取代到一半的來源；
+#   結束後來源段落數與預期相同，重新從磁碟載入後的結果也跟記憶體中的一樣
+# 執行：python -m pytest -q tests/test_vector_store_concurrency.py
+# ---------------------------------------------
+
+import threading
+import time
+import zlib
+
+import numpy as np
+import pytest
+
+from services import vector_store
+
+DIM = 16
+CID = "concurrency"
+WRITERS = 4
+SOURCES_PER_WRITER = 3
+ROUNDS = 20
+READERS = 3
+
+
+def _vectors(source: str, version: int, n: int) -> np.ndarray:
+    """每個來源 / 版本各自固定的一批單位向量（同一來源的段落彼此相近，方便用向量查回來）。"""
+    rng = np.random.default_rng(zlib.crc32(f"{source}:{version}".encode("utf-8")))
+    center = rng.normal(size=DIM)
+    vecs = center + 0.05 * rng.normal(size=(n, DIM))
+    return (vecs / np.linalg.norm(vecs, axis=1, keepdims=True)).astype("float32")
+
+
+def _metas(source: str, version: int, n: int) -> list[dict]:
+    return [{"page": i + 1, "text": f"{source} paragraph {i} ver{version}", "ver": version} for i in range(n)]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """把向量庫放到暫存資料夾，段檔門檻調低讓 compaction 在測試期間一直發生。"""
+    monkeypatch.setattr(vector_store, "BASE_DIR", tmp_path / "collections")
+    vector_store.BASE_DIR.mkdir()
+    monkeypatch.setattr(vector_store, "COMPACT_SEGMENTS", 3)
+    monkeypatch.setattr(vector_store, "FSYNC", False)
+    vector_store.reset_collection(CID, DIM)
+    yield vector_store
+    _wait_compaction()
+    vector_store.drop_collection(CID)
+
+
+def _wait_compaction(timeout: float = 60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        obj = vector_store._COLLECTIONS.peek(CID)
+        if obj is None or not obj.get("compacting"):
+            return
+        time.sleep(0.05)
+    raise AssertionError("背景 compaction 沒有在時間內結束")
+
+
+def _check_hits(hits: list[dict], source: str):
+    """過濾搜尋的結果只能來自這個來源，而且全部屬於同一個版本（不會看到取代到一半的狀態）。"""
+    assert all(h["source"] == source for h in hits), hits
+    assert len({h["ver"] for h in hits}) <= 1, hits
+
+
+def test_concurrent_writers_and_readers(store):
+    errors: list[BaseException] = []
+    expected: dict[str, tuple[int, int]] = {}   # 來源 → (版本, 段落數)；每個來源只屬於一個寫入執行緒
+    expected_lock = threading.Lock()
+    done = threading.Event()
+
+    def writer(w: int):
+        try:
+            sources = [f"src{w}x{j}" for j in range(SOURCES_PER_WRITER)]
+            for r in range(ROUNDS):
+                src = sources[r % SOURCES_PER_WRITER]
+                n = 3 + (r % 4)
+                step = r % 5
+                if step == 4:
+                    # 刪除整個來源
+                    store.delete_source(CID, src)
+                    state = None
+                elif step in (1, 3):
+                    # 取代：舊段落標記刪除、新版本一次換上
+                    store.replace_source(CID, src, _vectors(src, r, n), _metas(src, r, n))
+                    state = (r, n)
+                else:
+                    # 先刪掉再新增（跟上傳流程一樣，同一來源不會重複）
+                    store.delete_source(CID, src)
+                    store.add_embeddings(CID, _vectors(src, r, n), [dict(m, source=src) for m in _metas(src, r, n)])
+                    state = (r, n)
+                with expected_lock:
+                    if state is None:
+                        expected.pop(src, None)
+                    else:
+                        expected[src] = state
+        except BaseException as e:   # noqa: BLE001 - 交給主執行緒報告
+            errors.append(e)
+
+    def reader(k: int):
+        try:
+            rng = np.random.default_rng(k)
+            while not done.is_set():
+                w = int(rng.integers(WRITERS))
+                src = f"src{w}x{int(rng.integers(SOURCES_PER_WRITER))}"
+                q = _vectors(src, 0, 1)[0]
+                # 過濾搜尋
+                _check_hits(store.search(CID, q, top_k=10, sources=[src]), src)
+                # 混合搜尋（向量 + 關鍵字），同樣限定來源
+                _check_hits(store.search(CID, q, top_k=10, sources=[src], query_text=f"{src} paragraph"), src)
+                # 不過濾的混合搜尋：每個結果都要是完整的段落
+                for h in store.search(CID, q, top_k=5, query_text="paragraph"):
+                    assert h["source"].startswith("src") and "paragraph" in h["text"], h
+        except BaseException as e:   # noqa: BLE001
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(WRITERS)]
+    readers = [threading.Thread(target=reader, args=(k,)) for k in range(READERS)]
+    for t in threads + readers:
+        t.start()
+    for t in threads:
+        t.join()
+    done.set()
+    for t in readers:
+        t.join()
+    assert not errors, errors
+
+    _wait_compaction()
+
+    # 來源段落數與寫入端記錄的一致
+    want = {src: n for src, (_ver, n) in expected.items()}
+    assert store.list_sources(CID) == want
+
+    def snapshot():
+        out = {}
+        for src, (ver, n) in expected.items():
+            hits = store.search(CID, _vectors(src, ver, 1)[0], top_k=n + 5, sources=[src])
+            _check_hits(hits, src)
+            assert len(hits) == n and hits[0]["ver"] == ver
+            out[src] = sorted(h["text"] for h in hits)
+        return out
+
+    before = snapshot()
+    count = store.count(CID)
+
+    # 移出快取後從磁碟重新載入（manifest + 主檔 + 段檔重播），內容要完全一樣
+    store._COLLECTIONS.pop(CID)
+    assert store.count(CID) == count
+    assert store.list_sources(CID) == want
+    assert snapshot() == before
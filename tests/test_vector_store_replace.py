@@ -0,0 +1,50 @@
+# tests/test_vector_store_replace.py
+# ---------------------------------------------
+# replace_source 的中斷測試：
+# - 新版本的段檔已經落地，但 manifest 還沒記下舊列的刪除範圍就中斷
+# - 重新從磁碟載入後，舊版本不能再出現（只剩新版本）
+# 執行：python -m pytest -q tests/test_vector_store_replace.py
+# ---------------------------------------------
+
+import numpy as np
+import pytest
+
+from services import vector_store
+
+DIM = 8
+CID = "replace_crash"
+
+
+def _batch(source: str, version: int, n: int):
+    rng = np.random.default_rng(version)
+    vecs = rng.normal(size=(n, DIM))
+    vecs = (vecs / np.linalg.norm(vecs, axis=1, keepdims=True)).astype("float32")
+    metas = [{"page": i + 1, "text": f"{source} paragraph {i} ver{version}", "ver": version} for i in range(n)]
+    return vecs, metas
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_store, "BASE_DIR", tmp_path / "collections")
+    vector_store.BASE_DIR.mkdir()
+    monkeypatch.setattr(vector_store, "FSYNC", False)
+    vector_store.reset_collection(CID, DIM)
+    yield vector_store
+    vector_store.drop_collection(CID)
+
+
+def test_replace_survives_crash_before_manifest(store, monkeypatch):
+    vecs, metas = _batch("a.pdf", 1, 4)
+    store.replace_source(CID, "a.pdf", vecs, metas)
+    store.replace_source(CID, "b.pdf", *_batch("b.pdf", 2, 2))
+
+    # 模擬中斷：段檔寫完，manifest 的刪除範圍沒寫進去
+    vecs, metas = _batch("a.pdf", 3, 3)
+    with monkeypatch.context() as m:
+        m.setattr(vector_store, "_write_deleted", lambda cid, obj: None)
+        store.replace_source(CID, "a.pdf", vecs, metas)
+
+    store._COLLECTIONS.pop(CID)
+    assert store.list_sources(CID) == {"a.pdf": 3, "b.pdf": 2}
+    hits = store.search(CID, vecs[0], top_k=10, sources=["a.pdf"])
+    assert len(hits) == 3 and {h["ver"] for h in hits} == {3}